@@ -89,6 +89,7 @@ class ChoiceFilter(Filter):
     def __init__(self, display_name: str, field_name: str, choices: List[Tuple]):
         super().__init__(display_name, field_name)
         self.choices = choices
+        self.choice_counts = None
         if not choices:
             raise ValueError("Choices must not be empty")
 
@@ -104,6 +105,14 @@ class ChoiceFilter(Filter):
     def get_filter_params(self) -> Dict:
         return {self.field_name: self.values[0]}
 
+    def choices_with_counts(self):
+        """
+        Yield (value, label, count) for each choice, where count is the number of voters the choice
+        would leave (see count_choices below), or None if they haven't been counted.
+        """
+        for value, label, description in self.choices:
+            yield value, label, None if self.choice_counts is None else self.choice_counts.get(value, 0)
+
     def description(self) -> Optional[str]:
         """
         Return the appropriate description for the currently selected choice.
@@ -251,9 +260,36 @@ def filters_from_request(declared_filters: List[Filter], request: HttpRequest) -
             logger.warning('URL had a filter that is not in declared_filters: %s', field_name)
             continue
         filter_params.update(filter_inst.get_filter_params())
-        filter_inst.count = NCVoter.get_count(filter_params)
-        filter_inst.filter_params = filter_params
+        filter_inst.filter_params = filter_params.copy()
 
         applied_filters[field_name] = filter_inst
 
+    # Count all the cumulative filter parameters at once, so those not cached yet take a single
+    # pass over the voters
+    counts = NCVoter.get_counts([filter_inst.filter_params for filter_inst in applied_filters.values()])
+    for filter_inst, count in zip(applied_filters.values(), counts):
+        filter_inst.count = count
+
     return applied_filters, filter_params
+
+
+def count_choices(unapplied_filters: List[Filter], filter_params: Dict) -> List[Filter]:
+    """
+    Given a list of Filter objects that have not been applied, and the filter parameters
+    that have:
+    Return copies of the Filter objects, with '.choice_counts' set on each ChoiceFilter
+    (or MultiChoiceFilter) to a dict of the number of voters left by each of its choices.
+    The choices of all the filters are counted together (see NCVoter.get_facet_counts).
+    """
+    fields = [f.field_name for f in unapplied_filters if isinstance(f, ChoiceFilter)]
+    facet_counts = NCVoter.get_facet_counts(filter_params, fields) if fields else {}
+    counted_filters = []
+    for filter_inst in unapplied_filters:
+        filter_inst = copy(filter_inst)
+        if filter_inst.field_name in facet_counts:
+            # The choice values are strings, whatever the type of the field
+            filter_inst.choice_counts = {
+                str(value): count for value, count in facet_counts[filter_inst.field_name].items()
+            }
+        counted_filters.append(filter_inst)
+    return counted_filters
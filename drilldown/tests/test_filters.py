@@ -5,7 +5,8 @@ from unittest.mock import MagicMock, patch
 from django.http import QueryDict
 from django.test import TestCase
 
-from drilldown.filters import ChoiceFilter, MultiChoiceFilter, AgeFilter, FreeTextFilter, filters_from_request
+from drilldown.filters import ChoiceFilter, MultiChoiceFilter, AgeFilter, FreeTextFilter, filters_from_request, \
+    count_choices
 
 
 class FiltersTest(TestCase):
@@ -202,3 +203,20 @@ class FiltersFromRequestTest(FiltersTest):
         self.assertEqual(len(applied), 0)
         self.assertEqual(params, {})
         mock_warning.assert_called()
+
+
+@patch('drilldown.filters.NCVoter')
+class CountChoicesTest(FiltersTest):
+    def test_counts_all_at_once(self, mock_ncvoter):
+        mock_ncvoter.get_facet_counts.return_value = {'indent': {'S': 3}, 'pet': {'C': 1, 'D': 2}}
+        counted = count_choices(self.test_filters[1:], {'num': '1'})
+        mock_ncvoter.get_facet_counts.assert_called_once_with({'num': '1'}, ['indent', 'pet'])
+        self.assertEqual([('S', 'spaces', 3), ('T', 'tabs', 0)], list(counted[0].choices_with_counts()))
+        self.assertEqual([('C', 'cats', 1), ('D', 'dogs', 2)], list(counted[1].choices_with_counts()))
+        self.assertEqual(['age', 'rando'], [f.field_name for f in counted[2:]])
+        # The declared filters are left alone
+        self.assertEqual([('S', 'spaces', None), ('T', 'tabs', None)], list(self.test_filters[1].choices_with_counts()))
+
+    def test_no_choice_filters(self, mock_ncvoter):
+        self.assertEqual(['age'], [f.field_name for f in count_choices([self.test_filters[3]], {})])
+        mock_ncvoter.get_facet_counts.assert_not_called()
@@ -1,6 +1,7 @@
 from django.shortcuts import render
 
-from drilldown.filters import ChoiceFilter, MultiChoiceFilter, AgeFilter, filters_from_request, FreeTextFilter
+from drilldown.filters import ChoiceFilter, MultiChoiceFilter, AgeFilter, filters_from_request, FreeTextFilter, \
+    count_choices
 from voter.models import NCVoter
 from voter.constants import STATUS_FILTER_CHOICES, COUNTY_FILTER_CHOICES, GENDER_FILTER_CHOICES, \
     PARTY_FILTER_CHOICES, CITY_FILTER_CHOICES, RACE_FILTER_CHOICES, STATE_FILTER_CHOICES
@@ -50,10 +51,17 @@ declared_filters = [
     AgeFilter(),
 ]
 
+# The keys of NCVoter.data that the sample page shows
+SAMPLE_DATA_KEYS = NCVoter.LABEL_DATA_KEYS + (
+    'first_name', 'midl_name', 'middle_name', 'last_name', 'res_street_address', 'house_num', 'street_name',
+    'street_type_cd', 'res_city_desc', 'zip_code', 'full_phone_number', 'area_cd', 'phone_num',
+)
+
 
 def drilldown(request):
     applied_filters, final_filter_params = filters_from_request(declared_filters, request)
-    unapplied_filters = [f for f in declared_filters if f.field_name not in applied_filters]
+    unapplied_filters = count_choices(
+        [f for f in declared_filters if f.field_name not in applied_filters], final_filter_params)
     total_count = NCVoter.get_count(filters={})
 
     return render(request, 'drilldown/drilldown.html', {
@@ -65,7 +73,7 @@ def drilldown(request):
 
 def sample(request):
     applied_filters, final_filter_params = filters_from_request(declared_filters, request)
-    sample_results = NCVoter.get_random_sample(final_filter_params, 20)
+    sample_results = NCVoter.get_random_sample(final_filter_params, 20).project(*SAMPLE_DATA_KEYS)
     total_count = NCVoter.get_count(filters={})
 
     return render(request, 'drilldown/sample.html', {
@@ -187,6 +187,45 @@ NCVOTER_LATEST_COUNTY_URL_BASE = NCSBE_S3_URL_BASE + "ncvoter"
 NCVHIS_LATEST_COUNTY_URL_BASE = NCSBE_S3_URL_BASE + "ncvhis"
 NCVOTER_HISTORICAL_SNAPSHOT_URL = NCSBE_S3_URL_BASE + "Snapshots/"
 
+# Database connections to recount NCVoterQueryCache with, most often hit first, and how many
+# seconds to spend on it before giving up on the rest
+NCVOTER_QUERY_CACHE_REFRESH_WORKERS = 4
+NCVOTER_QUERY_CACHE_REFRESH_BUDGET = 30 * 60
+# Most entries NCVoterQueryCache keeps, which ones go first ('lfu' or 'lru'), after how many days
+# without a hit they expire, and what fraction of hits are recorded
+NCVOTER_QUERY_CACHE_MAX_SIZE = 10000
+NCVOTER_QUERY_CACHE_EVICTION = 'lfu'
+NCVOTER_QUERY_CACHE_MAX_IDLE_DAYS = 30
+NCVOTER_QUERY_CACHE_HIT_SAMPLE_RATE = 0.1
+
+# Counts are cached in front of NCVoterQueryCache in this cache (point it at a shared backend
+# such as memcached to share it between processes), and in an LRU of this many entries in each
+# process. A new DataGeneration leaves all cached counts behind. See voter/count_cache.py.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'counts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'counts',
+        'TIMEOUT': 24 * 60 * 60,
+    },
+}
+NCVOTER_COUNT_CACHE = 'counts'
+NCVOTER_COUNT_CACHE_LOCAL_SIZE = 1000
+
+# Serve counts from memory-mapped bitmaps (voter/bitmaps.py, needs NumPy), rebuilt in
+# NCVOTER_BITMAP_PATH for each new DataGeneration. Web workers look for a new generation every
+# NCVOTER_BITMAP_CHECK_INTERVAL seconds.
+NCVOTER_BITMAP_ENGINE = False
+NCVOTER_BITMAP_PATH = "bitmaps"
+NCVOTER_BITMAP_CHECK_INTERVAL = 10
+
 if 'test' in sys.argv:
     # turn down logging during tests
     LOGGING['handlers']['console']['level'] = 'ERROR'
+    # worker threads wouldn't see the data of the test transaction
+    NCVOTER_QUERY_CACHE_REFRESH_WORKERS = 1
+    # counts cached in one test would outlive its transaction
+    CACHES['counts'] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    NCVOTER_COUNT_CACHE_LOCAL_SIZE = 0
@@ -55,7 +55,7 @@ def qadashboard(request):
                         "phone_num": str(random.randint(1000000, 9999999)),
                     })
                     ncid += 1
-            NCVoterQueryView.refresh()
+            NCVoterQueryView.rebuild()
         else:
             form = ResetForm(request.POST)
             msg = "You didn't say the magic word"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""benchmark_row_hash.py path/to/snapshot.txt [repeat] [changed]
+
+This script measures the per-row cost of hashing snapshot rows, before and after
+versioned hashing:
+
+* before: the legacy bencode+MD5 hash, computed once per row to check if the row was
+  already seen, and once more for each changed row, when recording the change
+* after: the current hash, computed once per row and passed along
+
+How many rows changed is given as a fraction (default 0, as in a snapshot where every
+row was already seen). Only the hashing is timed, not the rest of processing a row.
+
+Rows are read with the csv module rather than the full snapshot processing pipeline, so
+Django doesn't need to be set up. The file is assumed to be a latin1, tab delimited
+snapshot file such as those under voter/test_data/.
+
+Example usage:
+
+    scripts/benchmark_row_hash.py voter/test_data/2010-10-31T00-00-00/snapshot_latin1.txt 2000 0.1
+"""
+
+import csv
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from voter.hashing import CURRENT_VERSION, LEGACY_VERSION, row_hash  # noqa: E402
+
+path = sys.argv[1]
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+changed = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+with open(path, encoding='latin1') as f:
+    reader = csv.DictReader(f, delimiter='\t')
+    rows = [{k.lower(): v.strip() for k, v in row.items() if v and v.strip()} for row in reader]
+
+
+changed_rows = rows[:round(len(rows) * changed)]
+
+
+def before():
+    for row in rows:
+        row_hash(row, LEGACY_VERSION)
+    for row in changed_rows:
+        row_hash(row, LEGACY_VERSION)
+
+
+def after():
+    for row in rows:
+        row_hash(row, CURRENT_VERSION)
+
+
+count = len(rows) * repeat
+print("{} rows ({} changed) x {} repeats".format(len(rows), len(changed_rows), repeat))
+results = {}
+for name, func in (('before', before), ('after', after)):
+    seconds = min(timeit.repeat(func, number=repeat, repeat=3))
+    results[name] = seconds
+    print("{:>7}: {:.2f} us per row".format(name, seconds / count * 1e6))
+print("speedup: {:.1f}x".format(results['before'] / results['after']))
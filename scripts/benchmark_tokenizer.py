@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""benchmark_tokenizer.py path/to/snapshot.txt [repeat]
+
+This script measures the per-line cost of reading a snapshot file and splitting its lines
+into rows, before and after the fast tokenizer:
+
+* before: the file is read through a text-mode wrapper, and each line is split with
+  clean_and_split_line() and turned into a row with a dict comprehension over the header
+* after: the file is read in blocks that are decoded in one go, and each line is split with
+  split_fields() and turned into a row by a RowSplitter made once for the file
+
+The lines after the header are repeated `repeat` times in memory, so that the test files
+under voter/test_data/ are big enough to measure. Bad lines are dropped rather than
+recorded, so no database is needed, but the snapshot processing module needs Django to be
+set up to be imported.
+
+Example usage:
+
+    scripts/benchmark_tokenizer.py voter/test_data/2010-10-31T00-00-00/snapshot_utf16.txt 2000
+"""
+
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ncvoter.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from voter.management.commands.voter_process_snapshot import (  # noqa: E402
+    FILE_CODECS, RowSplitter, clean_and_split_line, decode_lines, get_file_encoding, read_line_blocks,
+)
+
+path = sys.argv[1]
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+encoding = get_file_encoding(path)
+codec, bom = FILE_CODECS[encoding]
+
+with open(path, encoding=encoding) as f:
+    header_line = f.readline()
+    body = f.read()
+data = bom + (header_line + body * repeat).encode(codec)
+
+
+def before():
+    count = 0
+    with io.TextIOWrapper(io.BytesIO(data), encoding=encoding) as f:
+        header = clean_and_split_line(f.readline(), make_lowercase=True)
+        for line in f:
+            fields = clean_and_split_line(line)
+            if len(fields) != len(header):
+                continue
+            {header[i]: fields[i].strip() for i in range(len(header)) if not fields[i].strip() == ''}
+            count += 1
+    return count
+
+
+def after():
+    count = 0
+    with io.BytesIO(data) as f:
+        f.read(len(bom))
+        lines = (line for block in read_line_blocks(f, '\n'.encode(codec)) for line in decode_lines(block, codec))
+        splitter = RowSplitter(clean_and_split_line(next(lines, ''), make_lowercase=True))
+        for line in lines:
+            row, warning, error = splitter.split(line)
+            if row is not None:
+                count += 1
+    return count
+
+
+count = before()
+print("{} lines x {} repeats ({})".format(count // repeat, repeat, encoding))
+results = {}
+for name, func in (('before', before), ('after', after)):
+    seconds = min(timeit.repeat(func, number=1, repeat=3))
+    results[name] = seconds
+    print("{:>7}: {:.2f} us per line".format(name, seconds / count * 1e6))
+print("speedup: {:.1f}x".format(results['before'] / results['after']))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""duplicate_dataset.py path/to/tab-delimited.txt [copies] [rate]
+
+This script will take a tab delimited NC voter dataset and output a dataset in which a
+`rate` fraction of the voters (default 0.5) appear `copies` times (default 3), each time
+with a different last name, scattered around the file. This can be used to benchmark how
+voter_process_snapshot copes with a high rate of repeated NCIDs within a file.
+
+The input is assumed to be latin1 encoded, like the files under voter/test_data/. The new
+version is printed to stdout and can be piped to a new file.
+
+Example usage:
+
+    mkdir /tmp/duplicates
+    scripts/duplicate_dataset.py voter/test_data/2010-10-31T00-00-00/snapshot_latin1.txt 5 0.8 > /tmp/duplicates/snapshot.txt
+    python manage.py voter_add_files /tmp/duplicates/
+    time python manage.py voter_process_snapshot
+"""
+
+import io
+import sys
+import csv
+import random
+
+path = sys.argv[1]
+copies = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+f = open(path, encoding='latin1')
+out = io.TextIOWrapper(sys.stdout.buffer, encoding='latin1')
+
+reader = csv.DictReader(f, delimiter='\t')
+
+LAST_NAMES = [
+    'WILSON',
+    'MCDONALD',
+    'SMITH',
+    'RODRIGUEZ',
+]
+
+writer = csv.DictWriter(out, delimiter='\t', fieldnames=reader.fieldnames)
+writer.writeheader()
+
+rows = []
+for row in reader:
+    rows.append(row)
+    if random.random() < rate:
+        for i in range(copies - 1):
+            rows.append(dict(row, last_name=random.choice(LAST_NAMES)))
+
+random.shuffle(rows)
+for row in rows:
+    writer.writerow(row)
+out.flush()
@@ -1,23 +1,30 @@
 from django.contrib import admin
 
-from voter.models import FileTracker, ChangeTracker, NCVoter, NCVHis, BadLineRange, \
+from voter.models import FileTracker, ChangeTracker, FieldChange, NCVoter, NCVHis, BadLineRange, \
     NCVoterQueryView, NCVoterQueryCache
 
 
 @admin.register(FileTracker)
 class FileTrackerAdmin(admin.ModelAdmin):
     ordering = ('created',)
-    readonly_fields = ('etag', 'filename', 'data_file_kind', 'created')
-    list_display = ('short_filename', 'created', 'data_file_kind', 'file_status')
+    readonly_fields = ('etag', 'filename', 'data_file_kind', 'created', 'claimed_by', 'heartbeat', 'lease_expires',
+                       'checkpoint_offset', 'checkpoint_line_no', 'checkpoint_row_no', 'checkpoint_encoding')
+    list_display = ('short_filename', 'created', 'data_file_kind', 'file_status', 'claimed_by')
 
 
 @admin.register(ChangeTracker)
 class ChangeTrackerAdmin(admin.ModelAdmin):
     list_display = ('op_code', 'model_name', 'voter', 'election_desc',)
-    readonly_fields = ('op_code', 'model_name', 'md5_hash', 'file_tracker',
+    readonly_fields = ('op_code', 'model_name', 'md5_hash', 'hash_version', 'file_tracker',
                        'voter', 'election_desc')
 
 
+@admin.register(FieldChange)
+class FieldChangeAdmin(admin.ModelAdmin):
+    list_display = ('voter', 'field', 'old_value', 'new_value', 'snapshot_dt')
+    readonly_fields = ('voter', 'change', 'field', 'old_value', 'new_value', 'snapshot_dt')
+
+
 @admin.register(NCVHis)
 class NCVHis(admin.ModelAdmin):
     pass
@@ -37,10 +44,10 @@ class BadLineRangeAdmin(admin.ModelAdmin):
 class NCVoterQueryViewAdmin(admin.ModelAdmin):
     actions = None
     list_display_links = None
-    list_display = ('id', 'party_cd', 'county_id', 'race_ethnicity_code', 'status_cd', 'birth_state',
+    list_display = ('voter_id', 'party_cd', 'county_id', 'race_ethnicity_code', 'status_cd', 'birth_state',
                     'gender_code', 'age', 'res_city_desc', 'zip_code', )
     list_filter = ('party_cd', 'race_ethnicity_code', 'status_cd', 'gender_code', )
-    search_fields = ('id', )
+    search_fields = ('voter_id', )
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -51,5 +58,5 @@ class NCVoterQueryViewAdmin(admin.ModelAdmin):
 
 @admin.register(NCVoterQueryCache)
 class NCVoterQueryCacheAdmin(admin.ModelAdmin):
-    list_display = ('qs_filters', 'count')
+    list_display = ('qs_filters', 'count', 'hit_count', 'last_hit')
     search_fields = ('qs_filters', )
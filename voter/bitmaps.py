@@ -0,0 +1,219 @@
+"""In-memory bitmap engine for NCVoter.get_count.
+
+An optional alternative to counting voter_ncvoterqueryview in the database, turned on with
+settings.NCVOTER_BITMAP_ENGINE. It needs NumPy, which is only imported once the engine is used.
+
+The facet columns of every row are written once per data generation (see DataGeneration) to
+NumPy files in a directory of their own under settings.NCVOTER_BITMAP_PATH:
+
+* for each low-cardinality facet (BITMAP_FACETS), one packed bitmap per value, with a bit set
+  for each row that has the value
+* for each high-cardinality facet (CODE_FACETS), the code of the value of each row, as there
+  would be too many bitmaps
+* the age of each row
+
+Web workers memory-map the files of the current generation, so they all share one copy in the
+page cache, and count the rows matching a filter dict by ANDing bitmaps together and counting
+the bits that are set.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+BITMAP_FACETS = ('party_cd', 'county_id', 'race_ethnicity_code', 'status_cd', 'birth_state', 'gender_code')
+CODE_FACETS = ('res_city_desc', 'zip_code')
+INTEGER_FACETS = ('county_id',)
+
+META_FILENAME = 'meta.json'
+# Stands for a NULL age
+NO_AGE = -32768
+# Rows fetched from the database at a time while building
+FETCH_SIZE = 100000
+
+# The engine of this process, and when the current generation was last looked up
+_engine = None
+_checked_at = None
+
+
+def build(generation, path=None):
+    """Write the files of the engine for `generation` from voter_ncvoterqueryview, and delete
+    those of earlier generations. The files are written to a temporary directory first, and
+    moved into place once complete, so a web worker never loads half of them. Returns the
+    directory, or None if `generation` isn't the current one any more.
+
+    The rows are read as of the last NCVoterQueryView.refresh(), like the cached counts of the
+    generation: the deltas synced since are taken back out. The generation is looked up in the
+    same snapshot, so the files are never of data that's moved past it.
+    """
+    from voter.models import DataGeneration
+    import numpy as np
+
+    path = path or settings.NCVOTER_BITMAP_PATH
+    os.makedirs(path, exist_ok=True)
+    facets = BITMAP_FACETS + CODE_FACETS
+    values = {facet: {} for facet in facets}
+    chunks = {facet: [] for facet in facets + ('age',)}
+    columns = ', '.join(facets + ('age',))
+
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost:
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        if DataGeneration.current() != generation:
+            return None
+        with connection.chunked_cursor() as cursor:
+            # Rows as multisets: the rows before each pending change are put back, and those after
+            # it taken out
+            cursor.execute("""
+                SELECT {columns} FROM voter_ncvoterqueryview
+                 UNION ALL SELECT {columns} FROM voter_ncvoterquerydelta WHERE sign = -1
+                EXCEPT ALL SELECT {columns} FROM voter_ncvoterquerydelta WHERE sign = 1
+            """.format(columns=columns))
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for i, facet in enumerate(facets):
+                    codes = values[facet]
+                    chunks[facet].append(np.array([codes.setdefault(row[i], len(codes)) for row in rows], dtype=np.int32))
+                chunks['age'].append(np.array([NO_AGE if row[-1] is None else row[-1] for row in rows], dtype=np.int16))
+
+    directory = tempfile.mkdtemp(dir=path)
+    size = sum(len(chunk) for chunk in chunks['age'])
+    for facet in facets:
+        codes = np.concatenate(chunks[facet]) if size else np.zeros(0, dtype=np.int32)
+        if facet in BITMAP_FACETS:
+            bitmaps = np.zeros((len(values[facet]), (size + 7) // 8), dtype=np.uint8)
+            for code in range(len(values[facet])):
+                bitmaps[code] = np.packbits(codes == code)
+            np.save(os.path.join(directory, facet + '.npy'), bitmaps)
+        else:
+            np.save(os.path.join(directory, facet + '.npy'), codes.astype(np.uint16 if len(values[facet]) < 2 ** 16 else np.int32))
+    ages = np.concatenate(chunks['age']) if size else np.zeros(0, dtype=np.int16)
+    np.save(os.path.join(directory, 'age.npy'), ages)
+    with open(os.path.join(directory, META_FILENAME), 'w') as f:
+        json.dump({'size': size, 'values': {facet: list(values[facet]) for facet in facets}}, f)
+    os.chmod(directory, 0o755)
+
+    target = os.path.join(path, str(generation))
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.rename(directory, target)
+    for name in os.listdir(path):
+        if name.isdigit() and int(name) < generation:
+            # Workers still using these keep their mappings until they switch over
+            shutil.rmtree(os.path.join(path, name))
+    return target
+
+
+class BitmapEngine:
+    "The engine files of one generation, memory-mapped."
+
+    def __init__(self, directory, generation):
+        import numpy as np
+
+        self.np = np
+        self.generation = generation
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        self.size = meta['size']
+        self.codes = {
+            facet: {value: code for code, value in enumerate(values)} for facet, values in meta['values'].items()
+        }
+        self.arrays = {
+            facet: np.load(os.path.join(directory, facet + '.npy'), mmap_mode='r')
+            for facet in BITMAP_FACETS + CODE_FACETS + ('age',)
+        }
+        # Number of bits set in each byte value
+        self.popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _codes(self, facet, values):
+        "The codes of `values` for `facet`, or None if they can't be compared like the database would."
+        codes = []
+        for value in values:
+            if value is None:
+                return None
+            try:
+                value = int(value) if facet in INTEGER_FACETS else str(value)
+            except ValueError:
+                return None
+            if value in self.codes[facet]:
+                codes.append(self.codes[facet][value])
+        return codes
+
+    def _match(self, field, lookup, value):
+        "Return a packed bitmap of the rows matching one filter, or None if it isn't supported."
+        np = self.np
+        if field in BITMAP_FACETS + CODE_FACETS and lookup in ('', 'exact', 'in'):
+            codes = self._codes(field, list(value) if lookup == 'in' else [value])
+            if codes is None:
+                return None
+            if field in CODE_FACETS:
+                return np.packbits(np.isin(self.arrays[field], codes))
+            bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+            for code in codes:
+                bits |= self.arrays[field][code]
+            return bits
+        if field == 'age' and lookup in ('', 'exact', 'gt', 'gte', 'lt', 'lte'):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                return None
+            ages = self.arrays['age']
+            compare = {
+                '': np.equal, 'exact': np.equal, 'gt': np.greater, 'gte': np.greater_equal,
+                'lt': np.less, 'lte': np.less_equal,
+            }[lookup]
+            return np.packbits(compare(ages, value) & (ages != NO_AGE))
+        return None
+
+    def get_count(self, filters):
+        """Return the number of rows matching `filters` (as for NCVoter.get_count), or None if
+        some filter isn't supported.
+        """
+        mask = None
+        for key, value in filters.items():
+            field, _, lookup = key.partition('__')
+            bits = self._match(field, lookup, value)
+            if bits is None:
+                return None
+            mask = bits if mask is None else mask & bits
+        if mask is None:
+            return self.size
+        return int(self.popcount[mask].sum(dtype=self.np.int64))
+
+
+def get_engine():
+    """Return the BitmapEngine of the current data generation, or None if the engine is turned
+    off or the files of the current generation aren't built yet. The current generation is
+    looked up at most every settings.NCVOTER_BITMAP_CHECK_INTERVAL seconds.
+    """
+    global _engine, _checked_at
+    if not settings.NCVOTER_BITMAP_ENGINE:
+        return None
+    now = time.monotonic()
+    if _checked_at is None or now - _checked_at >= settings.NCVOTER_BITMAP_CHECK_INTERVAL:
+        from voter.models import DataGeneration
+
+        _checked_at = now
+        generation = DataGeneration.current()
+        if _engine is None or _engine.generation != generation:
+            directory = os.path.join(settings.NCVOTER_BITMAP_PATH, str(generation))
+            if os.path.exists(os.path.join(directory, META_FILENAME)):
+                _engine = BitmapEngine(directory, generation)
+            else:
+                _engine = None
+    return _engine
+
+
+def reset():
+    "Forget the engine of this process, so the next get_engine() looks up the generation again."
+    global _engine, _checked_at
+    _engine = None
+    _checked_at = None
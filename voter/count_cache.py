@@ -0,0 +1,110 @@
+"""Two tiers of caching in front of NCVoterQueryCache, for NCVoter.get_count (and get_facet_counts).
+
+1. a small LRU in the memory of each process (NCVOTER_COUNT_CACHE_LOCAL_SIZE entries)
+2. the Django cache named by settings.NCVOTER_COUNT_CACHE, shared by all processes if its
+   backend is (e.g. memcached)
+
+Both are keyed by a canonical serialization of the filters and the current DataGeneration, so
+when NCVoterQueryView.refresh() starts a new generation, all counts cached for the previous one
+are left behind at once, without deleting anything. The current generation is looked up in the
+database (a max() over a handful of rows) for each call of get_count() or get_facet_counts(),
+before any cached count is read, so no count from before a refresh is served once it has
+committed, whatever the cache backend, even in a process that doesn't share any cache with the
+one that ran the refresh.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+
+_local = OrderedDict()
+_lock = threading.Lock()
+# The current generation as last looked up
+_generation = None
+
+
+def shared_cache():
+    return caches[settings.NCVOTER_COUNT_CACHE]
+
+
+def canonical(filters):
+    """Serialize `filters` so that equivalent filter dicts come out the same: keys are sorted,
+    and so are the values of `__in` filters.
+    """
+    return json.dumps(
+        {key: sorted(value, key=str) if key.endswith('__in') else value for key, value in filters.items()},
+        sort_keys=True, separators=(',', ':'), cls=DjangoJSONEncoder,
+    )
+
+
+def get_generation():
+    "Look up the current data generation in the database."
+    global _generation
+    from voter.models import DataGeneration
+
+    generation = DataGeneration.current()
+    if generation != _generation:
+        # Nothing cached for an earlier generation is of any use any more
+        clear_local()
+        _generation = generation
+    return generation
+
+
+def make_key(filters, facets=(), generation=None):
+    """Return the key the count for `filters` is cached under in `generation` (by default the
+    current one), or with `facets`, the key of the counts of each value of those fields (see
+    NCVoter.get_facet_counts).
+    """
+    if generation is None:
+        generation = get_generation()
+    kind = 'facets:' + ','.join(facets) if facets else 'count'
+    digest = hashlib.md5(canonical(filters).encode('utf-8')).hexdigest()
+    return 'ncvoter:{}:{}:{}'.format(kind, generation, digest)
+
+
+def get(key):
+    """Return the (count, NCVoterQueryCache ID or None) cached under `key`, or None. A hit in the
+    shared cache is kept in the local one too.
+    """
+    with _lock:
+        if key in _local:
+            _local.move_to_end(key)
+            return _local[key]
+    value = shared_cache().get(key)
+    if value is not None:
+        _set_local(key, value)
+    return value
+
+
+def set(key, count, cached_query_id=None):
+    "Cache `count` (or the facet counts of NCVoter.get_facet_counts) under `key` in both tiers."
+    value = (count, cached_query_id)
+    shared_cache().set(key, value)
+    _set_local(key, value)
+
+
+def _set_local(key, value):
+    size = settings.NCVOTER_COUNT_CACHE_LOCAL_SIZE
+    if size <= 0:
+        return
+    with _lock:
+        _local[key] = value
+        _local.move_to_end(key)
+        while len(_local) > size:
+            _local.popitem(last=False)
+
+
+def clear_local():
+    "Empty the cache of this process."
+    with _lock:
+        _local.clear()
+
+
+def reset():
+    "Forget the current generation."
+    global _generation
+    _generation = None
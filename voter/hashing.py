@@ -0,0 +1,47 @@
+"""Hashing of snapshot rows, used to recognize rows we have already recorded.
+
+Every hash is stored together with the version of the algorithm that produced it
+(ChangeTracker.hash_version, NCVoter.latest_hash_version), so a stored hash is only ever
+compared with a hash of the new row made by the same algorithm. All versions produce 32
+hex digits, so they fit the same columns.
+"""
+import hashlib
+
+from bencode import bencode
+
+# bencode the row, then MD5 it. This is what all the changes recorded before versioning used.
+LEGACY_VERSION = 1
+# Join the sorted keys and values with control characters, then BLAKE2b it
+SORTED_BLAKE2_VERSION = 2
+
+CURRENT_VERSION = SORTED_BLAKE2_VERSION
+
+# Never part of the hash: it changes with every snapshot even when nothing else does
+EXCLUDED_FIELDS = ('snapshot_dt',)
+
+UNIT_SEPARATOR = '\x1f'
+RECORD_SEPARATOR = '\x1e'
+
+
+def legacy_hash(row):
+    row = {k: v for k, v in row.items() if k not in EXCLUDED_FIELDS}
+    return hashlib.md5(bytes(bencode(row), 'utf-8')).hexdigest()
+
+
+def sorted_blake2_hash(row):
+    # The separators never show up in the (stripped) field values of a snapshot file
+    data = RECORD_SEPARATOR.join(
+        k + UNIT_SEPARATOR + v for k, v in sorted(row.items()) if k not in EXCLUDED_FIELDS
+    )
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+HASH_FUNCTIONS = {
+    LEGACY_VERSION: legacy_hash,
+    SORTED_BLAKE2_VERSION: sorted_blake2_hash,
+}
+
+
+def row_hash(row, version=CURRENT_VERSION):
+    "Given a dictionary of raw `row` data (field name to string), returns the hex of its hash"
+    return HASH_FUNCTIONS[version](row)
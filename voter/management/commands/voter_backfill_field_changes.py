@@ -0,0 +1,66 @@
+from django.core.management import BaseCommand
+from django.db import connection
+from django.db.models import Max, Min
+
+from voter.models import ChangeTracker
+from voter.utils import out, tqdm_or_quiet
+
+
+def backfill_chunk(cursor, first_id, last_id):
+    """Add the FieldChange rows of every Modify change of the voters in the given ID range that
+    doesn't have them yet. The value a field had before a change is its value in the latest
+    earlier change of the voter that has it. Returns the number of rows added.
+    """
+    cursor.execute("""
+        INSERT INTO voter_fieldchange (voter_id, change_id, field, old_value, new_value, snapshot_dt)
+        SELECT voter_id, change_id, field, nullif(old_value, 'null'), nullif(new_value, 'null'), snapshot_dt
+          FROM (SELECT c.voter_id, c.id AS change_id, c.op_code, c.snapshot_dt, d.key AS field, d.value AS new_value,
+                       lag(d.value) OVER (PARTITION BY c.voter_id, d.key ORDER BY c.snapshot_dt, c.id) AS old_value
+                  FROM voter_changetracker c
+                 CROSS JOIN jsonb_each(c.data) d
+                 WHERE c.voter_id BETWEEN %s AND %s) f
+         WHERE op_code = %s
+            ON CONFLICT (change_id, field) DO NOTHING
+    """, [first_id, last_id, ChangeTracker.OP_CODE_MODIFY])
+    return cursor.rowcount
+
+
+def backfill_field_changes(chunk_size, output):
+    tqdm = tqdm_or_quiet(output)
+    bounds = ChangeTracker.objects.filter(op_code=ChangeTracker.OP_CODE_MODIFY).aggregate(
+        Min('voter_id'), Max('voter_id'))
+    if bounds['voter_id__min'] is None:
+        out("There are no modify changes to index", output)
+        return 0
+
+    added = 0
+    chunks = range(bounds['voter_id__min'], bounds['voter_id__max'] + 1, chunk_size)
+    # Each chunk is its own statement, and so its own transaction: if interrupted, just run
+    # it again and it skips over the rows that are already there.
+    with connection.cursor() as cursor:
+        for first_id in tqdm(chunks):
+            added += backfill_chunk(cursor, first_id, first_id + chunk_size - 1)
+    out("Backfilled {} field changes".format(added), output)
+    return added
+
+
+class Command(BaseCommand):
+    help = "Fill in FieldChange from the existing change history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            dest='chunk_size',
+            help='Number of voter IDs to backfill per statement',
+        )
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            help='Do not output updates or progress while running',
+        )
+
+    def handle(self, *args, **options):
+        backfill_field_changes(options['chunk_size'], not options.get('quiet'))
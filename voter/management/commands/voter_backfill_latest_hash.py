@@ -0,0 +1,62 @@
+from django.core.management import BaseCommand
+from django.db import connection
+from django.db.models import Max, Min
+
+from voter.models import NCVoter
+from voter.utils import out, tqdm_or_quiet
+
+
+def backfill_chunk(cursor, first_id, last_id):
+    """Set latest_hash and latest_snapshot_dt from the most recent change of every voter in
+    the given ID range that doesn't have them yet. Returns the number of voters updated.
+    """
+    cursor.execute("""
+        UPDATE voter_ncvoter v
+           SET latest_hash = c.md5_hash, latest_hash_version = c.hash_version, latest_snapshot_dt = c.snapshot_dt
+          FROM (SELECT DISTINCT ON (voter_id) voter_id, md5_hash, hash_version, snapshot_dt
+                  FROM voter_changetracker
+                 WHERE voter_id BETWEEN %s AND %s
+                 ORDER BY voter_id, snapshot_dt DESC, id DESC) c
+         WHERE v.id = c.voter_id AND v.latest_hash IS NULL
+    """, [first_id, last_id])
+    return cursor.rowcount
+
+
+def backfill_latest_hashes(chunk_size, output):
+    tqdm = tqdm_or_quiet(output)
+    bounds = NCVoter.objects.filter(latest_hash__isnull=True).aggregate(Min('id'), Max('id'))
+    if bounds['id__min'] is None:
+        out("All voters already have a latest hash", output)
+        return 0
+
+    updated = 0
+    chunks = range(bounds['id__min'], bounds['id__max'] + 1, chunk_size)
+    # Each chunk is its own statement, and so its own transaction: if interrupted, just run
+    # it again and it carries on with the voters that are still missing a hash.
+    with connection.cursor() as cursor:
+        for first_id in tqdm(chunks):
+            updated += backfill_chunk(cursor, first_id, first_id + chunk_size - 1)
+    out("Backfilled latest hash for {} voters".format(updated), output)
+    return updated
+
+
+class Command(BaseCommand):
+    help = "Set NCVoter.latest_hash and latest_snapshot_dt from the existing change history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            dest='chunk_size',
+            help='Number of voter IDs to update per statement',
+        )
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            help='Do not output updates or progress while running',
+        )
+
+    def handle(self, *args, **options):
+        backfill_latest_hashes(options['chunk_size'], not options.get('quiet'))
@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand
+
+from voter import bitmaps
+from voter.models import DataGeneration
+from voter.utils import out
+
+
+class Command(BaseCommand):
+    help = "Build the files of the bitmap engine for the current data generation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            help='Do not output updates or progress while running',
+        )
+
+    def handle(self, *args, **options):
+        output = not options.get('quiet')
+        generation = DataGeneration.current() or DataGeneration.bump()
+        out("Building bitmaps for data generation {}".format(generation), output)
+        directory = bitmaps.build(generation)
+        if directory:
+            out("Wrote {}".format(directory), output)
+        else:
+            out("Data generation {} was replaced while building, run again".format(generation), output)
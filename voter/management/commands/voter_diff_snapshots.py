@@ -0,0 +1,235 @@
+import heapq
+import io
+import tempfile
+from itertools import groupby, islice
+
+from django.core.management import BaseCommand
+from django.utils.timezone import now
+
+from voter.hashing import row_hash
+from voter.management.commands.voter_process_snapshot import FILE_CODECS, RowSplitter, decode_lines, \
+    get_file_encoding, prepare_row, read_snapshot
+from voter.models import FileTracker
+from voter.utils import out, tqdm_or_quiet
+
+# How many lines of a snapshot file are sorted in memory at a time. Each sorted run is then
+# written to a temporary file, and the runs are merged from disk.
+RUN_SIZE = 200000
+
+ADDED = 'A'
+CHANGED = 'M'
+VANISHED = 'V'
+
+
+def read_records(filename, keep_bad_lines=False, parse=False):
+    """Yield a (ncid, line_no, hash, line) record for every line of a snapshot file, where
+    hash is the current version of the row's hash (see voter.hashing).
+
+    Lines that can't be split into fields or have no NCID are dropped, unless
+    `keep_bad_lines` is set: then they come with an empty NCID and hash, so they sort first.
+    That includes blank lines, such as those in place of the rows left out of a diff. With
+    `parse`, rows that NCVoter.parse_row() fails on come with an empty hash, as processing
+    them never recorded their hash.
+    """
+    codec, bom = FILE_CODECS[get_file_encoding(filename)]
+    header, blocks = read_snapshot(filename, '', codec, bom)
+    splitter = RowSplitter(header)
+    line_no = 0
+    for offset, block in blocks:
+        for line in decode_lines(block, codec):
+            line_no += 1
+            row, warning, error = splitter.split(line)
+            ncid = row.get('ncid') if row else None
+            if ncid:
+                if parse:
+                    hash_val, parsed_row, parse_error = prepare_row(row)
+                    if parse_error:
+                        hash_val = ''
+                else:
+                    hash_val = row_hash(row)
+                yield ncid, line_no, hash_val, line.rstrip('\n')
+            elif keep_bad_lines:
+                yield '', line_no, '', line.rstrip('\n')
+
+
+def write_run(records, tempdir):
+    "Write a sorted list of records to a new file in `tempdir` and return its path."
+    fd, path = tempfile.mkstemp(dir=tempdir, suffix='.run')
+    with open(fd, 'w', encoding='utf-8', newline='\n') as f:
+        for ncid, line_no, hash_val, line in records:
+            f.write('{}\t{}\t{}\t{}\n'.format(ncid, line_no, hash_val, line))
+    return path
+
+
+def read_run(path):
+    "Yield the records written to `path` by write_run(), in order."
+    with open(path, encoding='utf-8', newline='\n') as f:
+        for record in f:
+            ncid, line_no, hash_val, line = record[:-1].split('\t', 3)
+            yield ncid, int(line_no), hash_val, line
+
+
+def sort_records(records, tempdir, run_size=RUN_SIZE):
+    """External sort of `records` by (ncid, line_no): sort them `run_size` at a time, write
+    each sorted run to `tempdir`, and lazily merge the runs. Only one run is ever in memory.
+    """
+    runs = []
+    while True:
+        run = sorted(islice(records, run_size))
+        if not run:
+            break
+        runs.append(write_run(run, tempdir))
+    return heapq.merge(*[read_run(path) for path in runs])
+
+
+def merge_join(old_records, new_records):
+    """Walk two streams of records sorted by NCID side by side, and yield an (ncid, old, new)
+    tuple for every NCID in either of them, where old and new are the lists of records for
+    that NCID in each stream (in file order), and either may be empty.
+    """
+    def by_ncid(records):
+        for ncid, group in groupby(records, key=lambda record: record[0]):
+            yield ncid, list(group)
+
+    old_groups = by_ncid(old_records)
+    new_groups = by_ncid(new_records)
+    old = next(old_groups, None)
+    new = next(new_groups, None)
+    while old or new:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0], old[1], []
+            old = next(old_groups, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0], [], new[1]
+            new = next(new_groups, None)
+        else:
+            yield new[0], old[1], new[1]
+            old = next(old_groups, None)
+            new = next(new_groups, None)
+
+
+def diff_records(old_records, new_records):
+    """Yield (op, ncid, new) for every NCID that was added, changed or vanished between two
+    streams of sorted records, where new is the list of records for that NCID in the new
+    stream (empty for vanished NCIDs). Lines without an NCID are always passed on as added.
+
+    An NCID is unchanged if all its rows in the new file have the same hash as its last row
+    in the old file, as voter_process_snapshot would then skip each of them as already seen.
+    That only holds if the old file was the last one processed for the voter, in full: a
+    change from a later file, or a row of the old file that failed to parse, leaves the
+    voter's latest hash at something else. The latter have an empty hash (see read_records),
+    so their NCIDs always count as changed; the former can't be told from the files.
+    """
+    for ncid, old, new in merge_join(old_records, new_records):
+        if not ncid or not old:
+            yield ADDED, ncid, new
+        elif not new:
+            yield VANISHED, ncid, new
+        elif any(record[2] != old[-1][2] for record in new):
+            yield CHANGED, ncid, new
+
+
+def diff_snapshots(old_filename, new_filename, output_filename, run_size=RUN_SIZE, output=True):
+    """Write the lines of the snapshot file `new_filename` for the voters that were added or
+    changed since the snapshot file `old_filename` to `output_filename`, a snapshot file
+    itself, in the same encoding as the new file. `old_filename` must be the last file
+    processed for its voters (see diff_records). NCIDs only found in the old file are only
+    counted.
+
+    The lines keep their order and their line numbers: each line left out is replaced by a
+    blank line, which processing of a registered diff counts but skips (see register_diff()),
+    so changes and bad lines are recorded with the line numbers of the new file.
+
+    Returns a dict of the number of NCIDs by op (ADDED, CHANGED, VANISHED).
+    """
+    tqdm = tqdm_or_quiet(output)
+    codec, bom = FILE_CODECS[get_file_encoding(new_filename)]
+    header = read_snapshot(new_filename, '', codec, bom)[0]
+    tallies = {ADDED: 0, CHANGED: 0, VANISHED: 0}
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        out("Sorting {}".format(old_filename), output)
+        old_records = sort_records(read_records(old_filename, parse=True), tempdir, run_size)
+        out("Sorting {}".format(new_filename), output)
+        new_records = sort_records(read_records(new_filename, keep_bad_lines=True), tempdir, run_size)
+
+        def kept_records():
+            # With the NCIDs blanked out, the kept lines sort back into file order
+            for op, ncid, new in tqdm(diff_records(old_records, new_records)):
+                tallies[op] += 1
+                for record in new:
+                    yield ('',) + record[1:]
+
+        out("Writing {}".format(output_filename), output)
+        with open(output_filename, 'wb') as raw:
+            raw.write(bom)
+            with io.TextIOWrapper(raw, encoding=codec, newline='\n') as f:
+                f.write('\t'.join(header) + '\n')
+                next_line_no = 1
+                for ncid, line_no, hash_val, line in sort_records(kept_records(), tempdir, run_size):
+                    f.write('\n' * (line_no - next_line_no) + line + '\n')
+                    next_line_no = line_no + 1
+
+    out("Added: {}, changed: {}, vanished: {}".format(tallies[ADDED], tallies[CHANGED], tallies[VANISHED]), output)
+    return tallies
+
+
+def register_diff(new_filename, output_filename):
+    """Create a FileTracker for the diff at `output_filename`, so voter_process_snapshot
+    processes it in place of the new file, skipping the blank lines in place of the rows left out. An unprocessed FileTracker for the new file is
+    cancelled, and its creation date carries over, as it's the snapshot date of the rows.
+    """
+    new_tracker = FileTracker.objects.filter(
+        filename=new_filename, file_status=FileTracker.UNPROCESSED
+    ).order_by('created').last()
+    file_tracker = FileTracker.objects.create(
+        filename=output_filename,
+        etag=new_tracker.etag if new_tracker else '',
+        data_file_kind=FileTracker.DATA_FILE_KIND_NCVOTER,
+        county_num=new_tracker.county_num if new_tracker else None,
+        created=new_tracker.created if new_tracker else now(),
+        file_status=FileTracker.UNPROCESSED,
+        diff=True,
+    )
+    if new_tracker:
+        new_tracker.file_status = FileTracker.CANCELLED
+        new_tracker.save()
+    return file_tracker
+
+
+class Command(BaseCommand):
+    help = "Write the rows of a snapshot file that changed since the previous one to a smaller snapshot file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'old', type=str,
+            help='Previous snapshot file, the last one processed for its voters (a later change to a voter goes unnoticed)',
+        )
+        parser.add_argument('new', type=str, help='Next snapshot file')
+        parser.add_argument('output', type=str, help='Snapshot file to write the added and changed rows to')
+        parser.add_argument(
+            '--run-size',
+            type=int,
+            default=RUN_SIZE,
+            dest='run_size',
+            help='Number of lines to sort in memory at a time',
+        )
+        parser.add_argument(
+            '--register',
+            action='store_true',
+            dest='register',
+            help='Add a FileTracker for the output file, in place of the one for the next snapshot file',
+        )
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            help='Do not output updates or progress while running',
+        )
+
+    def handle(self, *args, **options):
+        output = not options.get('quiet')
+        diff_snapshots(options['old'], options['new'], options['output'], options['run_size'], output)
+        if options.get('register'):
+            register_diff(options['new'], options['output'])
+            out("Registered {} for processing".format(options['output']), output)
@@ -14,6 +14,8 @@ class Command(BaseCommand):
     no arg: fetch latest statewide voter and voter history snapshot.
 
     --bycounty: fetch county files rather than statewide
+    --no-extract: keep the voter zip files, and process the data straight from them
+                  (voter history zip files are still extracted)
     --quiet: do not display any progress updates
     """
 
@@ -33,22 +35,30 @@ class Command(BaseCommand):
             dest='quiet',
             help='Do not output updates or progress while running',
         )
+        parser.add_argument(
+            '--no-extract',
+            action='store_false',
+            dest='extract',
+            help='Keep the downloaded voter zip files as they are, and process the data straight from them',
+        )
 
-    def fetch_state_zips(self, output=False):
-        status_1 = process_new_zip(settings.NCVOTER_LATEST_STATEWIDE_URL, settings.NCVOTER_DOWNLOAD_PATH, "ncvoter", output=output)
-        status_2 = process_new_zip(settings.NCVHIS_LATEST_STATEWIDE_URL, settings.NCVHIS_DOWNLOAD_PATH, "ncvhis", output=output)
+    def fetch_state_zips(self, output=False, extract=True):
+        status_1 = process_new_zip(settings.NCVOTER_LATEST_STATEWIDE_URL, settings.NCVOTER_DOWNLOAD_PATH, "ncvoter",
+                                   output=output, extract=extract)
+        status_2 = process_new_zip(settings.NCVHIS_LATEST_STATEWIDE_URL, settings.NCVHIS_DOWNLOAD_PATH, "ncvhis",
+                                   output=output, extract=extract)
         return status_1, status_2
 
-    def fetch_county_zips(self, output=False):
+    def fetch_county_zips(self, output=False, extract=True):
         statuses = []
         for county_num in range(1, 101):
             ncvoter_zip_url = settings.NCVOTER_LATEST_COUNTY_URL_BASE + str(county_num) + ".zip"
             ncvhis_zip_url = settings.NCVHIS_LATEST_COUNTY_URL_BASE + str(county_num) + ".zip"
             result = process_new_zip(ncvoter_zip_url,
-                                     settings.NCVOTER_DOWNLOAD_PATH, "ncvoter", county_num, output=output)
+                                     settings.NCVOTER_DOWNLOAD_PATH, "ncvoter", county_num, output=output, extract=extract)
             statuses.append(result)
             result = process_new_zip(ncvhis_zip_url,
-                                     settings.NCVHIS_DOWNLOAD_PATH, "ncvhis", county_num, output=output)
+                                     settings.NCVHIS_DOWNLOAD_PATH, "ncvhis", county_num, output=output, extract=extract)
             statuses.append(result)
         return statuses
 
@@ -56,6 +66,6 @@ class Command(BaseCommand):
         output = not options.get('quiet')
         out("Fetching zip files...", output)
         if not options['bycounty']:
-            status_1, status_2 = self.fetch_state_zips(output=output)
+            status_1, status_2 = self.fetch_state_zips(output=output, extract=options['extract'])
         else:
-            self.fetch_county_zips(output=output)
+            self.fetch_county_zips(output=output, extract=options['extract'])
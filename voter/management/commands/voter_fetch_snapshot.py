@@ -44,6 +44,12 @@ class Command(BaseCommand):
             dest='quiet',
             help='Do not output updates or progress while running',
         )
+        parser.add_argument(
+            '--no-extract',
+            action='store_false',
+            dest='extract',
+            help='Keep the downloaded zip files as they are, and process the data straight from them',
+        )
 
     def handle(self, *args, **options):
         output = not options.get('quiet')
@@ -64,7 +70,7 @@ class Command(BaseCommand):
 
             while len(snapshots) > 0:
                 url = snapshots.popleft()
-                process_new_zip(url, settings.NCVOTER_DOWNLOAD_PATH, "ncvoter", output=output)
+                process_new_zip(url, settings.NCVOTER_DOWNLOAD_PATH, "ncvoter", output=output, extract=options['extract'])
             if not options['loop']:
                 break
             else:  # pragma: no cover (infinite loop)
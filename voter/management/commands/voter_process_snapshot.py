@@ -1,24 +1,70 @@
 import logging
 
 from django.core.management import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection, transaction
-
-import hashlib
+from django.db.models import Min, Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+import csv
+import datetime
+import io
+import json
 import os
+import socket
 import sys
 import traceback
-from bencode import bencode
-
-from voter.models import FileTracker, ChangeTracker, NCVoter, BadLineRange, BadLineTracker, NCVoterQueryView
+import zipfile
+from collections import deque, namedtuple
+from itertools import chain, compress
+from concurrent.futures import ProcessPoolExecutor
+from psycopg2.extras import execute_values
+
+from voter.hashing import CURRENT_VERSION, LEGACY_VERSION, row_hash
+from voter.models import FileTracker, ChangeTracker, NCVoter, BadLineRange, BadLineTracker, NCVoterQueryView, \
+    DeferredIndex, FieldChange
 from voter.utils import out, tqdm_or_quiet
 
 logger = logging.getLogger(__name__)
 
 BULK_CREATE_AMOUNT = 500
+STAGING_COPY_AMOUNT = 10000
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+# How long other workers leave a claimed file alone without a heartbeat from its worker
+LEASE_DURATION = datetime.timedelta(minutes=10)
+
+# Tables whose indexes --bulk-load drops while loading, except for primary keys, unique
+# indexes (they enforce constraints), and the indexes the import itself looks rows up by,
+# given by their table and columns
+BULK_LOAD_TABLES = ('voter_ncvoter', 'voter_changetracker', 'voter_ncvoterqueryview', 'voter_fieldchange')
+ESSENTIAL_INDEXES = {
+    ('voter_changetracker', ('voter_id',)),
+    ('voter_changetracker', ('file_tracker_id',)),
+}
+
+# How to decode the raw bytes of each kind of file get_file_encoding() finds: (codec, BOM)
+FILE_CODECS = {
+    'latin1': ('latin1', b''),
+    'utf16': ('utf-16-le', b'\xff\xfe'),
+}
+
+# A place in a snapshot file that reading can start from: the byte offset of the start of a
+# line, the number of lines and of rows (see batched_lines) before it, and the encoding the
+# file is read with. Lines are always whole at such an offset, so there is no other decoder
+# state to keep.
+Checkpoint = namedtuple('Checkpoint', ['offset', 'line_no', 'row_no', 'encoding'])
 
 voter_records = []
+# Modified voters already in the database, by NCID, so a voter changed by several rows in
+# one batch is only written once, with its final data
+update_records = {}
 change_records = []
-processed_ncids = set()
+# Existing voters (by NCID) for the current batch of rows
+batch_voters = {}
+# Already seen voters whose latest_hash was of an older version, by ID, with the row's
+# current version hash to replace it with
+hash_upgrades = {}
 
 added_tally = 0
 modified_tally = 0
@@ -46,39 +92,57 @@ def diff_dicts(x, y, ignored_keys=('age', 'load_dt')):
     return merge_dicts(merge_dicts(new_data, modified_data), deleted_data)
 
 
-def find_md5(row_data, exclude=[]):
-    "Given a dictionary of `row_data` returns the hex of its MD5 hash"
-    row = row_data.copy()
-    for i in exclude:
-        if i in row:
-            del row[i]
-    row_data_str = bencode(row)
-    row_data_b = bytes(row_data_str, 'utf-8')
-    return hashlib.md5(row_data_b).hexdigest()
+def open_snapshot(filename, zip_member=''):
+    """Open a snapshot file for reading its raw bytes. If `zip_member` is given, `filename`
+    is a zip archive, and that member of it is decompressed as it's read, without ever
+    extracting it to disk.
+    """
+    if not zip_member:
+        return open(filename, 'rb')
+    # The member stays readable after the archive itself is closed
+    with zipfile.ZipFile(filename) as archive:
+        return archive.open(zip_member)
+
+
+def snapshot_name(filename, zip_member=''):
+    """The name bad lines of a snapshot file are recorded against: the file itself, or the
+    member's path inside its zip archive, as an archive can hold several data files.
+    """
+    if not zip_member:
+        return filename
+    return os.path.join(filename, zip_member)
+
+
+def get_snapshot_size(filename, zip_member=''):
+    "The (uncompressed) size of a snapshot file, in bytes."
+    if not zip_member:
+        return os.stat(filename).st_size
+    with zipfile.ZipFile(filename) as archive:
+        return archive.getinfo(zip_member).file_size
 
 
-def guess_total_lines(filename):
-    with open(filename, 'rb') as f:
+def guess_total_lines(filename, zip_member=''):
+    with open_snapshot(filename, zip_member) as f:
         chunk = f.read(1024 * 1024)
         newlines_per_meg = chunk.count(b'\n')
-        file_megs = os.stat(filename).st_size / (1024 * 1024)
+        file_megs = get_snapshot_size(filename, zip_member) / (1024 * 1024)
         approx_line_count = file_megs * newlines_per_meg
         return approx_line_count
 
 
-def get_file_encoding(filename):
+def detect_encoding(first_bytes):
     """We know how input data comes in latin1 and UTF-16 varieties, so we just
-    check for a standard UTF-16 BOM to detect which one.
+    check the first bytes of the data for a standard UTF-16 BOM to detect which one.
     """
+    # UTF16 or latin1
+    if first_bytes[:2] == b'\xff\xfe':
+        return 'utf16'
+    return 'latin1'
 
-    with open(filename, 'rb') as f:
-        # UTF16 or latin1
-        f.seek(0)
-        if f.read(2) == b'\xff\xfe':
-            encoding = 'utf16'
-        else:
-            encoding = 'latin1'
-        return encoding
+
+def get_file_encoding(filename, zip_member=''):
+    with open_snapshot(filename, zip_member) as f:
+        return detect_encoding(f.read(2))
 
 
 def clean_and_split_line(line, make_lowercase=False):
@@ -103,82 +167,505 @@ def clean_and_split_line(line, make_lowercase=False):
         return [field.strip('"').strip() if field != '\x00' else '' for field in line]
 
 
-def get_file_lines(filename, output):
+def split_fields(line):
+    """Same as clean_and_split_line(line), only quicker for the two shapes lines of snapshot
+    files come in: no quotes at all, or every field quoted. Anything else goes through
+    clean_and_split_line() itself.
+    """
+    if '"' not in line:
+        if '\x00' in line:
+            return [field.strip() if field != '\x00' else '' for field in line.split('\t')]
+        return list(map(str.strip, line.split('\t')))
+    if '\x00' in line:
+        return clean_and_split_line(line)
+    tabs = line.count('\t')
+    if line[0] == '"' and line.count('"\t"') == tabs:
+        # Splitting on the quotes around each tab unquotes every field but the last one. If
+        # no other field holds a quote, that gives the same fields as strip('"') would.
+        fields = line[1:].split('"\t"')
+        last = fields.pop()
+        if line.count('"') == 2 * tabs + 1 + last.count('"'):
+            fields = list(map(str.strip, fields))
+            fields.append(last.strip('"').strip())
+            return fields
+    return clean_and_split_line(line)
+
+
+class RowSplitter:
+    """Splits the lines of a snapshot file into dicts of their non-empty fields, keyed by the
+    field names in the file's `header`.
+
+    Lines with an extra cell or three are repaired by dropping cell 45 (or cells 45-47). The
+    slices to do so are worked out once per file, as is everything else about the header.
+
+    With `placeholders`, for files written by voter_diff_snapshots, blank lines hold the place
+    of the rows left out of the diff, so that the rows after them keep their line numbers.
+    """
+
+    def __init__(self, header, placeholders=False):
+        self.header = header
+        self.placeholders = placeholders
+        self.width = len(header)
+        self.repairs = {
+            self.width + 1: (
+                slice(None, 45), slice(46, None),
+                "Line has an extra 1 cell than the headers we have. (removing 45)",
+            ),
+            self.width + 3: (
+                slice(None, 45), slice(48, None),
+                "Line has an extra 3 cells than the headers we have. (removing 45-47)",
+            ),
+        }
+
+    def split(self, line):
+        """Returns a (row, warning, error) tuple. Repaired lines come back with a warning.
+        Lines we can't make sense of come back with an error and no row. With placeholders,
+        blank lines come back with neither.
+        """
+        if self.placeholders and not line.strip('\r\n'):
+            return None, None, None
+        fields = split_fields(line)
+        warning = None
+
+        if len(fields) != self.width:
+            if len(fields) in self.repairs:
+                head, tail, warning = self.repairs[len(fields)]
+                fields = fields[head] + fields[tail]
+            elif len(fields) > self.width:
+                return None, None, "More cells in this line than we know what to do with."
+            else:
+                return None, None, "Less cells in this line than we need."
+
+        return dict(compress(zip(self.header, fields), fields)), warning, None
+
+
+def get_file_lines(filename, output, zip_member='', start=None, checkpoints=None, placeholders=False):
+    """Yields a (counted, line, row) tuple for every line of the snapshot file that could be
+    split into a row, or that holds the place of one, with a row of None (see RowSplitter, which
+    `placeholders` is passed to). Lines that couldn't are recorded as bad lines instead.
+
+    Reading starts at the `start` Checkpoint if given. If `checkpoints` is given, the
+    Checkpoint at the start of each block of lines is appended to it as the block is read.
+    """
     tqdm = tqdm_or_quiet(output)
 
     # guess the number of lines and encoding
-    approx_line_count = guess_total_lines(filename)
-    encoding = get_file_encoding(filename)
+    approx_line_count = guess_total_lines(filename, zip_member)
+    encoding = get_file_encoding(filename, zip_member)
+    codec, bom = FILE_CODECS[encoding]
+
+    bad_lines = BadLineTracker(snapshot_name(filename, zip_member))
+
+    counted = start.line_no if start else 0
+    rows = start.row_no if start else 0
+
+    header, blocks = read_snapshot(filename, zip_member, codec, bom, start.offset if start else 0)
+    splitter = RowSplitter(header, placeholders)
+    progress = tqdm(total=approx_line_count, initial=counted) if output else None
+
+    for offset, block in blocks:
+        if checkpoints is not None:
+            # Lines before a checkpoint are never read again, so record their bad lines now
+            bad_lines.flush()
+            checkpoints.append(Checkpoint(offset, counted, rows, encoding))
+        block_start = counted
 
-    f = open(filename, encoding=encoding)
-    lines = iter(f)
-    header = next(lines)
-    header = clean_and_split_line(header, make_lowercase=True)
+        for line in decode_lines(block, codec):
+            counted += 1
+            non_empty_row, warning, error = splitter.split(line)
 
-    bad_lines = BadLineTracker(filename)
+            if error:
+                bad_lines.error(counted, line, error)
+                continue
+            if warning:
+                bad_lines.warning(counted, line, warning)
+
+            rows += 1
+            yield counted, line, non_empty_row
 
-    counted = 0
+        if progress:  # pragma: no cover
+            progress.update(counted - block_start)
+    if progress:  # pragma: no cover
+        progress.close()
 
-    for row in tqdm(lines, initial=counted, total=approx_line_count):
-        counted += 1
-        line = clean_and_split_line(row)
+    bad_lines.flush()
+    out("Decoded {} lines from {}".format(counted, filename), output)
 
-        if len(line) == len(header):
-            non_empty_row = {header[i]: line[i].strip() for i in range(len(header)) if not line[i].strip() == ''}
 
-        elif len(line) == len(header) + 1:
-            bad_lines.warning(counted, row, "Line has an extra 1 cell than the headers we have. (removing 45)")
-            del line[45]
-            non_empty_row = {header[i]: line[i].strip() for i in range(len(header)) if not line[i].strip() == ''}
+def find_newline(data, newline, last=False):
+    """Return the offset just past the first (or last) `newline` in `data`, or -1 if there is
+    none. For UTF-16, only newlines starting on a code unit boundary count.
+    """
+    width = len(newline)
+    if last:
+        idx = data.rfind(newline)
+        while idx >= 0 and idx % width:
+            idx = data.rfind(newline, 0, idx + width - 1)
+    else:
+        idx = data.find(newline)
+        while idx >= 0 and idx % width:
+            idx = data.find(newline, idx + 1)
+    return idx + width if idx >= 0 else -1
 
-        elif len(line) == len(header) + 3:
-            bad_lines.warning(counted, row, "Line has an extra 3 cells than the headers we have. (removing 45-47)")
-            x = set([45, 46, 47])
-            line = [line[i] for i in range(len(line)) if i not in x]
-            non_empty_row = {header[i]: line[i].strip() for i in range(len(header)) if not line[i].strip() == ''}
 
-        elif len(line) > len(header):
-            bad_lines.error(counted, row, "More cells in this line than we know what to do with.")
+def read_line_blocks(f, newline):
+    """Read the binary stream `f` in blocks of about READ_BLOCK_SIZE bytes, each of them ending
+    just after a newline, so that every block holds only whole lines.
+    """
+    remainder = b''
+    while True:
+        data = f.read(READ_BLOCK_SIZE)
+        if not data:
+            break
+        data = remainder + data
+        end = find_newline(data, newline, last=True)
+        if end < 0:
+            remainder = data
             continue
+        yield data[:end]
+        remainder = data[end:]
+    if remainder:
+        yield remainder
+
+
+def read_snapshot_blocks(filename, zip_member, codec, bom, offset=0):
+    """Yield (offset, block) pairs, where the blocks of whole lines (see read_line_blocks)
+    are read from the snapshot file starting at byte `offset` (or just past the BOM), and
+    offset is where each of them starts in the file.
 
+    Streams that can't seek, such as zip members, are read and thrown away up to `offset`.
+    """
+    offset = max(offset, len(bom))
+    with open_snapshot(filename, zip_member) as f:
+        if f.seekable():
+            f.seek(offset)
         else:
-            bad_lines.error(counted, row, "Less cells in this line than we need.")
-            continue
+            remaining = offset
+            while remaining > 0:
+                data = f.read(min(remaining, READ_BLOCK_SIZE))
+                if not data:
+                    break
+                remaining -= len(data)
+        for block in read_line_blocks(f, '\n'.encode(codec)):
+            yield offset, block
+            offset += len(block)
+
+
+def read_snapshot(filename, zip_member, codec, bom, offset=0):
+    """Read the header line of the snapshot file.
+
+    Returns the header fields, and an iterator of (offset, block) pairs (see
+    read_snapshot_blocks) for the lines after the header, or after `offset` if given.
+    """
+    newline = '\n'.encode(codec)
+    blocks = read_snapshot_blocks(filename, zip_member, codec, bom)
+    first_offset, first_block = next(blocks, (len(bom), b''))
+    header_end = find_newline(first_block, newline)
+    if header_end < 0:
+        header_end = len(first_block)
+    header = clean_and_split_line(first_block[:header_end].decode(codec), make_lowercase=True)
 
-        yield counted, row, non_empty_row
+    if offset:
+        blocks.close()
+        return header, read_snapshot_blocks(filename, zip_member, codec, bom, offset)
+    if header_end < len(first_block):
+        blocks = chain([(first_offset + header_end, first_block[header_end:])], blocks)
+    return header, blocks
+
+
+def decode_lines(block, codec):
+    "Decode a block of whole lines, splitting them just like a file opened in text mode would."
+    return io.StringIO(block.decode(codec), newline=None)
+
+
+def prepare_row(row):
+    """Do the per-row work that doesn't need the database: hash the row and parse it.
+
+    Returns a (hash_val, parsed_row, parse_error) tuple, where parse_error is the traceback
+    if NCVoter.parse_row failed.
+    """
+    hash_val = row_hash(row)
+    try:
+        parsed_row = NCVoter.parse_row(row)
+    except Exception:
+        return hash_val, None, ''.join(traceback.format_exception(*sys.exc_info()))
+    return hash_val, parsed_row, None
+
+
+def prepare_block(block, codec, header, placeholders=False):
+    """Runs in a worker process: decode, split, clean, parse and hash every line of `block`.
+
+    Returns a list of (line, row, warning, error, prepared) tuples, in file order.
+    """
+    splitter = RowSplitter(header, placeholders)
+    results = []
+    for line in decode_lines(block, codec):
+        row, warning, error = splitter.split(line)
+        prepared = prepare_row(row) if row is not None else None
+        results.append((line, row, warning, error, prepared))
+    return results
+
+
+def get_prepared_lines(filename, output, workers=1, zip_member='', start=None, checkpoints=None, placeholders=False):
+    """Like get_file_lines(), but yields (counted, line, row, prepared) tuples, where prepared
+    is the result of prepare_row() for the row, or None if it still has to be done.
+
+    With more than one worker, the file is cut into blocks of whole lines that are decoded,
+    cleaned, parsed and hashed in a pool of processes. Blocks are handed back in file order,
+    so line numbers are the same as when reading the file in a single process. Only a few
+    blocks per worker are in flight at once, so a slow consumer doesn't fill up memory.
+    """
+    if workers <= 1:
+        for counted, line, row in get_file_lines(filename, output, zip_member, start, checkpoints, placeholders):
+            yield counted, line, row, None
+        return
+
+    tqdm = tqdm_or_quiet(output)
+    approx_line_count = guess_total_lines(filename, zip_member)
+    encoding = get_file_encoding(filename, zip_member)
+    codec, bom = FILE_CODECS[encoding]
+
+    bad_lines = BadLineTracker(snapshot_name(filename, zip_member))
+    counted = start.line_no if start else 0
+    rows = start.row_no if start else 0
+
+    header, blocks = read_snapshot(filename, zip_member, codec, bom, start.offset if start else 0)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        progress = tqdm(total=approx_line_count, initial=counted) if output else None
+        while True:
+            # Keep the pool busy while we hand back the oldest block
+            for offset, block in blocks:
+                pending.append((offset, executor.submit(prepare_block, block, codec, header, placeholders)))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            offset, future = pending.popleft()
+            results = future.result()
+            if progress:  # pragma: no cover
+                progress.update(len(results))
+            if checkpoints is not None:
+                bad_lines.flush()
+                checkpoints.append(Checkpoint(offset, counted, rows, encoding))
+
+            for line, row, warning, error, prepared in results:
+                counted += 1
+                if error:
+                    bad_lines.error(counted, line, error)
+                    continue
+                if warning:
+                    bad_lines.warning(counted, line, warning)
+                rows += 1
+                yield counted, line, row, prepared
+        if progress:  # pragma: no cover
+            progress.close()
 
     bad_lines.flush()
     out("Decoded {} lines from {}".format(counted, filename), output)
 
 
-def find_existing_instance(ncid):
-    """Given an NCID find an existing NCVoter instance for that voter.
+def batched_lines(lines, last_line=0, row_no=0):
+    """Number the rows from get_prepared_lines() (counting on from `row_no`, if they don't
+    start at the top of the file), drop the ones at or before `last_line`, as well as the
+    placeholders for rows left out, and group the rest into lists of (line_no, line, row,
+    prepared) of up to BULK_CREATE_AMOUNT rows.
+    """
+    batch = []
+    line_no = row_no
+    for index, line, row, prepared in lines:
+        line_no += 1
+        if line_no <= last_line or row is None:
+            continue
+        batch.append((line_no, line, row, prepared))
+        if len(batch) >= BULK_CREATE_AMOUNT:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch_batch(rows):
+    """Look up the existing voters for a batch of rows with one query. Replaces whatever the
+    previous batch had looked up, so memory stays bounded by the batch size.
+
+    Voters without a latest_hash (see voter_backfill_latest_hash) get the hash of their latest
+    change filled in from their changelog, with one more query, so that rows are compared
+    with the latest change of every voter alike. It isn't saved, unless the voter changes.
+    """
+    batch_voters.clear()
+
+    ncids = {row['ncid'] for row in rows if row.get('ncid')}
+    if not ncids:
+        return
+    batch_voters.update((voter.ncid, voter) for voter in NCVoter.objects.filter(ncid__in=ncids))
+
+    missing = {voter.id: voter for voter in batch_voters.values() if voter.latest_hash is None}
+    if not missing:
+        return
+    latest_changes = ChangeTracker.objects.filter(voter_id__in=missing)\
+        .order_by('voter_id', '-snapshot_dt', '-id')\
+        .distinct('voter_id')\
+        .values_list('voter_id', 'md5_hash', 'hash_version')
+    for voter_id, md5_hash, hash_version in latest_changes:
+        missing[voter_id].latest_hash = md5_hash
+        missing[voter_id].latest_hash_version = hash_version
+
+
+def worker_name():
+    "How this process is known in FileTracker.claimed_by."
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_file(worker, lease=LEASE_DURATION, resume=False, exclude=()):
+    """Claim the next NCVoter file to process for `worker`, and return it, or None if there's
+    nothing left to claim. Several workers can claim files at the same time: the rows being
+    claimed are locked, and other workers skip over them. Files whose IDs are in `exclude`
+    are never claimed.
+
+    Files waiting to be processed are the unprocessed ones, those whose worker hasn't renewed
+    its lease in time and, with `resume`, any in progress. Files of one county must be
+    processed in the order they were created, so only the first file of each county that's
+    not processed yet can be claimed. Files with no county (the statewide ones) are in
+    order among themselves.
+    """
+    pending = FileTracker.objects.filter(
+        data_file_kind=FileTracker.DATA_FILE_KIND_NCVOTER,
+        file_status__in=[FileTracker.UNPROCESSED, FileTracker.PROCESSING],
+    )
+    next_in_county = Q(pk__in=[])
+    for first in pending.order_by().values('county_num').annotate(created=Min('created')):
+        if first['county_num'] is None:
+            next_in_county |= Q(county_num__isnull=True, created=first['created'])
+        else:
+            next_in_county |= Q(county_num=first['county_num'], created=first['created'])
 
-    Will prefetch all ChangeTracker instances related."""
+    waiting = Q(file_status=FileTracker.UNPROCESSED) | Q(
+        file_status=FileTracker.PROCESSING, lease_expires__lt=timezone.now()
+    )
+    if resume:
+        waiting |= Q(file_status=FileTracker.PROCESSING)
 
-    return NCVoter.objects.filter(ncid=ncid).prefetch_related('changelog').first()
+    with transaction.atomic():
+        file_tracker = pending.filter(waiting, next_in_county).exclude(pk__in=exclude).select_for_update(
+            skip_locked=True
+        ).order_by('created', 'id').first()
+        if file_tracker:
+            file_tracker.file_status = FileTracker.PROCESSING
+            file_tracker.claimed_by = worker
+            file_tracker.heartbeat = timezone.now()
+            file_tracker.lease_expires = file_tracker.heartbeat + lease
+            file_tracker.save(update_fields=['file_status', 'claimed_by', 'heartbeat', 'lease_expires'])
+    return file_tracker
+
+
+def renew_lease(file_tracker, force=False):
+    """Let other workers know we're still processing `file_tracker`, by pushing back the
+    end of its lease by as long as it was claimed for. Only every tenth of that, to save on
+    writes, unless `force` is set.
+
+    Raises an exception if another worker has taken over the file, as happens if we go
+    without a heartbeat for longer than the lease.
+    """
+    if not file_tracker.heartbeat or not file_tracker.lease_expires:
+        return
+    lease = file_tracker.lease_expires - file_tracker.heartbeat
+    heartbeat = timezone.now()
+    if not force and heartbeat - file_tracker.heartbeat < lease / 10:
+        return
+    renewed = FileTracker.objects.filter(pk=file_tracker.pk, claimed_by=file_tracker.claimed_by).update(
+        heartbeat=heartbeat, lease_expires=heartbeat + lease,
+    )
+    if not renewed:
+        raise Exception("{} was claimed by another worker".format(file_tracker.filename))
+    file_tracker.heartbeat = heartbeat
+    file_tracker.lease_expires = heartbeat + lease
 
 
-@transaction.atomic
-def lock_file(file_tracker):
-    file_tracker.file_status = FileTracker.PROCESSING
-    file_tracker.save()
+def hold_file(file_tracker):
+    """Lock the row of `file_tracker` until the end of the current transaction, so that no
+    other worker can claim the file in the meantime (claim_file skips locked rows), however
+    long the transaction takes.
+
+    Raises an exception if another worker has already taken over the file.
+    """
+    held = FileTracker.objects.select_for_update().filter(pk=file_tracker.pk, claimed_by=file_tracker.claimed_by)
+    if not held.exists():
+        raise Exception("{} was claimed by another worker".format(file_tracker.filename))
+
+
+def finish_file(file_tracker):
+    """Mark `file_tracker` as processed, unless another worker has taken it over, in which
+    case an exception is raised.
+    """
+    finished = FileTracker.objects.filter(pk=file_tracker.pk, claimed_by=file_tracker.claimed_by).update(
+        file_status=FileTracker.PROCESSED,
+    )
+    if not finished:
+        raise Exception("{} was claimed by another worker".format(file_tracker.filename))
+    file_tracker.file_status = FileTracker.PROCESSED
 
 
 @transaction.atomic
 def reset_file(file_tracker):
-    file_tracker.file_status = FileTracker.UNPROCESSED
-    file_tracker.save()
+    """Hand a file we failed to process back to be claimed again, unless another worker has
+    taken it over in the meantime.
+    """
+    FileTracker.objects.filter(pk=file_tracker.pk, claimed_by=file_tracker.claimed_by).update(
+        file_status=FileTracker.UNPROCESSED, claimed_by='', lease_expires=None,
+    )
+
+
+def bulk_update_voters(voters):
+    """Write the data and latest hash of modified voters with a single UPDATE joined against
+    a VALUES list, instead of one save() per voter.
+    """
+    with connection.cursor() as cursor:
+        execute_values(cursor, """
+            UPDATE voter_ncvoter v
+               SET data = u.data::jsonb, latest_hash = u.latest_hash,
+                   latest_hash_version = u.latest_hash_version, latest_snapshot_dt = u.latest_snapshot_dt
+              FROM (VALUES %s) AS u (id, data, latest_hash, latest_hash_version, latest_snapshot_dt)
+             WHERE v.id = u.id
+        """, [
+            (voter.pk, json.dumps(voter.data, cls=DjangoJSONEncoder), voter.latest_hash, voter.latest_hash_version,
+             voter.latest_snapshot_dt)
+            for voter in voters
+        ], page_size=BULK_CREATE_AMOUNT)
+
+
+def bulk_upgrade_hashes(upgrades):
+    """Replace the latest hashes of already seen voters, made by an older version of the
+    hashing, with their current version, given as a dict of voter ID to hash. That way
+    the row only has to be hashed once the next time it's seen.
+    """
+    with connection.cursor() as cursor:
+        execute_values(cursor, """
+            UPDATE voter_ncvoter v
+               SET latest_hash = u.latest_hash, latest_hash_version = u.latest_hash_version
+              FROM (VALUES %s) AS u (id, latest_hash, latest_hash_version)
+             WHERE v.id = u.id
+        """, [
+            (voter_id, latest_hash, CURRENT_VERSION) for voter_id, latest_hash in upgrades.items()
+        ], page_size=BULK_CREATE_AMOUNT)
 
 
 def flush():
-    """Bulk insert pending NCVoter and ChangeTracker rows. Also, clear all such
-    buffer lists.
+    """Bulk insert pending NCVoter, ChangeTracker and FieldChange rows, bulk update modified
+    NCVoter rows (and the hashes of upgraded ones) and sync their NCVoterQueryView rows, all
+    in one transaction. Also, clear all such buffer lists.
     """
     with transaction.atomic():
         if voter_records:
             NCVoter.objects.bulk_create(voter_records)
-    with transaction.atomic():
+        if update_records:
+            bulk_update_voters(update_records.values())
+        if hash_upgrades:
+            bulk_upgrade_hashes(hash_upgrades)
+        NCVoterQueryView.sync(
+            [voter.id for voter in voter_records] + [voter.id for voter in update_records.values()]
+        )
         # This looks weird. Let me explain.
         # All the unsaved ChangeTracker instances have references
         # to the NCVoter instances from *before* the NCVoter instances
@@ -190,8 +677,16 @@ def flush():
             c.voter = c.voter
             c.voter_id = c.voter.id
         ChangeTracker.objects.bulk_create(change_records)
+        # Now that the changes have IDs, index the fields they modified
+        FieldChange.objects.bulk_create(
+            [field_change for c in change_records if c.op_code == ChangeTracker.OP_CODE_MODIFY
+             for field_change in FieldChange.for_change(c, c.previous_data)],
+            batch_size=BULK_CREATE_AMOUNT,
+        )
     change_records.clear()
     voter_records.clear()
+    update_records.clear()
+    hash_upgrades.clear()
 
 
 def reset():
@@ -202,7 +697,9 @@ def reset():
 
     change_records.clear()
     voter_records.clear()
-    processed_ncids.clear()
+    update_records.clear()
+    batch_voters.clear()
+    hash_upgrades.clear()
 
     added_tally = 0
     already_seen_tally = 0
@@ -210,37 +707,59 @@ def reset():
     skip_tally = 0
 
 
-def skip_or_voter(row):
+def is_already_seen(voter_instance, row, hash_val):
+    """Does `row`, whose current version hash is `hash_val`, match the latest change
+    recorded for this voter?
+
+    A latest_hash made by an older version of the hashing is compared with the row hashed
+    the same way, and if they match, queued to be replaced by `hash_val` (see flush). Going
+    back to the data of an older change is a change too. Voters whose latest_hash hasn't been
+    backfilled yet have it filled in by prefetch_batch; those without any change never match.
+    """
+    if voter_instance.latest_hash is None:
+        return False
+    if voter_instance.latest_hash_version == CURRENT_VERSION:
+        return voter_instance.latest_hash == hash_val
+    if voter_instance.latest_hash != row_hash(row, voter_instance.latest_hash_version):
+        return False
+    voter_instance.latest_hash = hash_val
+    voter_instance.latest_hash_version = CURRENT_VERSION
+    hash_upgrades[voter_instance.pk] = hash_val
+    return True
+
+
+def skip_or_voter(row, hash_val=None):
     global skip_tally
     global already_seen_tally
 
-    # If we see a repeat, flushed queued data before continuing
-    # This prevents the same voter from appearing twice in a single bulk insert
+    # A voter seen earlier in this batch comes back with that row's changes already
+    # applied, even if they're not flushed yet
     ncid = row.get('ncid')
-    if ncid in processed_ncids:
-        flush()
-    voter_instance = find_existing_instance(ncid)
+    voter_instance = batch_voters.get(ncid)
 
     # Skip rows that have no NCID in them :-(
     if not ncid:
         skip_tally += 1
         raise ValueError("No NCID found in data")
 
-    # Generate a hash value for the change set and skip this one if it matches
-    # an existing change already recorded
-    hash_val = find_md5(row, exclude=['snapshot_dt'])
-    if voter_instance and voter_instance.changelog.filter(md5_hash=hash_val).exists():
+    # Generate a hash value for the change set (unless a worker already did) and skip
+    # this one if it matches the latest change already recorded
+    if hash_val is None:
+        hash_val = row_hash(row)
+    if voter_instance and is_already_seen(voter_instance, row, hash_val):
         already_seen_tally += 1
         return None, None
 
     return ncid, voter_instance
 
 
-def prepare_change(file_tracker, row, voter_instance, line_no):
-    parsed_row = NCVoter.parse_row(row)
+def prepare_change(file_tracker, row, voter_instance, line_no, parsed_row=None, hash_val=None):
+    if parsed_row is None:
+        parsed_row = NCVoter.parse_row(row)
     # get snapshot_dt from the data (if available), else from the file tracker creation timestamp
     snapshot_dt = parsed_row.pop('snapshot_dt', None) or file_tracker.created
-    hash_val = find_md5(row, exclude=['snapshot_dt'])
+    if hash_val is None:
+        hash_val = row_hash(row)
 
     # If there was no voter instance, this is an ADD otherwise a MODIFY
     # For modifying we only record a diff of data, otherwise all of it
@@ -251,22 +770,31 @@ def prepare_change(file_tracker, row, voter_instance, line_no):
             existing_data = voter_instance.build_current()
         change_tracker_data = diff_dicts(existing_data, parsed_row)
         voter_instance.data = parsed_row
-        voter_instance.save()
+        voter_instance.latest_hash = hash_val
+        voter_instance.latest_hash_version = CURRENT_VERSION
+        voter_instance.latest_snapshot_dt = snapshot_dt
     else:
         change_tracker_op_code = ChangeTracker.OP_CODE_ADD
         change_tracker_data = parsed_row
         voter_instance = NCVoter.from_row(parsed_row)
+        voter_instance.latest_hash = hash_val
+        voter_instance.latest_hash_version = CURRENT_VERSION
+        voter_instance.latest_snapshot_dt = snapshot_dt
 
     # Queue the change up to be bulk inserted later
     change = ChangeTracker(
         voter=voter_instance,
         md5_hash=hash_val,
+        hash_version=CURRENT_VERSION,
         snapshot_dt=snapshot_dt,
         file_tracker=file_tracker,
         file_lineno=line_no,
         op_code=change_tracker_op_code,
         data=change_tracker_data,
     )
+    if change_tracker_op_code == ChangeTracker.OP_CODE_MODIFY:
+        # Kept for the FieldChange rows that flush() writes
+        change.previous_data = existing_data
 
     return change
 
@@ -275,16 +803,76 @@ def record_change(change):
     global added_tally
     global modified_tally
 
-    if change.voter.pk:
-        modified_tally += 1
-    else:
+    if change.op_code == ChangeTracker.OP_CODE_ADD:
         added_tally += 1
         voter_records.append(change.voter)
+    else:
+        modified_tally += 1
+        # A voter added earlier in this batch isn't in the database yet. It's still queued
+        # for insert, and is inserted with the data of its latest change.
+        if change.voter.pk:
+            update_records[change.voter.ncid] = change.voter
     change_records.append(change)
-    processed_ncids.add(change.voter.ncid)
+    # Later rows for this voter in the same batch must see this change
+    batch_voters[change.voter.ncid] = change.voter
+
+
+def find_last_line(file_tracker):
+    """Return the last line number of `file_tracker` that was already recorded, either as
+    a change or as a bad line, so that an interrupted import can pick up after it.
+    """
+    prev_line = ChangeTracker.objects.filter(file_tracker=file_tracker).order_by('file_lineno').last()
+    prev_error = BadLineRange.objects.filter(
+        filename=snapshot_name(file_tracker.filename, file_tracker.zip_member)
+    ).order_by('last_line_no').last()
+
+    last_line = 0
+    if prev_line:
+        last_line = prev_line.file_lineno
+    if prev_error:
+        last_line = max(last_line, prev_error.last_line_no)
+    return last_line
+
+
+def get_checkpoint(file_tracker):
+    """The Checkpoint saved by an earlier, interrupted import of this file, if any. One saved
+    while reading the file with another encoding is for some other file by the same name, so
+    it's ignored.
+    """
+    if not file_tracker.checkpoint_offset:
+        return None
+    if file_tracker.checkpoint_encoding != get_file_encoding(file_tracker.filename, file_tracker.zip_member):
+        return None
+    return Checkpoint(
+        file_tracker.checkpoint_offset,
+        file_tracker.checkpoint_line_no,
+        file_tracker.checkpoint_row_no,
+        file_tracker.checkpoint_encoding,
+    )
+
+
+def save_checkpoint(file_tracker, checkpoints, line_no, bad_lines):
+    """Called once everything about the rows up to `line_no` is committed. Saves the last of
+    `checkpoints` (as collected by get_prepared_lines) that has only such rows before it,
+    and forgets about the ones before that.
+    """
+    checkpoint = None
+    while checkpoints and checkpoints[0].row_no <= line_no:
+        checkpoint = checkpoints.popleft()
+    if checkpoint is None:
+        return
+
+    bad_lines.flush()
+    file_tracker.checkpoint_offset = checkpoint.offset
+    file_tracker.checkpoint_line_no = checkpoint.line_no
+    file_tracker.checkpoint_row_no = checkpoint.row_no
+    file_tracker.checkpoint_encoding = checkpoint.encoding
+    file_tracker.save(update_fields=[
+        'checkpoint_offset', 'checkpoint_line_no', 'checkpoint_row_no', 'checkpoint_encoding',
+    ])
 
 
-def track_changes(file_tracker, output):
+def track_changes(file_tracker, output, workers=1):
     global added_tally
     global modified_tally
     global already_seen_tally
@@ -294,55 +882,66 @@ def track_changes(file_tracker, output):
 
     out("Tracking changes for file {0}".format(file_tracker.filename), output)
 
-    # Have we seen any lines, successful or failures, from this before?
-    prev_line = ChangeTracker.objects.filter(file_tracker=file_tracker).order_by('file_lineno').last()
-    prev_error = BadLineRange.objects.filter(filename=file_tracker.filename).order_by('last_line_no').last()
-
-    last_line = 0
-    if prev_line:
-        last_line = prev_line.file_lineno
-    if prev_error:
-        last_line = max(last_line, prev_error.last_line_no)
-
-    lines = get_file_lines(file_tracker.filename, output)
-    bad_lines = BadLineTracker(file_tracker.filename)
+    last_line = find_last_line(file_tracker)
+    # Pick up reading where an interrupted import left off, instead of reading the whole
+    # file again only to skip what's before `last_line`
+    start = get_checkpoint(file_tracker)
+    checkpoints = deque()
 
-    for index, line, row in lines:
-        line_no += 1
-        if line_no <= last_line:
-            continue
+    lines = get_prepared_lines(
+        file_tracker.filename, output, workers, file_tracker.zip_member, start, checkpoints, file_tracker.diff
+    )
+    bad_lines = BadLineTracker(snapshot_name(file_tracker.filename, file_tracker.zip_member))
 
-        try:
-            ncid, voter_instance = skip_or_voter(row)
-            if not ncid:
+    for batch in batched_lines(lines, last_line, start.row_no if start else 0):
+        # Queued changes must be in the database before we look up the next batch's voters
+        if change_records or hash_upgrades:
+            flush()
+            save_checkpoint(file_tracker, checkpoints, line_no, bad_lines)
+        # Even if the batch before had nothing to record, we're still working on the file
+        renew_lease(file_tracker)
+        prefetch_batch([row for line_no, line, row, prepared in batch])
+
+        for line_no, line, row, prepared in batch:
+            # With several workers, rows come already hashed and parsed. Either way, the
+            # hash is only computed once and handed to everything that needs it.
+            hash_val, parsed_row, parse_error = prepared or (row_hash(row), None, None)
+            try:
+                ncid, voter_instance = skip_or_voter(row, hash_val)
+                if not ncid:
+                    continue
+            except ValueError as e:
+                bad_lines.error(line_no, line, str(e))
                 continue
-        except ValueError as e:
-            bad_lines.error(line_no, line, str(e))
-            continue
 
-        # We're done skipping for various reasons, so lets move on to actually recording
-        # new data. We start by parsing the the row data.
-        try:
-            change = prepare_change(file_tracker, row, voter_instance, line_no)  # ChangeTracker
-        except Exception:
-            tb = ''.join(traceback.format_exception(*sys.exc_info()))
-            bad_lines.error(line_no, line, tb)
-        else:
-            record_change(change)
+            if parse_error:
+                bad_lines.error(line_no, line, parse_error)
+                continue
 
-        # When the number of queued chanegs hits a threshold, we insert them all in bulk
-        if len(change_records) >= BULK_CREATE_AMOUNT:
-            flush()
+            # We're done skipping for various reasons, so lets move on to actually recording
+            # new data. We start by parsing the the row data.
+            try:
+                change = prepare_change(file_tracker, row, voter_instance, line_no, parsed_row, hash_val)  # ChangeTracker
+            except Exception:
+                tb = ''.join(traceback.format_exception(*sys.exc_info()))
+                bad_lines.error(line_no, line, tb)
+            else:
+                record_change(change)
+
+            # When the number of queued chanegs hits a threshold, we insert them all in bulk
+            if len(change_records) >= BULK_CREATE_AMOUNT:
+                flush()
+                save_checkpoint(file_tracker, checkpoints, line_no, bad_lines)
+                renew_lease(file_tracker)
 
     # Any left over records to flush that didn't hit the bulk amount?
-    if change_records:
+    if change_records or hash_upgrades:
         flush()
 
     bad_lines.flush()
 
     # Mark the file as processed, we're done with it
-    file_tracker.file_status = FileTracker.PROCESSED
-    file_tracker.save()
+    finish_file(file_tracker)
 
     # TODO: Add a way to skip this, if we want to re-run for testing without re-downloading
     # remove_files(file_tracker)
@@ -350,27 +949,311 @@ def track_changes(file_tracker, output):
     return (added_tally, modified_tally, already_seen_tally, skip_tally)
 
 
-def process_files(**options):
-    output = not options.get('quiet')
-    out("Processing NCVoter file...", output)
+def staging_table_name(file_tracker):
+    "Each file gets its own staging table, so concurrent imports never share one."
+    return 'voter_staging_{}'.format(file_tracker.id)
+
+
+def create_staging_table(cursor, table):
+    """(Re)create the UNLOGGED table that one snapshot file is streamed into.
+
+    Nothing in here needs to survive a crash (we just start the file over), so we skip
+    the write-ahead log entirely.
+    """
+    cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
+    cursor.execute("""
+        CREATE UNLOGGED TABLE {0} (
+            file_lineno integer PRIMARY KEY,
+            ncid text NOT NULL,
+            md5_hash varchar(32) NOT NULL,
+            legacy_hash varchar(32),
+            snapshot_dt timestamp with time zone NOT NULL,
+            data jsonb,
+            line text,
+            error text,
+            generation integer,
+            op char(1),
+            voter_id integer,
+            change_data jsonb,
+            change_id integer
+        )
+    """.format(table))
+
+
+def copy_staged_rows(cursor, table, rows):
+    """Stream a list of staged rows into `table` with a single COPY FROM STDIN."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows(rows)
+    buf.seek(0)
+    cursor.copy_expert(
+        "COPY {0} (file_lineno, ncid, md5_hash, legacy_hash, snapshot_dt, data, line, error) "
+        "FROM STDIN WITH (FORMAT csv)".format(table),
+        buf,
+    )
+
+
+def stage_file(cursor, table, file_tracker, last_line, output, workers=1, legacy=False, start=None):
+    """Decode, parse and hash every line of the file (after `last_line`, reading from the
+    `start` Checkpoint if given) and COPY it into the staging table. Lines we can't parse are staged with their error, because they only
+    count as bad lines if they turn out not to be already seen.
+
+    Rows are also hashed the legacy way if `legacy` is set, for comparing with voters whose
+    hashes are from before versioned hashing.
+
+    Returns the number of lines read and the number of lines skipped for having no NCID.
+    """
+    skipped = 0
+    line_no = start.row_no if start else 0
+    pending = []
+    bad_lines = BadLineTracker(snapshot_name(file_tracker.filename, file_tracker.zip_member))
+
+    lines = get_prepared_lines(
+        file_tracker.filename, output, workers, file_tracker.zip_member, start, placeholders=file_tracker.diff
+    )
+    for index, line, row, prepared in lines:
+        line_no += 1
+        if line_no <= last_line or row is None:
+            continue
+
+        ncid = row.get('ncid')
+        if not ncid:
+            skipped += 1
+            bad_lines.error(line_no, line, "No NCID found in data")
+            continue
 
-    file_tracker_filter_data = {
-        'data_file_kind': FileTracker.DATA_FILE_KIND_NCVOTER
-    }
+        hash_val, parsed_row, parse_error = prepared or prepare_row(row)
+        legacy_hash = row_hash(row, LEGACY_VERSION) if legacy else None
+        if parse_error:
+            pending.append((line_no, ncid, hash_val, legacy_hash, file_tracker.created.isoformat(), None, line, parse_error))
+        else:
+            snapshot_dt = parsed_row.pop('snapshot_dt', None) or file_tracker.created
+            data = json.dumps(parsed_row, cls=DjangoJSONEncoder)
+            pending.append((line_no, ncid, hash_val, legacy_hash, snapshot_dt.isoformat(), data, None, None))
+
+        if len(pending) >= STAGING_COPY_AMOUNT:
+            copy_staged_rows(cursor, table, pending)
+            pending.clear()
+            renew_lease(file_tracker)
+
+    if pending:
+        copy_staged_rows(cursor, table, pending)
+    bad_lines.flush()
+    return line_no, skipped
+
+
+def fill_missing_voter_data(table, generation):
+    """Voters imported before NCVoter.data existed have it set to NULL. The row-by-row path
+    rebuilds it from the changelog when it needs it, so do the same up front for any such
+    voter in this generation, letting the SQL below assume data is always present.
+    """
+    staged_ncids = RawSQL("SELECT ncid FROM {0} WHERE generation = %s".format(table), [generation])
+    voters = NCVoter.objects.filter(data__isnull=True, ncid__in=staged_ncids)
+    for voter in voters:
+        voter.data = voter.build_current()
+        voter.save(update_fields=['data'])
+
+
+def apply_staged_generation(cursor, table, file_tracker, generation):
+    """Apply one generation of staged rows with set-based SQL.
+
+    A generation holds at most one row per NCID, so every row in it can be compared against
+    the database as it stood before the generation, exactly as the row-by-row path would
+    see it. The steps mirror skip_or_voter, prepare_change and flush.
+    """
+    fill_missing_voter_data(table, generation)
+
+    cursor.execute("""
+        UPDATE {0} s SET voter_id = v.id
+          FROM voter_ncvoter v
+         WHERE v.ncid = s.ncid AND s.generation = %s
+    """.format(table), [generation])
+
+    # Already seen: the voter's latest change has this very hash (made the same way)
+    cursor.execute("""
+        UPDATE {0} s SET op = 'S'
+          FROM voter_ncvoter v
+         WHERE v.id = s.voter_id AND s.generation = %(generation)s
+           AND CASE WHEN v.latest_hash IS NULL THEN
+                         EXISTS (SELECT 1 FROM (SELECT c.md5_hash, c.hash_version FROM voter_changetracker c
+                                                 WHERE c.voter_id = s.voter_id
+                                                 ORDER BY c.snapshot_dt DESC, c.id DESC LIMIT 1) c
+                                  WHERE (c.hash_version = %(current)s AND c.md5_hash = s.md5_hash)
+                                     OR (c.hash_version = %(legacy)s AND c.md5_hash = s.legacy_hash))
+                    WHEN v.latest_hash_version = %(current)s THEN v.latest_hash = s.md5_hash
+                    ELSE v.latest_hash = s.legacy_hash END
+    """.format(table), {'generation': generation, 'current': CURRENT_VERSION, 'legacy': LEGACY_VERSION})
+    # Those matched through an older version of the hashing get the current one instead
+    cursor.execute("""
+        UPDATE voter_ncvoter v SET latest_hash = s.md5_hash, latest_hash_version = %(current)s
+          FROM {0} s
+         WHERE v.id = s.voter_id AND s.generation = %(generation)s AND s.op = 'S'
+           AND v.latest_hash IS NOT NULL AND v.latest_hash_version <> %(current)s
+    """.format(table), {'generation': generation, 'current': CURRENT_VERSION})
+    cursor.execute("""
+        UPDATE {0} s SET op = CASE WHEN s.error IS NOT NULL THEN 'E'
+                                   WHEN s.voter_id IS NULL THEN 'A'
+                                   ELSE 'M' END
+         WHERE s.generation = %s AND s.op IS NULL
+    """.format(table), [generation])
+
+    # Adds: insert the new voters, then pick up their IDs
+    cursor.execute("""
+        INSERT INTO voter_ncvoter (ncid, data, deleted, latest_hash, latest_hash_version, latest_snapshot_dt)
+        SELECT s.ncid, s.data, false, s.md5_hash, %s, s.snapshot_dt FROM {0} s
+         WHERE s.generation = %s AND s.op = 'A'
+         ORDER BY s.file_lineno
+    """.format(table), [CURRENT_VERSION, generation])
+    cursor.execute("""
+        UPDATE {0} s SET voter_id = v.id, change_data = s.data
+          FROM voter_ncvoter v
+         WHERE v.ncid = s.ncid AND s.generation = %s AND s.op = 'A'
+    """.format(table), [generation])
+
+    # Modifies: the same diff as diff_dicts(), in SQL
+    cursor.execute("""
+        UPDATE {0} s SET change_data = (
+            SELECT coalesce(jsonb_object_agg(d.key, d.value), '{{}}'::jsonb) FROM (
+                SELECT n.key, n.value FROM jsonb_each(s.data) n
+                 WHERE NOT v.data ? n.key
+                    OR (n.key NOT IN ('age', 'load_dt') AND v.data -> n.key <> n.value)
+                UNION ALL
+                SELECT o.key, CASE WHEN jsonb_typeof(o.value) = 'string' THEN '""'::jsonb
+                                   ELSE 'null'::jsonb END
+                  FROM jsonb_each(v.data) o
+                 WHERE NOT s.data ? o.key
+            ) d
+        )
+          FROM voter_ncvoter v
+         WHERE v.id = s.voter_id AND s.generation = %s AND s.op = 'M'
+    """.format(table), [generation])
+    cursor.execute("""
+        WITH inserted AS (
+            INSERT INTO voter_changetracker
+                (op_code, model_name, md5_hash, hash_version, data, election_desc, file_tracker_id, file_lineno,
+                 voter_id, snapshot_dt)
+            SELECT s.op, '', s.md5_hash, %s, s.change_data, '', %s, s.file_lineno, s.voter_id, s.snapshot_dt
+              FROM {0} s
+             WHERE s.generation = %s AND s.op IN ('A', 'M')
+             ORDER BY s.file_lineno
+            RETURNING id, file_lineno
+        )
+        UPDATE {0} s SET change_id = i.id FROM inserted i WHERE s.file_lineno = i.file_lineno
+    """.format(table), [CURRENT_VERSION, file_tracker.id, generation])
+
+    # The fields each modify changed, with their values from before it: this has to come
+    # before the voters' data is updated below. A JSON null is stored as NULL, as the ORM does.
+    cursor.execute("""
+        INSERT INTO voter_fieldchange (voter_id, change_id, field, old_value, new_value, snapshot_dt)
+        SELECT s.voter_id, s.change_id, d.key, nullif(v.data -> d.key, 'null'), nullif(d.value, 'null'), s.snapshot_dt
+          FROM {0} s
+          JOIN voter_ncvoter v ON v.id = s.voter_id
+         CROSS JOIN jsonb_each(s.change_data) d
+         WHERE s.generation = %s AND s.op = 'M'
+    """.format(table), [generation])
+
+    cursor.execute("""
+        UPDATE voter_ncvoter v
+           SET data = s.data, latest_hash = s.md5_hash, latest_hash_version = %s, latest_snapshot_dt = s.snapshot_dt
+          FROM {0} s
+         WHERE v.id = s.voter_id AND s.generation = %s AND s.op = 'M'
+    """.format(table), [CURRENT_VERSION, generation])
+
+
+def track_changes_copy(file_tracker, output, workers=1):
+    """Set-based alternative to track_changes().
+
+    Instead of one or two lookups per line, the whole file is streamed into an UNLOGGED
+    staging table with COPY, and adds, modifies and already-seen rows are worked out with a
+    handful of joins against voter_ncvoter and voter_changetracker. The resulting NCVoter
+    and ChangeTracker rows are the same as those from track_changes().
+
+    If an NCID appears more than once in a file, each occurrence is put in a later
+    "generation", and generations are applied in order, so later rows are compared against
+    the result of earlier ones just like in the row-by-row path.
+    """
+    out("Tracking changes for file {0} using a staging table".format(file_tracker.filename), output)
+
+    last_line = find_last_line(file_tracker)
+    table = staging_table_name(file_tracker)
+    # Only pay for a second hash of every row if some voter may still need it
+    legacy = NCVoter.objects.filter(
+        Q(latest_hash__isnull=True) | ~Q(latest_hash_version=CURRENT_VERSION)
+    ).exists()
+
+    with connection.cursor() as cursor:
+        create_staging_table(cursor, table)
+        try:
+            line_no, skipped = stage_file(
+                cursor, table, file_tracker, last_line, output, workers, legacy, get_checkpoint(file_tracker)
+            )
+
+            cursor.execute("""
+                UPDATE {0} s SET generation = g.generation
+                  FROM (SELECT file_lineno,
+                               row_number() OVER (PARTITION BY ncid ORDER BY file_lineno) AS generation
+                          FROM {0}) g
+                 WHERE s.file_lineno = g.file_lineno
+            """.format(table))
+            cursor.execute("ANALYZE {0}".format(table))
+            cursor.execute("SELECT max(generation) FROM {0}".format(table))
+            generations = cursor.fetchone()[0] or 0
+
+            # All or nothing, so that resuming after an interruption can't skip over a
+            # later generation's lines, or lose the bad lines among them. This can take a
+            # while, so start with a full lease, and keep the file from being claimed by
+            # another worker until it's done.
+            renew_lease(file_tracker, force=True)
+            with transaction.atomic():
+                hold_file(file_tracker)
+                for generation in range(1, generations + 1):
+                    apply_staged_generation(cursor, table, file_tracker, generation)
+                NCVoterQueryView.sync(NCVoter.objects.filter(
+                    id__in=RawSQL("SELECT voter_id FROM {0} WHERE op IN ('A', 'M')".format(table), [])
+                ))
+
+                bad_lines = BadLineTracker(snapshot_name(file_tracker.filename, file_tracker.zip_member))
+                cursor.execute("SELECT file_lineno, line, error FROM {0} WHERE op = 'E' ORDER BY file_lineno".format(table))
+                for error_line_no, line, error in cursor.fetchall():
+                    bad_lines.error(error_line_no, line, error)
+                bad_lines.flush()
+            renew_lease(file_tracker, force=True)
+
+            cursor.execute("SELECT op, count(*) FROM {0} GROUP BY op".format(table))
+            tallies = dict(cursor.fetchall())
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
+
+    finish_file(file_tracker)
+
+    out("Lines processed for {}: {}".format(file_tracker.filename, line_no), output)
+    return (tallies.get('A', 0), tallies.get('M', 0), tallies.get('S', 0), skipped)
 
-    if not options.get('resume'):
-        file_tracker_filter_data['file_status'] = FileTracker.UNPROCESSED
 
-    ncvoter_file_trackers = FileTracker.objects.filter(**file_tracker_filter_data).order_by('created')
+def process_files(**options):
+    """Claim and process NCVoter files, one at a time, until there are none left that this
+    process may claim (see claim_file). Any number of these can run at once, each working
+    through files of different counties.
+    """
+    output = not options.get('quiet')
+    workers = options.get('workers') or 1
+    lease = datetime.timedelta(minutes=options.get('lease') or LEASE_DURATION.total_seconds() / 60)
+    worker = worker_name()
+    claimed = []
+    out("Processing NCVoter file...", output)
 
-    for file_tracker in ncvoter_file_trackers:
+    while True:
+        # A file is processed once per run, even if it didn't end up processed after all
+        file_tracker = claim_file(worker, lease, options.get('resume'), claimed)
+        if not file_tracker:
+            break
+        claimed.append(file_tracker.pk)
         reset()
-        if FileTracker.objects.filter(file_status=FileTracker.PROCESSING).exists() and not options.get('resume'):
-            out("Another parser is processing the files. Restart me later!", output)
-            return
-        lock_file(file_tracker)
         try:
-            added, modified, already_seen, skipped = track_changes(file_tracker, output)
+            if options.get('copy'):
+                added, modified, already_seen, skipped = track_changes_copy(file_tracker, output, workers)
+            else:
+                added, modified, already_seen, skipped = track_changes(file_tracker, output, workers)
         except Exception:
             reset_file(file_tracker)
             raise Exception('Error processing file {}'.format(file_tracker.filename))
@@ -412,6 +1295,67 @@ def vacuum():
     print("Completed VACUUM ANALYZE")
 
 
+def files_pending():
+    "Are there any NCVoter files left to process, or being processed?"
+    return FileTracker.objects.filter(
+        data_file_kind=FileTracker.DATA_FILE_KIND_NCVOTER,
+        file_status__in=[FileTracker.UNPROCESSED, FileTracker.PROCESSING],
+    ).exists()
+
+
+def defer_indexes(output=True):
+    """Drop the indexes on BULK_LOAD_TABLES that loading doesn't need, recording each of them
+    as a DeferredIndex in the same transaction, for rebuild_indexes() to create again.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT t.relname, i.relname, pg_get_indexdef(i.oid),
+                   array(SELECT a.attname
+                           FROM unnest(x.indkey::int2[]) WITH ORDINALITY k (attnum, n)
+                           JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+                          ORDER BY k.n)
+              FROM pg_index x
+              JOIN pg_class t ON t.oid = x.indrelid
+              JOIN pg_class i ON i.oid = x.indexrelid
+             WHERE t.relname IN %s AND pg_table_is_visible(t.oid)
+               AND NOT x.indisprimary AND NOT x.indisunique
+             ORDER BY t.relname, i.relname
+        """, [BULK_LOAD_TABLES])
+        for table_name, index_name, definition, columns in cursor.fetchall():
+            if (table_name, tuple(columns)) in ESSENTIAL_INDEXES:
+                continue
+            DeferredIndex.objects.create(table_name=table_name, index_name=index_name, definition=definition)
+            cursor.execute("DROP INDEX {}".format(connection.ops.quote_name(index_name)))
+            out("Dropped index {} until loading is done".format(index_name), output)
+
+
+def rebuild_indexes(workers=None, output=True):
+    """Create every DeferredIndex again, from its recorded definition, with up to `workers`
+    parallel maintenance workers each (on PostgreSQL 11 and later). Each index is created
+    and its DeferredIndex deleted in one transaction, so this can be run again after an
+    interruption and carries on with the indexes that are left.
+    """
+    tqdm = tqdm_or_quiet(output)
+    deferred = list(DeferredIndex.objects.order_by('id'))
+    if not deferred:
+        return
+    out("Rebuilding {} indexes".format(len(deferred)), output)
+    with connection.cursor() as cursor:
+        parallel = workers and connection.pg_version >= 110000
+        if parallel:
+            cursor.execute("SET max_parallel_maintenance_workers = %s", [workers])
+        try:
+            for index in tqdm(deferred):
+                with transaction.atomic():
+                    cursor.execute("SELECT to_regclass(%s)", [connection.ops.quote_name(index.index_name)])
+                    if cursor.fetchone()[0] is None:
+                        cursor.execute(index.definition)
+                    index.delete()
+        finally:
+            if parallel:
+                cursor.execute("RESET max_parallel_maintenance_workers")
+
+
 class Command(BaseCommand):
     help = "Process voter snapshot files and save them into the database"
 
@@ -428,8 +1372,48 @@ class Command(BaseCommand):
             dest='quiet',
             help='Do not output updates or progress while running',
         )
+        parser.add_argument(
+            '--copy',
+            action='store_true',
+            dest='copy',
+            help='COPY each file into a staging table and compute changes with set-based SQL',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            dest='workers',
+            help='Number of processes to decode, parse and hash the file with',
+        )
+        parser.add_argument(
+            '--bulk-load',
+            action='store_true',
+            dest='bulk_load',
+            help='Drop the indexes loading does not need, process all the files, then create them again',
+        )
+        parser.add_argument(
+            '--index-workers',
+            type=int,
+            default=4,
+            dest='index_workers',
+            help='Number of parallel maintenance workers to create each index with, after --bulk-load',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=int(LEASE_DURATION.total_seconds() / 60),
+            dest='lease',
+            help='Minutes without a heartbeat after which other workers may take over a file',
+        )
 
     def handle(self, *args, **options):
+        output = not options.get('quiet')
+        if options.get('bulk_load') and files_pending():
+            defer_indexes(output)
         process_files(**options)
+        # Not while other workers are still loading. This also finishes an interrupted
+        # --bulk-load, even if the interrupted run was the last one with files to process.
+        if not files_pending():
+            rebuild_indexes(options.get('index_workers'), output)
         vacuum()
         NCVoterQueryView.refresh()
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from voter.models import NCVoterQueryView
+from voter.utils import out
+
+
+class Command(BaseCommand):
+    help = "Recompute every row of NCVoterQueryView from NCVoter, and refresh the cached counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            help='Do not output updates or progress while running',
+        )
+
+    def handle(self, *args, **options):
+        output = not options.get('quiet')
+        out("Rebuilding NCVoterQueryView", output)
+        NCVoterQueryView.rebuild()
+        out("Rebuilt {} rows".format(NCVoterQueryView.objects.count()), output)
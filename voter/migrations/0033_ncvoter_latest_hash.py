@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-17 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0032_update_ncvoterqueryview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ncvoter',
+            name='latest_hash',
+            field=models.CharField(blank=True, help_text='MD5 hash of the most recently recorded change for this voter, or NULL if not yet backfilled.', max_length=32, null=True, verbose_name='latest MD5 hash'),
+        ),
+        migrations.AddField(
+            model_name='ncvoter',
+            name='latest_snapshot_dt',
+            field=models.DateTimeField(blank=True, help_text='Snapshot date of the most recently recorded change for this voter.', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-17 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0033_ncvoter_latest_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changetracker',
+            name='hash_version',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Version of the voter.hashing algorithm that produced md5_hash.'),
+        ),
+        migrations.AddField(
+            model_name='ncvoter',
+            name='latest_hash_version',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Version of the voter.hashing algorithm that produced latest_hash.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.6 on 2026-10-17 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0034_hash_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetracker',
+            name='zip_member',
+            field=models.TextField(blank=True, default='', help_text="Name of the data file inside the zip archive `filename`, if it's read straight from the zip.", verbose_name='zip member'),
+        ),
+    ]
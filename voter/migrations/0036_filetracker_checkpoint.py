@@ -0,0 +1,33 @@
+# Generated by Django 2.0.6 on 2026-10-17 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0035_filetracker_zip_member'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetracker',
+            name='checkpoint_encoding',
+            field=models.CharField(blank=True, default='', help_text='Encoding the file was read with when the checkpoint was saved.', max_length=10, verbose_name='checkpoint encoding'),
+        ),
+        migrations.AddField(
+            model_name='filetracker',
+            name='checkpoint_line_no',
+            field=models.IntegerField(default=0, help_text='Number of lines (after the header) before the checkpoint offset.', verbose_name='checkpoint line number'),
+        ),
+        migrations.AddField(
+            model_name='filetracker',
+            name='checkpoint_offset',
+            field=models.BigIntegerField(default=0, help_text='Byte offset of the first line not read yet when the checkpoint was saved.', verbose_name='checkpoint offset'),
+        ),
+        migrations.AddField(
+            model_name='filetracker',
+            name='checkpoint_row_no',
+            field=models.IntegerField(default=0, help_text='Number of rows (lines that could be split into fields) before the checkpoint offset.', verbose_name='checkpoint row number'),
+        ),
+    ]
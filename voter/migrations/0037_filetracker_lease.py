@@ -0,0 +1,28 @@
+# Generated by Django 2.0.6 on 2026-10-17 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0036_filetracker_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetracker',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', help_text='Host name and process ID of the worker that claimed the file for processing.', max_length=255, verbose_name='claimed by'),
+        ),
+        migrations.AddField(
+            model_name='filetracker',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='heartbeat'),
+        ),
+        migrations.AddField(
+            model_name='filetracker',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='lease expires'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.6 on 2026-10-17 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0037_filetracker_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeferredIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table_name', models.CharField(max_length=63, verbose_name='table name')),
+                ('index_name', models.CharField(max_length=63, unique=True, verbose_name='index name')),
+                ('definition', models.TextField(help_text='The CREATE INDEX statement for the index, as given by pg_indexes.')),
+                ('deferred_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
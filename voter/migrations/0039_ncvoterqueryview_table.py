@@ -0,0 +1,91 @@
+# Generated by Django 2.0.6 on 2026-10-17 18:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+PROJECTION = """
+            SELECT id,
+                   data->>'party_cd' AS party_cd,
+                   (data->>'county_id')::integer AS county_id,
+                   CASE WHEN data->>'ethnic_code' = 'HL'
+                     THEN 'H'
+                     ELSE data->>'race_code'
+                   END AS race_ethnicity_code,
+                   data->>'status_cd' AS status_cd,
+                   coalesce(data->>'birth_state', data->>'birth_place') AS birth_state,
+                   coalesce(data->>'gender_code', data->>'sex_code') AS gender_code,
+                   coalesce(data->>'birth_age', data->>'age')::integer AS age,
+                   data->>'res_city_desc' AS res_city_desc,
+                   data->>'zip_code' AS zip_code
+             FROM voter_ncvoter
+"""
+
+INDEXES = """
+            CREATE INDEX ON voter_ncvoterqueryview(party_cd);
+            CREATE INDEX ON voter_ncvoterqueryview(race_ethnicity_code);
+            CREATE INDEX ON voter_ncvoterqueryview(status_cd);
+            CREATE INDEX ON voter_ncvoterqueryview(gender_code);
+            CREATE INDEX ON voter_ncvoterqueryview(age);
+            CREATE INDEX ON voter_ncvoterqueryview(res_city_desc);
+            CREATE INDEX ON voter_ncvoterqueryview(zip_code);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0038_deferredindex'),
+    ]
+
+    operations = [
+        # Now that it's a table, the model is managed, so that Django truncates it along with
+        # voter_ncvoter. The columns keep the types from the materialized view.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    """
+                    DROP MATERIALIZED VIEW IF EXISTS voter_ncvoterqueryview;
+                    CREATE TABLE voter_ncvoterqueryview (
+                        id integer PRIMARY KEY REFERENCES voter_ncvoter(id) ON DELETE CASCADE,
+                        party_cd text,
+                        county_id integer,
+                        race_ethnicity_code text,
+                        status_cd text,
+                        birth_state text,
+                        gender_code text,
+                        age integer,
+                        res_city_desc text,
+                        zip_code text
+                    );
+                    INSERT INTO voter_ncvoterqueryview""" + PROJECTION + ";" + INDEXES,
+                    """
+                    DROP TABLE voter_ncvoterqueryview;
+                    CREATE MATERIALIZED VIEW voter_ncvoterqueryview AS""" + PROJECTION + """;
+                    CREATE UNIQUE INDEX ON voter_ncvoterqueryview(id);""" + INDEXES,
+                ),
+            ],
+            state_operations=[
+                migrations.DeleteModel(
+                    name='NCVoterQueryView',
+                ),
+                migrations.CreateModel(
+                    name='NCVoterQueryView',
+                    fields=[
+                        ('voter', models.OneToOneField(db_column='id', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='query_view', serialize=False, to='voter.NCVoter')),
+                        ('party_cd', models.CharField(max_length=3, verbose_name='party code')),
+                        ('county_id', models.IntegerField(verbose_name='county code')),
+                        ('race_ethnicity_code', models.CharField(max_length=1, verbose_name='race code')),
+                        ('status_cd', models.CharField(max_length=1, verbose_name='voter status code')),
+                        ('birth_state', models.CharField(blank=True, max_length=2, verbose_name='birth state')),
+                        ('gender_code', models.CharField(max_length=1, verbose_name='gender code')),
+                        ('age', models.IntegerField(null=True)),
+                        ('res_city_desc', models.CharField(blank=True, max_length=30, verbose_name='city of residence')),
+                        ('zip_code', models.CharField(blank=True, max_length=10, verbose_name='zip code')),
+                    ],
+                    options={
+                        'db_table': 'voter_ncvoterqueryview',
+                    },
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.6 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0039_ncvoterqueryview_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NCVoterQueryDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sign', models.SmallIntegerField()),
+                ('party_cd', models.TextField(null=True)),
+                ('county_id', models.IntegerField(null=True)),
+                ('race_ethnicity_code', models.TextField(null=True)),
+                ('status_cd', models.TextField(null=True)),
+                ('birth_state', models.TextField(null=True)),
+                ('gender_code', models.TextField(null=True)),
+                ('age', models.IntegerField(null=True)),
+                ('res_city_desc', models.TextField(null=True)),
+                ('zip_code', models.TextField(null=True)),
+            ],
+        ),
+    ]
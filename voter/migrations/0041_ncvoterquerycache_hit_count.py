@@ -0,0 +1,18 @@
+# Generated by Django 2.0.6 on 2026-10-17 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0040_ncvoterquerydelta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ncvoterquerycache',
+            name='hit_count',
+            field=models.IntegerField(default=0, help_text='Number of times the count was read from the cache.'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.0.6 on 2026-10-17 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0041_ncvoterquerycache_hit_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NCVoterFacetCube',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rolled_up', models.SmallIntegerField()),
+                ('status_cd', models.TextField()),
+                ('gender_code', models.TextField()),
+                ('party_cd', models.TextField()),
+                ('county_id', models.IntegerField()),
+                ('birth_state', models.TextField()),
+                ('race_ethnicity_code', models.TextField()),
+                ('age_bucket', models.IntegerField()),
+                ('count', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ncvoterfacetcube',
+            unique_together={('rolled_up', 'status_cd', 'gender_code', 'party_cd', 'county_id', 'birth_state', 'race_ethnicity_code', 'age_bucket')},
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO voter_ncvoterfacetcube
+                (rolled_up, status_cd, gender_code, party_cd, county_id, birth_state, race_ethnicity_code, age_bucket,
+                 count)
+            SELECT GROUPING(status_cd, gender_code, party_cd, county_id, birth_state, race_ethnicity_code, age_bucket),
+                   coalesce(status_cd, ''), coalesce(gender_code, ''), coalesce(party_cd, ''), coalesce(county_id, -1),
+                   coalesce(birth_state, ''), coalesce(race_ethnicity_code, ''), coalesce(age_bucket, -1),
+                   count(*)
+              FROM (SELECT coalesce(status_cd, '') AS status_cd, coalesce(gender_code, '') AS gender_code,
+                           coalesce(party_cd, '') AS party_cd, coalesce(county_id, -1) AS county_id,
+                           coalesce(birth_state, '') AS birth_state,
+                           coalesce(race_ethnicity_code, '') AS race_ethnicity_code,
+                           CASE WHEN age IS NULL THEN -1
+                                WHEN age >= 66 THEN 66
+                                WHEN age >= 41 THEN 41
+                                WHEN age >= 26 THEN 26
+                                WHEN age >= 18 THEN 18
+                                ELSE 0 END AS age_bucket
+                      FROM voter_ncvoterqueryview) v
+             GROUP BY CUBE (status_cd, gender_code, party_cd, county_id, birth_state, race_ethnicity_code, age_bucket);
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.6 on 2026-10-17 20:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0043_datageneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ncvoterquerycache',
+            name='last_hit',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the count was last read from the cache (or created), as of the last sampled hit.'),
+        ),
+        migrations.AlterField(
+            model_name='ncvoterquerycache',
+            name='hit_count',
+            field=models.IntegerField(default=0, help_text='Estimated number of times the count was read from the cache (hits are sampled).'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.0.6 on 2026-10-17 21:30
+
+from django.db import migrations, models
+import random
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0044_ncvoterquerycache_last_hit'),
+    ]
+
+    operations = [
+        # The database default gives the rows that _populate() inserts with SQL a key of their own
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    """
+                    ALTER TABLE voter_ncvoterqueryview ADD COLUMN random_key double precision NOT NULL DEFAULT random();
+                    CREATE INDEX ON voter_ncvoterqueryview(random_key);
+                    CREATE INDEX ON voter_ncvoterqueryview(county_id, random_key);
+                    CREATE INDEX ON voter_ncvoterqueryview(party_cd, random_key);
+                    CREATE INDEX ON voter_ncvoterqueryview(res_city_desc, random_key);
+                    CREATE INDEX ON voter_ncvoterqueryview(zip_code, random_key);
+                    """,
+                    "ALTER TABLE voter_ncvoterqueryview DROP COLUMN random_key;",
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='ncvoterqueryview',
+                    name='random_key',
+                    field=models.FloatField(default=random.random, editable=False, help_text='Random number that get_random_sample() orders the rows by.'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.0.6 on 2026-10-17 21:50
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0045_ncvoterqueryview_random_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.TextField()),
+                ('old_value', django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='Value of the field before the change, or NULL if it had none.', null=True)),
+                ('new_value', django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('snapshot_dt', models.DateTimeField()),
+                ('change', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='field_changes', to='voter.ChangeTracker')),
+                ('voter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='field_changes', to='voter.NCVoter')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='fieldchange',
+            index=models.Index(fields=['field', 'new_value'], name='voter_field_field_c7ad0f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fieldchange',
+            index=models.Index(fields=['field', 'voter', '-snapshot_dt'], name='voter_field_field_445545_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fieldchange',
+            unique_together={('change', 'field')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.6 on 2026-10-17 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('voter', '0046_fieldchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetracker',
+            name='diff',
+            field=models.BooleanField(default=False, help_text='Written by voter_diff_snapshots, with a blank line in place of each row left out.', verbose_name='diff'),
+        ),
+    ]
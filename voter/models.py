@@ -1,16 +1,27 @@
 import logging
 import os
 import random
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 import pytz
+from psycopg2.extensions import QueryCanceledError
 
-from django.db import connection, models, transaction
+from django.conf import settings
+from django.db import OperationalError, connection, models, transaction
+from django.db.models.query import ModelIterable
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields.jsonb import KeyTransform
 from django.contrib.postgres.indexes import GinIndex
+from django.core.exceptions import EmptyResultSet
 from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 
 from ncvoter.known_cities import KNOWN_CITIES
+from voter import bitmaps, count_cache
 from voter.constants import GENDER_FILTER_CHOICES, PARTY_FILTER_CHOICES, RACE_FILTER_CHOICES
+from voter.hashing import LEGACY_VERSION
 
 logger = logging.getLogger(__name__)
 
@@ -45,10 +56,59 @@ class FileTracker(models.Model):
     county_num = models.IntegerField(null=True)
     created = models.DateTimeField()
     file_status = models.SmallIntegerField('file status', default=UNPROCESSED, choices=STATUS_CHOICES)
+    zip_member = models.TextField(
+        'zip member',
+        blank=True,
+        default='',
+        help_text="Name of the data file inside the zip archive `filename`, if it's read straight from the zip."
+    )
+    # Which voter_process_snapshot worker is processing the file, and until when others must
+    # leave it to that worker. The lease is renewed with every heartbeat, so if a worker
+    # dies, its file is claimed again by another once the lease runs out.
+    claimed_by = models.CharField(
+        'claimed by',
+        max_length=255,
+        blank=True,
+        default='',
+        help_text="Host name and process ID of the worker that claimed the file for processing."
+    )
+    heartbeat = models.DateTimeField('heartbeat', null=True, blank=True)
+    lease_expires = models.DateTimeField('lease expires', null=True, blank=True)
+    # Where an interrupted import can pick up reading the file again, updated as changes are
+    # committed. See voter_process_snapshot.
+    checkpoint_offset = models.BigIntegerField(
+        'checkpoint offset',
+        default=0,
+        help_text="Byte offset of the first line not read yet when the checkpoint was saved."
+    )
+    checkpoint_line_no = models.IntegerField(
+        'checkpoint line number',
+        default=0,
+        help_text="Number of lines (after the header) before the checkpoint offset."
+    )
+    checkpoint_row_no = models.IntegerField(
+        'checkpoint row number',
+        default=0,
+        help_text="Number of rows (lines that could be split into fields) before the checkpoint offset."
+    )
+    checkpoint_encoding = models.CharField(
+        'checkpoint encoding',
+        max_length=10,
+        blank=True,
+        default='',
+        help_text="Encoding the file was read with when the checkpoint was saved."
+    )
+    diff = models.BooleanField(
+        'diff',
+        default=False,
+        help_text="Written by voter_diff_snapshots, with a blank line in place of each row left out."
+    )
 
     @property
     def short_filename(self):
         "Use the filename portion of the path to show a friendly name in the admin."
+        if self.zip_member:
+            return os.path.split(self.zip_member)[-1]
         return os.path.split(self.filename)[-1]
 
 
@@ -143,6 +203,10 @@ class ChangeTracker(models.Model):
     op_code = models.CharField('Operation Code', max_length=1, choices=OP_CODE_CHOICES, db_index=True)
     model_name = models.CharField('Model Name', max_length=20, choices=FileTracker.DATA_FILE_KIND_CHOICES)
     md5_hash = models.CharField('MD5 Hash Value', max_length=32)
+    hash_version = models.PositiveSmallIntegerField(
+        default=LEGACY_VERSION,
+        help_text="Version of the voter.hashing algorithm that produced md5_hash."
+    )
     data = JSONField(encoder=DjangoJSONEncoder)
     election_desc = models.CharField('election_desc', max_length=230, blank=True)
     file_tracker = models.ForeignKey('FileTracker', on_delete=models.CASCADE, related_name='changes')
@@ -161,6 +225,43 @@ class ChangeTracker(models.Model):
         return data
 
 
+class FieldChange(models.Model):
+    """
+    One row per field of each Modify ChangeTracker, with the value the field had before the change
+    and the value it changed to, so that changes to a field can be looked up by the index instead
+    of by replaying changelogs. The ingest writes these along with the changes, and the
+    voter_backfill_field_changes command fills them in for the existing history.
+    """
+    voter = models.ForeignKey('NCVoter', on_delete=models.CASCADE, related_name='field_changes')
+    change = models.ForeignKey('ChangeTracker', on_delete=models.CASCADE, related_name='field_changes')
+    field = models.TextField()
+    old_value = JSONField(
+        null=True, encoder=DjangoJSONEncoder, help_text="Value of the field before the change, or NULL if it had none."
+    )
+    new_value = JSONField(null=True, encoder=DjangoJSONEncoder)
+    snapshot_dt = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('change', 'field'),)
+        indexes = [
+            models.Index(fields=['field', 'new_value']),
+            # The latest change of each voter to a field, in order of voter (see voter.views.changes)
+            models.Index(fields=['field', 'voter', '-snapshot_dt']),
+        ]
+
+    @classmethod
+    def for_change(cls, change, previous_data):
+        """
+        Return the (unsaved) FieldChange objects of a Modify `change`, given the data of the voter
+        before it.
+        """
+        return [
+            cls(voter_id=change.voter_id, change_id=change.id, field=field, old_value=previous_data.get(field),
+                new_value=value, snapshot_dt=change.snapshot_dt)
+            for field, value in change.data.items()
+        ]
+
+
 class NCVHis(models.Model):
 
     class Meta:
@@ -204,6 +305,48 @@ class NCVHis(models.Model):
     vtd_description = models.CharField('vtd_description', max_length=60, blank=True)
 
 
+class ProjectedNCVoterIterable(ModelIterable):
+    """
+    Yield NCVoter objects whose `data` is made of the keys annotated by NCVoterQuerySet.project().
+    Voters whose data isn't set yet get those keys from their changelog instead.
+    """
+
+    def __iter__(self):
+        keys = [
+            (name, name[len(NCVoterQuerySet.PROJECTION_PREFIX):]) for name in self.queryset.query.annotations
+            if name.startswith(NCVoterQuerySet.PROJECTION_PREFIX)
+        ]
+        for voter in super().__iter__():
+            if voter.data_is_null:
+                current = voter.build_current()
+                voter.data = {key: current[key] for name, key in keys if current.get(key) is not None}
+            else:
+                voter.data = {key: getattr(voter, name) for name, key in keys if getattr(voter, name) is not None}
+            voter.projected = True
+            yield voter
+
+
+class NCVoterQuerySet(models.QuerySet):
+    PROJECTION_PREFIX = 'projected_'
+
+    def project(self, *keys):
+        """
+        Only read the given keys of NCVoter.data, each as its own column (data->'key'), instead of
+        whole documents. The voters come with a `data` dict of those keys (the ones they have), so
+        templates and the label helpers can use them as usual, but saving them raises ValueError.
+        """
+        clone = self.defer('data').annotate(
+            data_is_null=models.Case(
+                models.When(data__isnull=True, then=models.Value(True)),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            ),
+            **{self.PROJECTION_PREFIX + key: KeyTransform(key, 'data') for key in keys}
+        )
+        clone._iterable_class = ProjectedNCVoterIterable
+        return clone
+
+
 class NCVoter(models.Model):
     ncid = models.TextField('ncid', unique=True, db_index=True)
     data = JSONField(
@@ -216,6 +359,30 @@ class NCVoter(models.Model):
         default=False,
         help_text="True if this voter not seen in most recent registration data."
     )
+    latest_hash = models.CharField(
+        'latest MD5 hash',
+        max_length=32,
+        null=True,
+        blank=True,
+        help_text="MD5 hash of the most recently recorded change for this voter, or NULL if not yet backfilled."
+    )
+    latest_hash_version = models.PositiveSmallIntegerField(
+        default=LEGACY_VERSION,
+        help_text="Version of the voter.hashing algorithm that produced latest_hash."
+    )
+    latest_snapshot_dt = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Snapshot date of the most recently recorded change for this voter."
+    )
+
+    objects = NCVoterQuerySet.as_manager()
+
+    # The keys of NCVoter.data that get_race_label(), get_gender_label() and get_party_label() use
+    # How many matching voters get_random_sample() shuffles all of, rather than pick one by one
+    SAMPLE_SHUFFLE_MAX = 10000
+    SAMPLE_PROBES_PER_VOTER = 10
+    LABEL_DATA_KEYS = ('race_code', 'ethnic_code', 'gender_code', 'sex_code', 'party_cd')
 
     class Meta:
         verbose_name = "NC Voter"
@@ -290,6 +457,11 @@ class NCVoter(models.Model):
     def build_current(self):
         return self.build_version(0)
 
+    def save(self, *args, **kwargs):
+        if getattr(self, 'projected', False):
+            raise ValueError("Can't save a voter with only some of its data (see NCVoterQuerySet.project)")
+        super().save(*args, **kwargs)
+
     def get_race_label(self):
         race_code = self.data.get('race_code', 'U')
         ethnic_code = self.data.get('ethnic_code')
@@ -316,40 +488,138 @@ class NCVoter(models.Model):
     @classmethod
     def get_count(cls, filters):
         """
-        Get the count from the cache table if possible, otherwise compute it from the materialized view.
+        Get the number of voters matching `filters` (see get_counts()).
+        """
+        return cls.get_counts([filters])[0]
+
+    @classmethod
+    def get_counts(cls, filter_list):
+        """
+        Get the number of voters matching each of the filter dicts in `filter_list`: from the
+        bitmap engine if it's turned on, then from the count caches of voter.count_cache, then from
+        the cache table if possible, then from the facet cube. Those still missing are computed
+        from the query view together, in one pass over it, and cached.
+        """
+        counts = [None] * len(filter_list)
+        # Count cache key => (filters, indexes in filter_list), for the counts still missing
+        missing = OrderedDict()
+        engine = bitmaps.get_engine()
+        # Looked up before any count is read, so none from before a refresh that commits
+        # meanwhile is cached as of the new generation
+        generation = count_cache.get_generation()
+        for i, filters in enumerate(filter_list):
+            if engine:
+                counts[i] = engine.get_count(filters)
+                if counts[i] is not None:
+                    continue
+            key = count_cache.make_key(filters, generation=generation)
+            if key in missing:
+                missing[key][1].append(i)
+                continue
+            counts[i] = cls._get_cached_count(filters, key)
+            if counts[i] is None:
+                missing[key] = (filters, [i])
+        if not missing:
+            return counts
+
+        created = []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Wait for a refresh() applying deltas, which would not apply them to these new
+                # counts
+                cursor.execute('LOCK TABLE voter_ncvoterquerycache IN ROW EXCLUSIVE MODE')
+            results = NCVoterQueryView.counts_with_pending_delta([filters for filters, _ in missing.values()])
+            for (key, (filters, indexes)), (count, pending) in zip(missing.items(), results):
+                cached_count_query = NCVoterQueryCache.objects.create(qs_filters=filters, count=count - pending)
+                created.append((key, cached_count_query))
+                for i in indexes:
+                    counts[i] = cached_count_query.count
+        for key, cached_count_query in created:
+            count_cache.set(key, cached_count_query.count, cached_count_query.id)
+        return counts
+
+    @classmethod
+    def get_facet_counts(cls, filters, fields):
+        """
+        Get the number of voters matching `filters` for each value (but NULL) of each of `fields`,
+        as a dict of {field: {value: count}}, from the count caches of voter.count_cache, then from
+        the facet cube if possible. The fields still missing are counted in one grouped query over
+        the query view. Like the counts of get_count(), they're as of the last refresh.
+        """
+        key = count_cache.make_key(filters, fields)
+        cached = count_cache.get(key)
+        if cached is not None:
+            return cached[0]
+        facet_counts = NCVoterFacetCube.facet_counts(filters, fields)
+        facet_counts.update(NCVoterQueryView.facet_counts(filters, [field for field in fields if field not in facet_counts]))
+        count_cache.set(key, facet_counts)
+        return facet_counts
+
+    @classmethod
+    def _get_cached_count(cls, filters, key):
+        """
+        Return the count for `filters` from the count caches, the cache table or the facet cube,
+        or None if it has to be computed.
         """
+        cached = count_cache.get(key)
+        if cached is not None:
+            count, cached_query_id = cached
+            if cached_query_id:
+                NCVoterQueryCache(pk=cached_query_id).record_hit()
+            return count
         cached_count_query = NCVoterQueryCache.objects.filter(qs_filters=filters).first()
         if cached_count_query:
-            count = cached_count_query.count
-        else:
-            count = NCVoterQueryView.objects.filter(**filters).count()
-            NCVoterQueryCache.objects.create(qs_filters=filters, count=count)
+            cached_count_query.record_hit()
+            count_cache.set(key, cached_count_query.count, cached_count_query.id)
+            return cached_count_query.count
+        count = NCVoterFacetCube.get_count(filters)
+        if count is not None:
+            count_cache.set(key, count)
         return count
 
     @classmethod
     def get_random_sample(cls, filters, n):
         """
-        Apply filters to NCVoter and return a random sample of N voter records (as a queryset).
+        Apply filters to NCVoter and return a random sample of N voter records (as a queryset), or
+        of all of them if there are fewer.
+
+        Up to SAMPLE_SHUFFLE_MAX matching voters are simply shuffled. Past that, each voter of the
+        sample is picked on its own: the first matching row from a random point in the order of the
+        NCVoterQueryView random keys (wrapping around to the start if there's none after it), which
+        the indexes on random_key let the database find without reading any other row. A pick that
+        lands on a voter already picked is made again, up to SAMPLE_PROBES_PER_VOTER picks per voter
+        in all. A voter whose key comes after a wide gap is a little more likely to be picked, but
+        the voters of a sample have nothing to do with each other.
         """
-        count = cls.get_count(filters)
-        query = NCVoterQueryView.objects.filter(**filters)
-        if n >= count:
-            # there are fewer than N records, so return them all
-            voter_pks = query.values_list('pk', flat=True)
-        else:
-            # this 'randomness' assumes that records in NCVoterQueryView are not ordered in any
-            # meaningful way
-            offset = random.randint(0, count - n)
-            voter_pks = query[offset:offset + n].values_list('pk', flat=True)
+        query = NCVoterQueryView.objects.filter(**filters).values_list('pk', flat=True)
+        if cls.get_count(filters) <= cls.SAMPLE_SHUFFLE_MAX:
+            return NCVoter.objects.filter(pk__in=list(query.order_by('?')[:n]))
+        by_key = query.order_by('random_key')
+        voter_pks = set()
+        for probe in range(n * cls.SAMPLE_PROBES_PER_VOTER):
+            if len(voter_pks) >= n:
+                break
+            voter_pk = by_key.filter(random_key__gte=random.random()).first() or by_key.first()
+            if voter_pk is None:
+                break
+            voter_pks.add(voter_pk)
         return NCVoter.objects.filter(pk__in=voter_pks)
 
 
 class NCVoterQueryView(models.Model):
     """
-    This is an unmanaged model which maps to a materialized view. Our goal is to keep each row in
-    this view as small as possible, with only the facets we need for search. All other voter data
-    remains in the NCVoter.data JSON field, and we can join with it as needed.
+    A table of the search facets of each voter. Our goal is to keep each row in this table as
+    small as possible, with only the facets we need for search. All other voter data remains in
+    the NCVoter.data JSON field, and we can join with it as needed.
+
+    The table used to be a materialized view, but refreshing that meant rebuilding every row after
+    each import. Instead, the ingest code calls sync() for the voters it touched, and rows of
+    deleted voters go with them (the foreign key is ON DELETE CASCADE in the database, see
+    migration 0039). rebuild() is still there to recompute the whole table from scratch.
     """
+    voter = models.OneToOneField(
+        NCVoter, primary_key=True, db_column='id', on_delete=models.DO_NOTHING, related_name='query_view',
+    )
     party_cd = models.CharField('party code', max_length=3)
     county_id = models.IntegerField('county code')
     race_ethnicity_code = models.CharField('race code', max_length=1)
@@ -359,25 +629,320 @@ class NCVoterQueryView(models.Model):
     age = models.IntegerField(null=True)
     res_city_desc = models.CharField('city of residence', max_length=30, blank=True)
     zip_code = models.CharField('zip code', max_length=10, blank=True)
+    # Indexed alone and after the main facets (see migration 0045)
+    random_key = models.FloatField(
+        default=random.random, editable=False, help_text='Random number that get_random_sample() orders the rows by.',
+    )
+
+    # Above this many rows of NCVoterQueryDelta, refresh() recounts each cached query instead
+    REFRESH_MAX_DELTA = 200000
+
+    # How each column is computed from a row of voter_ncvoter (see migration 0032)
+    PROJECTION = (
+        ('id', "id"),
+        ('party_cd', "data->>'party_cd'"),
+        ('county_id', "(data->>'county_id')::integer"),
+        ('race_ethnicity_code', "CASE WHEN data->>'ethnic_code' = 'HL' THEN 'H' ELSE data->>'race_code' END"),
+        ('status_cd', "data->>'status_cd'"),
+        ('birth_state', "coalesce(data->>'birth_state', data->>'birth_place')"),
+        ('gender_code', "coalesce(data->>'gender_code', data->>'sex_code')"),
+        ('age', "coalesce(data->>'birth_age', data->>'age')::integer"),
+        ('res_city_desc', "data->>'res_city_desc'"),
+        ('zip_code', "data->>'zip_code'"),
+    )
 
     class Meta:
-        managed = False
         db_table = 'voter_ncvoterqueryview'
 
     @classmethod
-    def refresh(cls):
+    def _populate(cls, cursor, where='TRUE', params=()):
+        "Insert or update the rows for the voters in voter_ncvoter matching `where`."
+        columns = [column for column, expression in cls.PROJECTION]
+        cursor.execute(
+            'INSERT INTO voter_ncvoterqueryview ({columns}) '
+            'SELECT {expressions} FROM voter_ncvoter WHERE {where} '
+            'ON CONFLICT (id) DO UPDATE SET {updates}'.format(
+                columns=', '.join(columns),
+                expressions=', '.join(expression for column, expression in cls.PROJECTION),
+                where=where,
+                updates=', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns[1:]),
+            ),
+            params,
+        )
+        return cursor.rowcount
+
+    @classmethod
+    def _record_delta(cls, cursor, sign, where, params):
+        "Copy the rows matching `where` to NCVoterQueryDelta, with the given sign."
+        columns = ', '.join(column for column, expression in cls.PROJECTION[1:])
+        cursor.execute(
+            'INSERT INTO voter_ncvoterquerydelta (sign, {columns}) '
+            'SELECT %s, {columns} FROM voter_ncvoterqueryview WHERE {where}'.format(columns=columns, where=where),
+            [sign] + list(params),
+        )
+
+    @classmethod
+    def sync(cls, voter_ids):
+        """
+        Bring the rows for the given NCVoter IDs up to date with their NCVoter.data. `voter_ids`
+        is either a list of IDs or a queryset of NCVoter, which is then run as a subquery.
+
+        The rows as they were before are recorded in NCVoterQueryDelta with a sign of -1, and
+        as they are after with a sign of +1, for refresh() to update the cached counts with.
+        """
+        if isinstance(voter_ids, models.QuerySet):
+            subquery, params = voter_ids.values('pk').query.sql_with_params()
+            where = 'id IN ({})'.format(subquery)
+        else:
+            voter_ids = list(voter_ids)
+            if not voter_ids:
+                return 0
+            where, params = 'id = ANY(%s)', [voter_ids]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cls._record_delta(cursor, -1, where, params)
+            count = cls._populate(cursor, where, params)
+            cls._record_delta(cursor, 1, where, params)
+        return count
+
+    @classmethod
+    def rebuild(cls):
         """
-        Refresh the materialized view and refresh each of the cached query counts.
+        Recompute every row of the table from NCVoter, and refresh each of the cached query counts.
         """
-        logger.info('Starting refresh of NCVoterQueryView')
+        logger.info('Starting rebuild of NCVoterQueryView')
         with transaction.atomic():
             with connection.cursor() as cursor:
-                cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY voter_ncvoterqueryview')
-        logger.info('Refreshing %d NCVoterQueryCache counts', NCVoterQueryCache.objects.count())
-        for cached_query in NCVoterQueryCache.objects.all():
-            cached_query.count = NCVoterQueryView.objects.filter(**cached_query.qs_filters).count()
-            cached_query.save(update_fields=['count'])
+                cursor.execute('TRUNCATE voter_ncvoterqueryview')
+                cls._populate(cursor)
+        cls.refresh(recount=True)
+
+    @classmethod
+    def counts_with_pending_delta(cls, filter_list, after_delta=0):
+        """
+        Return, for each of the filter dicts in `filter_list`, the number of rows matching it and
+        the part of that number that comes from deltas not yet applied by refresh() (those with an
+        ID past `after_delta`), as of the same snapshot of the database. All the rows are counted
+        in one pass over each table, with a conditional aggregate per filter dict.
+        """
+        counts, count_params = cls._conditional_aggregates(cls, 'count(*)', filter_list)
+        pending, pending_params = cls._conditional_aggregates(NCVoterQueryDelta, 'sum(sign)', filter_list)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT c.*, d.* FROM (SELECT {} FROM {}) c, (SELECT {} FROM {} WHERE id > %s) d'.format(
+                    counts, connection.ops.quote_name(cls._meta.db_table),
+                    pending, connection.ops.quote_name(NCVoterQueryDelta._meta.db_table)),
+                count_params + pending_params + [after_delta],
+            )
+            row = cursor.fetchone()
+        return [(row[i], row[len(filter_list) + i] or 0) for i in range(len(filter_list))]
+
+    @classmethod
+    def facet_counts(cls, filters, fields):
+        """
+        Return {field: {value: count}} with the number of rows matching `filters` for each value
+        (but NULL) of each of `fields`, leaving out the deltas not yet applied by refresh(). The
+        rows of both tables are counted together in one query, with a grouping set per field.
+        """
+        if not fields:
+            return {}
+        rows_sql, rows_params = cls.objects.filter(**filters).values(*fields).query.sql_with_params()
+        delta_sql, delta_params = NCVoterQueryDelta.objects.filter(**filters).values(*fields, 'sign').query.sql_with_params()
+        columns = [connection.ops.quote_name(field) for field in fields]
+        facet_counts = {field: {} for field in fields}
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT GROUPING({columns}), {columns}, sum(sign) FROM ('
+                'SELECT {columns}, 1 AS sign FROM ({rows}) r UNION ALL SELECT {columns}, -sign FROM ({delta}) d'
+                ') c GROUP BY GROUPING SETS ({sets})'.format(
+                    columns=', '.join(columns), rows=rows_sql, delta=delta_sql,
+                    sets=', '.join('({})'.format(column) for column in columns)),
+                rows_params + delta_params,
+            )
+            for row in cursor.fetchall():
+                # GROUPING() has a bit set, from the left, for each field that's not grouped by
+                i = next(i for i in range(len(fields)) if not row[0] & (1 << (len(fields) - 1 - i)))
+                if row[-1] and row[1 + i] is not None:
+                    facet_counts[fields[i]][row[1 + i]] = row[-1]
+        return facet_counts
+
+    @staticmethod
+    def _conditional_aggregates(model, aggregate, filter_list):
+        """
+        Return the SQL (and its params) of a select list with `aggregate` over the rows of `model`
+        matching each of the filter dicts in `filter_list`. The filters must be on columns of the
+        model's own table, as no joins are made.
+        """
+        columns, params = [], []
+        for filters in filter_list:
+            query = model.objects.filter(**filters).query
+            try:
+                where, where_params = query.get_compiler(connection.alias).compile(query.where)
+            except EmptyResultSet:
+                # e.g. an __in filter with an empty list
+                where, where_params = 'FALSE', []
+            columns.append('{} FILTER (WHERE {})'.format(aggregate, where or 'TRUE'))
+            params.extend(where_params)
+        return ', '.join(columns), params
+
+    @classmethod
+    def pending_deltas(cls, filter_list, chunk_size=1000, max_id=None):
+        """
+        Return, for each of the filter dicts in `filter_list`, the sum of the signs of the matching
+        NCVoterQueryDelta rows (up to ID `max_id` if given). The deltas are read in one pass per
+        `chunk_size` filter dicts, with a conditional aggregate per filter dict (a select list can't
+        have more than 1664 entries).
+        """
+        where, where_params = ('WHERE id <= %s', [max_id]) if max_id is not None else ('', [])
+        sums = []
+        for start in range(0, len(filter_list), chunk_size):
+            columns, params = cls._conditional_aggregates(
+                NCVoterQueryDelta, 'sum(sign)', filter_list[start:start + chunk_size])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT {} FROM {} {}'.format(
+                        columns, connection.ops.quote_name(NCVoterQueryDelta._meta.db_table), where),
+                    params + where_params,
+                )
+                sums.extend(delta or 0 for delta in cursor.fetchone())
+        return sums
+
+    @classmethod
+    def refresh(cls, max_delta=None, recount=False):
+        """
+        Bring NCVoterFacetCube and each of the cached query counts up to date, and start a new
+        DataGeneration if anything changed. Cached queries are evicted first (see
+        NCVoterQueryCache.evict()), so they don't have to be brought up to date. The table itself is
+        kept up to date by sync(), which records the rows it changed in NCVoterQueryDelta. For
+        each cached query, the signs of the matching deltas are added to its count, all of them
+        counted in one pass over the deltas (see pending_deltas()), so this takes time in
+        proportion to the number of changed voters. If there are more than `max_delta`
+        (by default REFRESH_MAX_DELTA) deltas, or `recount` is set, each query is counted again
+        from scratch instead.
+
+        Only the deltas recorded by the time the refresh starts are applied; those that sync()
+        records meanwhile are left for the next one. Neither sync() nor get_count() has to wait for
+        the recount, only for the deltas to be applied to the cached counts at the end.
+        """
+        if max_delta is None:
+            max_delta = cls.REFRESH_MAX_DELTA
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Just long enough for the sync() calls in progress to commit, so that no delta
+                # up to max_id can turn up after it's read
+                cursor.execute('LOCK TABLE voter_ncvoterquerydelta IN EXCLUSIVE MODE')
+            max_id = NCVoterQueryDelta.objects.aggregate(max_id=models.Max('id'))['max_id'] or 0
+        deltas = NCVoterQueryDelta.objects.filter(id__lte=max_id)
+        delta_count = deltas.count()
+        NCVoterQueryCache.evict()
+        rebuild = recount or delta_count > max_delta
+        recounted = set()
+        if rebuild:
+            # Counted as if the deltas up to max_id were applied already
+            recounted = cls.recount(NCVoterQueryCache.objects.all(), after_delta=max_id)
+        with transaction.atomic():
+            if rebuild:
+                NCVoterFacetCube.rebuild(after_delta=max_id)
+            elif delta_count:
+                NCVoterFacetCube.apply_deltas(max_id)
+            with connection.cursor() as cursor:
+                # Keep get_count() from adding cached counts that leave out the deltas deleted here
+                cursor.execute('LOCK TABLE voter_ncvoterquerycache IN SHARE ROW EXCLUSIVE MODE')
+            # Those added by get_count() since the recount started, if any
+            cached_queries = list(NCVoterQueryCache.objects.exclude(id__in=recounted))
+            if delta_count and cached_queries:
+                logger.info('Applying %d deltas to %d NCVoterQueryCache counts', delta_count, len(cached_queries))
+                pending = cls.pending_deltas([cached_query.qs_filters for cached_query in cached_queries], max_id=max_id)
+                for cached_query, delta in zip(cached_queries, pending):
+                    if delta:
+                        cached_query.count = models.F('count') + delta
+                        cached_query.save(update_fields=['count'])
+            deltas.delete()
+            generation = DataGeneration.bump() if recount or delta_count else None
         logger.info('Done refreshing all NCVoterQueryCache counts')
+        if generation and settings.NCVOTER_BITMAP_ENGINE:
+            logger.info('Building bitmaps for data generation %d', generation)
+            bitmaps.build(generation)
+
+    @classmethod
+    def recount(cls, cached_queries, workers=None, budget=None, after_delta=0):
+        """
+        Count each of `cached_queries` again from scratch, leaving out the deltas with an ID past
+        `after_delta` (see counts_with_pending_delta()), the most often hit first, with
+        `workers` threads of their own database connection each (by default
+        settings.NCVOTER_QUERY_CACHE_REFRESH_WORKERS). With a single worker, counts are made
+        inline on this connection instead.
+
+        Counting stops once `budget` seconds (by default NCVOTER_QUERY_CACHE_REFRESH_BUDGET) have
+        passed. Cached queries that weren't counted by then are deleted, so that get_count()
+        counts them again when they're next asked for. Returns the IDs of the cached queries
+        either recounted or deleted.
+        """
+        if workers is None:
+            workers = settings.NCVOTER_QUERY_CACHE_REFRESH_WORKERS
+        if budget is None:
+            budget = settings.NCVOTER_QUERY_CACHE_REFRESH_BUDGET
+        start = time.monotonic()
+        deadline = start + budget
+        pending = deque(cached_queries.order_by('-hit_count', 'id'))
+        cached_query_ids = {cached_query.id for cached_query in pending}
+        total = len(pending)
+        counts = {}
+        logger.info('Recounting %d NCVoterQueryCache counts with %d worker(s)', total, workers)
+
+        def count_pending(statement_timeout):
+            while True:
+                try:
+                    cached_query = pending.popleft()
+                except IndexError:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    with connection.cursor() as cursor:
+                        if statement_timeout:
+                            cursor.execute('SET statement_timeout = %s', [max(int(remaining * 1000), 1)])
+                        count, delta = cls.counts_with_pending_delta([cached_query.qs_filters], after_delta)[0]
+                        counts[cached_query.id] = count - delta
+                except OperationalError as e:
+                    if not isinstance(e.__cause__, QueryCanceledError):
+                        raise
+                    # Canceled by statement_timeout: out of time
+                    return
+                if len(counts) % 100 == 0:
+                    logger.info('Recounted %d of %d NCVoterQueryCache counts in %.1fs',
+                                len(counts), total, time.monotonic() - start)
+
+        errors = []
+
+        def worker():
+            try:
+                count_pending(statement_timeout=True)
+            except Exception as e:
+                # Raised again once all the workers are done
+                errors.append(e)
+            finally:
+                # Each thread has its own connection
+                connection.close()
+
+        if workers > 1:
+            threads = [threading.Thread(target=worker) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        else:
+            count_pending(statement_timeout=False)
+
+        for cached_query in cached_queries.filter(id__in=counts.keys()):
+            cached_query.count = counts[cached_query.id]
+            cached_query.save(update_fields=['count'])
+        expired = cached_queries.filter(id__in=cached_query_ids - counts.keys()).delete()[0]
+        logger.info('Recounted %d NCVoterQueryCache counts in %.1fs, out of time for %d',
+                    len(counts), time.monotonic() - start, expired)
+        return cached_query_ids
 
 
 class NCVoterQueryCache(models.Model):
@@ -387,11 +952,276 @@ class NCVoterQueryCache(models.Model):
 
     We never invalidate these, so it is important that these be deleted (or better yet, refreshed)
     whenever new data is available in the NCVoter table. This is currently accomplished by calling
-    NCVoterQueryView.refresh() after each import.
+    NCVoterQueryView.refresh() after each import. Each count leaves out the deltas in
+    NCVoterQueryDelta, which refresh() is yet to add to it.
+
+    The cache is kept from growing forever by evict(), which refresh() calls first thing.
     """
+    # Eviction policies
+    LFU = 'lfu'
+    LRU = 'lru'
+
     qs_filters = JSONField(
         encoder=DjangoJSONEncoder,
         help_text="Dictionary of queryset filters for NCVoterQueryView.",
         unique=True
     )
     count = models.IntegerField()
+    hit_count = models.IntegerField(
+        default=0,
+        help_text="Estimated number of times the count was read from the cache (hits are sampled).",
+    )
+    last_hit = models.DateTimeField(
+        default=timezone.now,
+        help_text="When the count was last read from the cache (or created), as of the last sampled hit.",
+    )
+
+    def record_hit(self):
+        """
+        Count a hit on this entry, but only for a random NCVOTER_QUERY_CACHE_HIT_SAMPLE_RATE of
+        calls, so the read path only rarely writes. Each recorded hit stands for 1 / rate hits.
+        """
+        rate = settings.NCVOTER_QUERY_CACHE_HIT_SAMPLE_RATE
+        if rate > 0 and random.random() < rate:
+            NCVoterQueryCache.objects.filter(pk=self.pk).update(
+                hit_count=models.F('hit_count') + max(round(1 / rate), 1), last_hit=timezone.now(),
+            )
+
+    @classmethod
+    def evict(cls, max_size=None, max_idle=None, policy=None):
+        """
+        Delete the entries not hit for `max_idle` days, then as many of the least frequently
+        (policy LFU) or least recently (policy LRU) hit entries as needed to leave `max_size`.
+        The defaults are the NCVOTER_QUERY_CACHE_MAX_SIZE, NCVOTER_QUERY_CACHE_MAX_IDLE_DAYS and
+        NCVOTER_QUERY_CACHE_EVICTION settings. Returns the number of entries deleted.
+        """
+        if max_size is None:
+            max_size = settings.NCVOTER_QUERY_CACHE_MAX_SIZE
+        if max_idle is None:
+            max_idle = settings.NCVOTER_QUERY_CACHE_MAX_IDLE_DAYS
+        if policy is None:
+            policy = settings.NCVOTER_QUERY_CACHE_EVICTION
+        order = {cls.LFU: ('hit_count', 'last_hit', 'id'), cls.LRU: ('last_hit', 'id')}[policy]
+        expired = cls.objects.filter(last_hit__lt=timezone.now() - timedelta(days=max_idle)).delete()[0]
+        excess = cls.objects.count() - max_size
+        evicted = 0
+        if excess > 0:
+            evicted = cls.objects.filter(
+                id__in=list(cls.objects.order_by(*order).values_list('id', flat=True)[:excess])
+            ).delete()[0]
+        if expired or evicted:
+            logger.info('Expired %d and evicted %d (%s) NCVoterQueryCache entries', expired, evicted, policy)
+        return expired + evicted
+
+
+class NCVoterQueryDelta(models.Model):
+    """
+    A row of NCVoterQueryView as it was before (sign -1) or after (sign +1) NCVoterQueryView.sync()
+    changed it. NCVoterQueryView.refresh() adds up the signs of the rows matching each cached
+    query to update its count, then deletes them.
+
+    Voters deleted from NCVoter take their NCVoterQueryView rows with them without a delta, so
+    run NCVoterQueryView.rebuild() after deleting voters.
+    """
+    sign = models.SmallIntegerField()
+    party_cd = models.TextField(null=True)
+    county_id = models.IntegerField(null=True)
+    race_ethnicity_code = models.TextField(null=True)
+    status_cd = models.TextField(null=True)
+    birth_state = models.TextField(null=True)
+    gender_code = models.TextField(null=True)
+    age = models.IntegerField(null=True)
+    res_city_desc = models.TextField(null=True)
+    zip_code = models.TextField(null=True)
+
+
+class DeferredIndex(models.Model):
+    """
+    An index that `voter_process_snapshot --bulk-load` dropped to speed up loading, and that
+    has to be created again, exactly as it was, once loading is done. Each row is deleted in
+    the same transaction that recreates its index, so an interrupted rebuild picks up where
+    it left off.
+    """
+    table_name = models.CharField('table name', max_length=63)
+    index_name = models.CharField('index name', max_length=63, unique=True)
+    definition = models.TextField(help_text="The CREATE INDEX statement for the index, as given by pg_indexes.")
+    deferred_at = models.DateTimeField(auto_now_add=True)
+
+
+class NCVoterFacetCube(models.Model):
+    """
+    The number of NCVoterQueryView rows for every combination of values of the low-cardinality
+    facets (FACETS), as computed by GROUP BY CUBE. `rolled_up` tells which facets a row is a
+    total over, as returned by GROUPING(): the bit for the first facet is the most significant.
+    Ages are grouped in buckets, identified by the lowest age in them (AGE_BUCKETS).
+
+    NULL facet values are stored as '' (or -1), so that the columns can be part of a unique
+    constraint for NCVoterQueryView.refresh() to upsert deltas with.
+    """
+    FACETS = ('status_cd', 'gender_code', 'party_cd', 'county_id', 'birth_state', 'race_ethnicity_code', 'age_bucket')
+    # Lowest age of each age bucket but the first, which holds all ages below 18
+    AGE_BUCKETS = (18, 26, 41, 66)
+
+    rolled_up = models.SmallIntegerField()
+    status_cd = models.TextField()
+    gender_code = models.TextField()
+    party_cd = models.TextField()
+    county_id = models.IntegerField()
+    birth_state = models.TextField()
+    race_ethnicity_code = models.TextField()
+    age_bucket = models.IntegerField()
+    count = models.BigIntegerField()
+
+    class Meta:
+        unique_together = (
+            ('rolled_up', 'status_cd', 'gender_code', 'party_cd', 'county_id', 'birth_state', 'race_ethnicity_code',
+             'age_bucket'),
+        )
+
+    @classmethod
+    def _cube_sql(cls, source, sign):
+        "SQL for the rows of the cube of table `source`, where each row counts as `sign`."
+        age_bucket = 'CASE WHEN age IS NULL THEN -1 {} ELSE 0 END'.format(' '.join(
+            'WHEN age >= {0} THEN {0}'.format(bound) for bound in reversed(cls.AGE_BUCKETS)
+        ))
+        columns = ', '.join(cls.FACETS)
+        return """
+            SELECT GROUPING({columns}), {rolled_up}, coalesce(sum(sign), 0)
+              FROM (SELECT coalesce(status_cd, '') AS status_cd, coalesce(gender_code, '') AS gender_code,
+                           coalesce(party_cd, '') AS party_cd, coalesce(county_id, -1) AS county_id,
+                           coalesce(birth_state, '') AS birth_state,
+                           coalesce(race_ethnicity_code, '') AS race_ethnicity_code, {age_bucket} AS age_bucket,
+                           {sign} AS sign
+                      FROM {source}) v
+             GROUP BY CUBE ({columns})
+        """.format(
+            columns=columns,
+            rolled_up=', '.join(
+                "coalesce({}, {})".format(facet, '-1' if facet in ('county_id', 'age_bucket') else "''")
+                for facet in cls.FACETS
+            ),
+            age_bucket=age_bucket,
+            sign=sign,
+            source=source,
+        )
+
+    @classmethod
+    def rebuild(cls, after_delta=0):
+        """
+        Recompute the whole cube from NCVoterQueryView, leaving out the pending NCVoterQueryDelta
+        rows with an ID past `after_delta`. The old rows are deleted rather than truncated, so that
+        until the transaction commits, get_count() keeps reading them instead of waiting on a lock
+        for as long as NCVoterQueryView.refresh() takes.
+        """
+        logger.info('Rebuilding NCVoterFacetCube')
+        columns = 'status_cd, gender_code, party_cd, county_id, birth_state, race_ethnicity_code, age'
+        source = """(SELECT {columns}, 1 AS sign FROM voter_ncvoterqueryview
+                     UNION ALL SELECT {columns}, -sign FROM voter_ncvoterquerydelta WHERE id > %s) r""".format(columns=columns)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM voter_ncvoterfacetcube')
+            cursor.execute('INSERT INTO voter_ncvoterfacetcube (rolled_up, {}, count) {}'.format(
+                ', '.join(cls.FACETS), cls._cube_sql(source, 'sign')), [after_delta])
+
+    @classmethod
+    def apply_deltas(cls, max_id):
+        "Add the cube of the pending NCVoterQueryDelta rows, up to ID `max_id`, to the cube."
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO voter_ncvoterfacetcube (rolled_up, {columns}, count) {cube} HAVING sum(sign) <> 0
+                ON CONFLICT (rolled_up, {columns}) DO UPDATE SET count = voter_ncvoterfacetcube.count + EXCLUDED.count
+            """.format(columns=', '.join(cls.FACETS),
+                       cube=cls._cube_sql('(SELECT * FROM voter_ncvoterquerydelta WHERE id <= %s) d', 'sign')), [max_id])
+
+    @classmethod
+    def age_buckets(cls, lookup, age):
+        """
+        Return the age buckets wholly covered by an `age__gte` or `age__lte` filter, or None if the
+        filter doesn't line up with the edges of the buckets.
+        """
+        age = int(age)
+        lowest = (0,) + cls.AGE_BUCKETS
+        if lookup == 'gte' and age in cls.AGE_BUCKETS:
+            return {bucket for bucket in lowest if bucket >= age}
+        if lookup == 'lte' and age + 1 in cls.AGE_BUCKETS:
+            return {bucket for bucket in lowest if bucket <= age}
+        return None
+
+    @classmethod
+    def get_count(cls, filters):
+        """
+        Return the number of NCVoterQueryView rows matching `filters` (as for NCVoter.get_count),
+        as of the last NCVoterQueryView.refresh(), or None if the filters aren't all equality or
+        `__in` filters on FACETS, or age ranges that line up with AGE_BUCKETS.
+        """
+        values = cls._allowed_values(filters)
+        if values is None:
+            return None
+        return cls._matching(values).aggregate(count=models.Sum('count'))['count'] or 0
+
+    @classmethod
+    def facet_counts(cls, filters, fields):
+        """
+        Return {field: {value: count}} with the number of NCVoterQueryView rows matching `filters`
+        for each value of each of `fields` that's one of FACETS (but age_bucket), as of the last
+        NCVoterQueryView.refresh(). NULL values are left out. Returns {} if the filters can't be
+        answered from the cube (see get_count()).
+        """
+        values = cls._allowed_values(filters)
+        if values is None:
+            return {}
+        facet_counts = {}
+        for field in fields:
+            if field in cls.FACETS and field != 'age_bucket':
+                rows = cls._matching(values, field).exclude(**{field: -1 if field == 'county_id' else ''})
+                facet_counts[field] = dict(rows.values_list(field).annotate(total=models.Sum('count')).filter(total__gt=0))
+        return facet_counts
+
+    @classmethod
+    def _allowed_values(cls, filters):
+        """
+        Return {facet: set of allowed values} for `filters`, or None if they aren't all equality or
+        `__in` filters on FACETS, or age ranges that line up with AGE_BUCKETS.
+        """
+        values = {}
+        for key, value in filters.items():
+            field, _, lookup = key.partition('__')
+            if field == 'age' and lookup in ('gte', 'lte'):
+                field, allowed = 'age_bucket', cls.age_buckets(lookup, value)
+                if allowed is None:
+                    return None
+            elif field in cls.FACETS and field != 'age_bucket' and lookup in ('', 'exact', 'in'):
+                allowed = set(value) if lookup == 'in' else {value}
+                if allowed & {'', None}:
+                    # Those stand for NULL in the cube
+                    return None
+            else:
+                return None
+            values[field] = values[field] & allowed if field in values else allowed
+        return values
+
+    @classmethod
+    def _matching(cls, values, grouped_by=None):
+        "The rows of the cube with the counts for the allowed `values`, by value of `grouped_by`."
+        rolled_up = sum(1 << (len(cls.FACETS) - 1 - i) for i, facet in enumerate(cls.FACETS)
+                        if facet not in values and facet != grouped_by)
+        return cls.objects.filter(rolled_up=rolled_up, **{field + '__in': allowed for field, allowed in values.items()})
+
+
+class DataGeneration(models.Model):
+    """
+    One row per generation of the voter data that counts are served from. NCVoterQueryView.refresh()
+    adds a row whenever it brings the counts up to date with changed data, so whatever is derived
+    from the data outside the database (such as the files of voter.bitmaps) can be tied to the
+    generation it was made from, and replaced when a new one starts.
+    """
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def current(cls):
+        "Return the number of the current generation, or 0 before the first one."
+        return cls.objects.aggregate(current=models.Max('id'))['current'] or 0
+
+    @classmethod
+    def bump(cls):
+        "Start a new generation and return its number."
+        return cls.objects.create().id
@@ -20,8 +20,9 @@ class APIChangesTests(TestCase):
         voter = models.NCVoter.objects.get_or_create(ncid=ncid)[0]
         lineno = models.ChangeTracker.objects.filter(file_tracker=ft).count()
         op_code = 'A' if voter.changelog.count() == 0 else 'M'
+        previous_data = voter.build_current()
 
-        models.ChangeTracker.objects.create(
+        change = models.ChangeTracker.objects.create(
             file_tracker=ft,
             file_lineno=lineno,
             snapshot_dt=now,
@@ -29,6 +30,8 @@ class APIChangesTests(TestCase):
             voter=voter,
             data=data,
         )
+        if op_code == 'M':
+            models.FieldChange.objects.bulk_create(models.FieldChange.for_change(change, previous_data))
 
     def test_changed_required(self):
         resp = changes(self.make_request({}))
@@ -105,3 +108,27 @@ class APIChangesTests(TestCase):
             resp = changes(self.make_request({'changed': 'last_name', 'limit': '5'}))
 
         assert 6 == len(resp)  # 5 NCIDs + _elapsed key
+
+    def test_voter_summary(self):
+        self.make_change("A1", {'last_name': 'SMITH'})
+        self.make_change("A1", {'last_name': 'WILLIAMS'})
+        models.NCVoter.objects.filter(ncid="A1").update(
+            data={'first_name': 'JO', 'midl_name': 'ANN', 'last_name': 'WILLIAMS', 'age': 40, 'race_code': 'W'})
+
+        with patch("voter.views.JsonResponse") as jr, self.assertNumQueries(1):
+            jr.side_effect = lambda x, *a, **kw: x
+            resp = changes(self.make_request({'changed': 'last_name'}))
+
+        assert resp['A1']['voter'] == {'full_name': 'JO ANN WILLIAMS', 'age': 40}
+
+    def test_voter_summary_without_data(self):
+        "Voters whose data isn't set yet are summarized from their changelog, Add included"
+        self.make_change("A1", {'first_name': 'JO', 'midl_name': 'ANN', 'last_name': 'SMITH', 'age': 40})
+        self.make_change("A1", {'last_name': 'WILLIAMS'})
+        self.assertIsNone(models.NCVoter.objects.get(ncid="A1").data)
+
+        with patch("voter.views.JsonResponse") as jr:
+            jr.side_effect = lambda x, *a, **kw: x
+            resp = changes(self.make_request({'changed': 'last_name'}))
+
+        assert resp['A1']['voter'] == {'full_name': 'JO ANN WILLIAMS', 'age': 40}
@@ -0,0 +1,37 @@
+from django.test import TestCase
+
+from voter.hashing import CURRENT_VERSION, LEGACY_VERSION
+from voter.management.commands.voter_backfill_latest_hash import backfill_latest_hashes
+from voter.management.commands.voter_process_snapshot import process_files, reset
+from voter.models import NCVoter
+from voter.tests.test_voter_process_snapshot import create_file_tracker
+
+
+class BackfillLatestHashTest(TestCase):
+
+    def setUp(self):
+        reset()
+        create_file_tracker(1)
+        process_files(quiet=True)
+        create_file_tracker(3)
+        process_files(quiet=True)
+        self.expected = dict(NCVoter.objects.values_list('ncid', 'latest_hash'))
+        NCVoter.objects.update(latest_hash=None, latest_hash_version=LEGACY_VERSION, latest_snapshot_dt=None)
+
+    def test_backfill(self):
+        updated = backfill_latest_hashes(chunk_size=3, output=False)
+
+        self.assertEqual(19, updated)
+        self.assertEqual(self.expected, dict(NCVoter.objects.values_list('ncid', 'latest_hash')))
+        voter = NCVoter.objects.get(ncid="AS2035")
+        self.assertEqual(voter.latest_snapshot_dt, voter.changelog.last().snapshot_dt)
+        self.assertEqual(CURRENT_VERSION, voter.latest_hash_version)
+
+    def test_backfill_only_missing(self):
+        NCVoter.objects.filter(ncid="AS2035").update(latest_hash='0' * 32)
+
+        updated = backfill_latest_hashes(chunk_size=1000, output=False)
+
+        self.assertEqual(18, updated)
+        self.assertEqual('0' * 32, NCVoter.objects.get(ncid="AS2035").latest_hash)
+        self.assertEqual(0, backfill_latest_hashes(chunk_size=1000, output=False))
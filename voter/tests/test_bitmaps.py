@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from voter import bitmaps
+from voter.models import DataGeneration, NCVoter, NCVoterQueryView
+from voter.tests import factories
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+VOTERS = [
+    {'party_cd': 'DEM', 'county_id': '1', 'gender_code': 'F', 'age': '20', 'zip_code': '27511'},
+    {'party_cd': 'DEM', 'county_id': '2', 'gender_code': 'M', 'age': '30', 'zip_code': '27513'},
+    {'party_cd': 'REP', 'county_id': '1', 'gender_code': 'F', 'age': '70', 'zip_code': '27511',
+     'res_city_desc': 'CARY'},
+    {'party_cd': 'UNA', 'county_id': '10', 'gender_code': 'U'},
+]
+
+
+@unittest.skipUnless(numpy, "NumPy is not installed")
+class BitmapEngineTest(TestCase):
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = tempdir.name
+        settings = override_settings(NCVOTER_BITMAP_ENGINE=True, NCVOTER_BITMAP_PATH=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        bitmaps.reset()
+        self.addCleanup(bitmaps.reset)
+        for i, data in enumerate(VOTERS):
+            factories.NCVoter(ncid='AA{}'.format(i), data=data)
+        NCVoterQueryView.rebuild()
+
+    def test_counts_match_database(self):
+        generation = DataGeneration.current()
+        engine = bitmaps.BitmapEngine(bitmaps.build(generation), generation)
+        for filters in ({}, {'party_cd': 'DEM'}, {'party_cd': 'GRE'}, {'party_cd__in': ['DEM', 'UNA']},
+                        {'county_id': '1', 'gender_code': 'F'}, {'county_id__in': [1, 10]},
+                        {'zip_code': '27511'}, {'zip_code__in': ['27513', '99999']}, {'res_city_desc': 'CARY'},
+                        {'age__gte': 25}, {'age__lte': 30, 'party_cd': 'DEM'}, {'age__gte': 21, 'age__lte': 69}):
+            with self.subTest(filters=filters):
+                self.assertEqual(NCVoterQueryView.objects.filter(**filters).count(), engine.get_count(filters))
+        self.assertIsNone(engine.get_count({'zip_code__startswith': '275'}))
+        self.assertIsNone(engine.get_count({'party_cd': None}))
+
+    def test_get_count_uses_current_generation(self):
+        # rebuild() started a generation, and built its files
+        generation = DataGeneration.current()
+        self.assertEqual(generation, bitmaps.get_engine().generation)
+        with patch('voter.models.NCVoterQueryView.objects.filter') as mock_queryview:
+            self.assertEqual(NCVoter.get_count({'zip_code': '27511'}), 2)
+        mock_queryview.assert_not_called()
+        # Files not built yet for the next generation
+        DataGeneration.bump()
+        bitmaps.reset()
+        self.assertIsNone(bitmaps.get_engine())
+
+    def test_build_as_of_refresh(self):
+        generation = DataGeneration.current()
+        voter = NCVoter.objects.get(ncid='AA3')
+        voter.data['zip_code'] = '27511'
+        voter.save()
+        NCVoterQueryView.sync([voter.id])
+        NCVoterQueryView.sync([factories.NCVoter(ncid='AA4', data={'zip_code': '27511'}).id])
+        # Left out until the next refresh, like the cached counts
+        engine = bitmaps.BitmapEngine(bitmaps.build(generation), generation)
+        self.assertEqual(4, engine.get_count({}))
+        self.assertEqual(2, engine.get_count({'zip_code': '27511'}))
+        self.assertEqual(1, engine.get_count({'party_cd': 'UNA', 'county_id': '10'}))
+        # Not for a generation that's been replaced
+        DataGeneration.bump()
+        self.assertIsNone(bitmaps.build(generation))
+
+    def test_refresh_starts_new_generation(self):
+        generation = DataGeneration.current()
+        voter = NCVoter.objects.get(ncid='AA3')
+        voter.data['zip_code'] = '27511'
+        voter.save()
+        NCVoterQueryView.sync([voter.id])
+        NCVoterQueryView.refresh()
+        self.assertEqual(generation + 1, DataGeneration.current())
+        self.assertEqual([str(generation + 1)], os.listdir(self.path))
+        bitmaps.reset()
+        self.assertEqual(3, NCVoter.get_count({'zip_code': '27511'}))
+        # Nothing changed, so no new generation
+        NCVoterQueryView.refresh()
+        self.assertEqual(generation + 1, DataGeneration.current())
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from unittest.mock import patch
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from voter import count_cache
+from voter.models import DataGeneration, NCVoter, NCVoterQueryCache, NCVoterQueryView
+from voter.tests import factories
+
+COUNT_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'counts': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-counts'},
+}
+
+
+class CanonicalTest(SimpleTestCase):
+
+    def test_equivalent_filters(self):
+        self.assertEqual(
+            count_cache.canonical({'party_cd__in': ['REP', 'DEM'], 'age__gte': 18}),
+            count_cache.canonical({'age__gte': 18, 'party_cd__in': ['DEM', 'REP']}),
+        )
+        self.assertNotEqual(count_cache.canonical({'age__gte': 18}), count_cache.canonical({'age__lte': 18}))
+
+
+@override_settings(CACHES=COUNT_CACHES, NCVOTER_COUNT_CACHE_LOCAL_SIZE=2)
+class CountCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        count_cache.shared_cache().clear()
+        count_cache.clear_local()
+        count_cache.reset()
+        self.addCleanup(count_cache.clear_local)
+        self.addCleanup(count_cache.reset)
+
+    def test_local_lru(self):
+        for i in range(3):
+            count_cache.set('key{}'.format(i), i)
+        self.assertEqual(['key1', 'key2'], list(count_cache._local))
+        # Still in the shared cache, and back in the local one
+        self.assertEqual((0, None), count_cache.get('key0'))
+        self.assertEqual(['key2', 'key0'], list(count_cache._local))
+
+    def test_new_generation_invalidates(self):
+        voter = factories.NCVoter(ncid='AA1', data={'zip_code': '27511'})
+        factories.NCVoter(ncid='AA2', data={'zip_code': '27513'})
+        NCVoterQueryView.rebuild()
+        self.assertEqual(DataGeneration.current(), count_cache.get_generation())
+        self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+        # Served from the count caches, without looking at NCVoterQueryCache again
+        NCVoterQueryCache.objects.update(count=23)
+        self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+        count_cache.clear_local()
+        self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+
+        voter.data['zip_code'] = '27513'
+        voter.save()
+        NCVoterQueryView.sync([voter.id])
+        NCVoterQueryView.refresh()
+        self.assertEqual(DataGeneration.current(), count_cache.get_generation())
+        # Read from NCVoterQueryCache again, with the delta applied to it
+        self.assertEqual(22, NCVoter.get_count({'zip_code': '27511'}))
+
+    def test_generation_from_another_process(self):
+        voter = factories.NCVoter(ncid='AA1', data={'zip_code': '27511'})
+        NCVoterQueryView.rebuild()
+        self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+        self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+        # Another process, which shares no cache with this one, imports and refreshes
+        with patch.multiple(count_cache, _local=OrderedDict(), _generation=None), \
+                patch('voter.count_cache.shared_cache', return_value=LocMemCache('other-process', {})):
+            self.assertEqual(1, NCVoter.get_count({'zip_code': '27511'}))
+            voter.data['zip_code'] = '27513'
+            voter.save()
+            NCVoterQueryView.sync([voter.id])
+            NCVoterQueryView.refresh()
+            self.assertEqual(0, NCVoter.get_count({'zip_code': '27511'}))
+        # This one stops serving its cached count right away
+        self.assertEqual(0, NCVoter.get_count({'zip_code': '27511'}))
+        self.assertEqual(DataGeneration.current(), count_cache._generation)
@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+from django.test import TestCase
+
+from voter.management.commands.voter_diff_snapshots import ADDED, CHANGED, VANISHED, diff_snapshots, \
+    register_diff, read_records
+from voter.management.commands.voter_process_snapshot import get_file_encoding, process_files, reset
+from voter.models import ChangeTracker, FileTracker, NCVoter
+from voter.tests.test_voter_process_snapshot import file_trackers_data
+
+LATIN1 = file_trackers_data[0]['filename']
+UTF16 = file_trackers_data[1]['filename']
+NEXT_YEAR = file_trackers_data[2]['filename']
+LATIN1_COPY = 'voter/test_data/2010-10-31T00-00-00/snapshot_latin1_copy.txt'
+
+
+def create_file_tracker(i):
+    # Leave the IDs to the database, as register_diff() adds one too
+    data = dict(file_trackers_data[i - 1])
+    del data['id']
+    return FileTracker.objects.create(**data)
+
+
+class DiffSnapshotsTest(TestCase):
+
+    def setUp(self):
+        reset()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.output = os.path.join(tempdir.name, 'diff.txt')
+
+    def diff(self, old, new):
+        # A tiny run size, so the records are sorted in many runs
+        return diff_snapshots(old, new, self.output, run_size=4, output=False)
+
+    def ncids(self, filename):
+        return {record[0] for record in read_records(filename)}
+
+    def test_same_rows(self):
+        tallies = self.diff(LATIN1, LATIN1_COPY)
+        self.assertEqual({ADDED: 0, CHANGED: 0, VANISHED: 0}, tallies)
+        self.assertEqual(set(), self.ncids(self.output))
+
+    def test_added_and_vanished(self):
+        old_ncids = self.ncids(LATIN1)
+        new_ncids = self.ncids(UTF16)
+        tallies = self.diff(LATIN1, UTF16)
+        self.assertEqual(19, tallies[ADDED])
+        self.assertEqual(len(new_ncids - old_ncids), tallies[ADDED])
+        self.assertEqual(len(old_ncids - new_ncids), tallies[VANISHED])
+
+    def test_keeps_encoding(self):
+        tallies = self.diff(LATIN1, UTF16)
+        self.assertEqual('utf16', get_file_encoding(self.output))
+        self.assertEqual(tallies[ADDED] + tallies[CHANGED], len(self.ncids(self.output)))
+
+    def test_old_row_that_failed_to_parse(self):
+        "A voter's row that failed to parse was never recorded, so it's not unchanged either"
+        with open(LATIN1, encoding='latin1') as f:
+            lines = f.readlines()
+        fields = lines[1].split('\t')
+        fields[1] = 'XX'  # county_id
+        lines[1] = '\t'.join(fields)
+        bad = os.path.join(os.path.dirname(self.output), 'bad.txt')
+        with open(bad, 'w', encoding='latin1') as f:
+            f.writelines(lines)
+        tallies = self.diff(bad, bad)
+        self.assertEqual({ADDED: 0, CHANGED: 1, VANISHED: 0}, tallies)
+        self.assertEqual({fields[4]}, self.ncids(self.output))
+
+    def test_keeps_line_numbers(self):
+        self.diff(LATIN1, NEXT_YEAR)
+        new_lines = {record[1]: record[3] for record in read_records(NEXT_YEAR)}
+        kept = list(read_records(self.output))
+        self.assertEqual(6, len(kept))
+        for ncid, line_no, hash_val, line in kept:
+            self.assertEqual(new_lines[line_no], line)
+
+    def test_processing_diff_matches_processing_file(self):
+        create_file_tracker(1)
+        create_file_tracker(3)
+        process_files(quiet=True)
+        expected_voters = dict(NCVoter.objects.values_list('ncid', 'data'))
+        expected_changes = sorted(
+            ChangeTracker.objects.values_list('voter__ncid', 'op_code', 'md5_hash', 'data', 'file_lineno')
+        )
+        ChangeTracker.objects.all().delete()
+        NCVoter.objects.all().delete()
+        FileTracker.objects.all().delete()
+
+        create_file_tracker(1)
+        process_files(quiet=True)
+        next_year = create_file_tracker(3)
+        tallies = self.diff(LATIN1, NEXT_YEAR)
+        self.assertEqual({ADDED: 0, CHANGED: 6, VANISHED: 0}, tallies)
+        diff_tracker = register_diff(NEXT_YEAR, self.output)
+        self.assertTrue(diff_tracker.diff)
+        next_year.refresh_from_db()
+        self.assertEqual(FileTracker.CANCELLED, next_year.file_status)
+        self.assertEqual(next_year.created, diff_tracker.created)
+        reset()
+        process_files(quiet=True)
+
+        self.assertEqual(expected_voters, dict(NCVoter.objects.values_list('ncid', 'data')))
+        self.assertEqual(
+            expected_changes,
+            sorted(ChangeTracker.objects.values_list('voter__ncid', 'op_code', 'md5_hash', 'data', 'file_lineno')),
+        )
+        # Only the added and changed voters were read from the diff
+        self.assertEqual(tallies[ADDED] + tallies[CHANGED], ChangeTracker.objects.filter(file_tracker=diff_tracker).count())
@@ -1,3 +1,6 @@
+import os
+import tempfile
+import zipfile
 from unittest import mock
 
 from django.conf import settings
@@ -174,6 +177,46 @@ class VoterFetchUtilsTest(TestCase):
         result = utils.process_new_zip(self.url, self.base_path, self.label)
         self.assertEqual(result, utils.FETCH_STATUS_CODES.CODE_WRITE_FAILURE)
 
+    @mock.patch('voter.utils.extract_and_remove_file')
+    @mock.patch('voter.utils.attempt_fetch_and_write_new_zip')
+    def test_process_new_zip_no_extract(self, mock_fetch, mock_extract):
+        with tempfile.TemporaryDirectory() as tempdir:
+            zip_filename = os.path.join(tempdir, 'file.zip')
+            with zipfile.ZipFile(zip_filename, 'w') as archive:
+                archive.writestr('bar.txt', 'data')
+                archive.writestr('ignored.foo', 'data')
+            mock_fetch.return_value = utils.FETCH_STATUS_CODES.CODE_OK, self.etag, timezone.now(), zip_filename
+            result = utils.process_new_zip(self.url, self.base_path, self.label, extract=False)
+            self.assertEqual(result, utils.FETCH_STATUS_CODES.CODE_OK)
+            mock_extract.assert_not_called()
+            # FileTracker for the .txt member of the zip file gets created ...
+            self.assertTrue(FileTracker.objects.filter(filename=zip_filename, zip_member='bar.txt').exists())
+            # ... but we ignore members that don't have a .txt extension
+            self.assertEqual(1, FileTracker.objects.count())
+
+    @mock.patch('voter.utils.os.listdir')
+    @mock.patch('voter.utils.extract_and_remove_file')
+    @mock.patch('voter.utils.attempt_fetch_and_write_new_zip')
+    def test_process_new_zip_ncvhis_no_extract(self, mock_fetch, mock_extract, mock_listdir):
+        # voter_process only reads plain files, so voter history is extracted regardless
+        mock_fetch.return_value = utils.FETCH_STATUS_CODES.CODE_OK, self.etag, timezone.now(), ''
+        mock_extract.return_value = True
+        mock_listdir.return_value = ['bar.txt']
+        result = utils.process_new_zip(self.url, self.base_path, 'ncvhis', extract=False)
+        self.assertEqual(result, utils.FETCH_STATUS_CODES.CODE_OK)
+        mock_extract.assert_called_once_with('')
+        self.assertTrue(FileTracker.objects.filter(filename='bar.txt', zip_member='').exists())
+
+    @mock.patch('voter.utils.attempt_fetch_and_write_new_zip')
+    def test_process_new_zip_no_extract_bad_zip(self, mock_fetch):
+        with tempfile.NamedTemporaryFile(suffix='.zip') as f:
+            f.write(b'not a zip file')
+            f.flush()
+            mock_fetch.return_value = utils.FETCH_STATUS_CODES.CODE_OK, self.etag, timezone.now(), f.name
+            result = utils.process_new_zip(self.url, self.base_path, self.label, extract=False)
+        self.assertEqual(result, utils.FETCH_STATUS_CODES.CODE_WRITE_FAILURE)
+        self.assertFalse(FileTracker.objects.exists())
+
     @mock.patch('voter.utils.attempt_fetch_and_write_new_zip')
     def test_process_new_zip_already_downloaded(self, mock_fetch):
         mock_fetch.return_value = utils.FETCH_STATUS_CODES.CODE_NOTHING_TO_DO, None, None, None
@@ -201,7 +244,17 @@ class VoterFetchHistoricalTest(TestCase):
         mock_s3_list.return_value = {'Contents': [{'Key': 'http://example.com/foo.zip'}]}
         call_command('voter_fetch_snapshot', '--quiet')
         expected_url = settings.NCVOTER_HISTORICAL_SNAPSHOT_URL + 'foo.zip'
-        mock_process_new_zip.assert_called_once_with(expected_url, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter', output=False)
+        mock_process_new_zip.assert_called_once_with(expected_url, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter', output=False,
+                                                     extract=True)
+
+    @mock.patch('voter.management.commands.voter_fetch_snapshot.process_new_zip')
+    @mock.patch('voter.management.commands.voter_fetch_snapshot.s3client.list_objects')
+    def test_handle_no_extract(self, mock_s3_list, mock_process_new_zip):
+        mock_s3_list.return_value = {'Contents': [{'Key': 'http://example.com/foo.zip'}]}
+        call_command('voter_fetch_snapshot', '--quiet', '--no-extract')
+        expected_url = settings.NCVOTER_HISTORICAL_SNAPSHOT_URL + 'foo.zip'
+        mock_process_new_zip.assert_called_once_with(expected_url, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter', output=False,
+                                                     extract=False)
 
     @mock.patch('voter.management.commands.voter_fetch_snapshot.process_new_zip')
     @mock.patch('voter.management.commands.voter_fetch_snapshot.s3client.list_objects')
@@ -214,8 +267,8 @@ class VoterFetchHistoricalTest(TestCase):
         expected_url2 = settings.NCVOTER_HISTORICAL_SNAPSHOT_URL + 'foo.zip'
         expected = [
             # mock records tuples of (args, kwargs)
-            ((expected_url1, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False}),
-            ((expected_url2, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False}),
+            ((expected_url1, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False, 'extract': True}),
+            ((expected_url2, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False, 'extract': True}),
         ]
         self.assertEqual(mock_process_new_zip.call_args_list, expected)
 
@@ -237,8 +290,8 @@ class VoterFetchCurrentTest(TestCase):
         expected_url2 = settings.NCVHIS_LATEST_STATEWIDE_URL
         expected = [
             # mock records tuples of (args, kwargs)
-            ((expected_url1, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False}),
-            ((expected_url2, settings.NCVHIS_DOWNLOAD_PATH, 'ncvhis'), {'output': False}),
+            ((expected_url1, settings.NCVOTER_DOWNLOAD_PATH, 'ncvoter'), {'output': False, 'extract': True}),
+            ((expected_url2, settings.NCVHIS_DOWNLOAD_PATH, 'ncvhis'), {'output': False, 'extract': True}),
         ]
         self.assertEqual(mock_process_new_zip.call_args_list, expected)
 
@@ -0,0 +1,41 @@
+import hashlib
+
+from bencode import bencode
+from django.test import SimpleTestCase
+
+from voter.hashing import CURRENT_VERSION, LEGACY_VERSION, row_hash
+
+
+class RowHashTest(SimpleTestCase):
+
+    row = {'ncid': 'AS2035', 'last_name': 'LANGSTON', 'first_name': 'JANE', 'snapshot_dt': '2010-10-31'}
+
+    def test_legacy_matches_bencode_md5(self):
+        expected = hashlib.md5(bytes(bencode({'ncid': 'AS2035', 'last_name': 'LANGSTON', 'first_name': 'JANE'}), 'utf-8'))
+        self.assertEqual(expected.hexdigest(), row_hash(self.row, LEGACY_VERSION))
+
+    def test_versions_differ(self):
+        self.assertNotEqual(row_hash(self.row, LEGACY_VERSION), row_hash(self.row, CURRENT_VERSION))
+
+    def test_fits_hash_columns(self):
+        for version in (LEGACY_VERSION, CURRENT_VERSION):
+            hash_val = row_hash(self.row, version)
+            self.assertEqual(32, len(hash_val))
+            int(hash_val, 16)
+
+    def test_ignores_key_order(self):
+        reordered = dict(reversed(list(self.row.items())))
+        self.assertEqual(row_hash(self.row), row_hash(reordered))
+
+    def test_ignores_snapshot_dt(self):
+        other = dict(self.row, snapshot_dt='2011-10-31')
+        self.assertEqual(row_hash(self.row), row_hash(other))
+        del other['snapshot_dt']
+        self.assertEqual(row_hash(self.row), row_hash(other))
+
+    def test_field_boundaries(self):
+        self.assertNotEqual(row_hash({'ab': 'c'}), row_hash({'a': 'bc'}))
+        self.assertNotEqual(row_hash({'a': 'b', 'c': ''}), row_hash({'a': 'b'}))
+
+    def test_detects_changes(self):
+        self.assertNotEqual(row_hash(self.row), row_hash(dict(self.row, last_name='SMITH')))
@@ -1,8 +1,18 @@
+import collections
+import itertools
+import json
+import random
+import threading
+from datetime import timedelta
 from unittest.mock import patch
 
-from django.test import TestCase
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from voter.models import FileTracker, BadLineTracker, BadLineRange, NCVoter, NCVoterQueryView
+from voter.models import FileTracker, BadLineTracker, BadLineRange, ChangeTracker, NCVoter, NCVoterQueryView, NCVoterQueryDelta, \
+    NCVoterQueryCache, NCVoterFacetCube
 from voter.tests import factories
 
 
@@ -109,15 +119,372 @@ class BadLineTrackerTest(TestCase):
 
 class NCVoterTest(TestCase):
 
-    def test_get_count_uses_materialized_view(self):
-        factories.NCVoter()
-        # materialized query view is not refreshed, so will get zero records
+    def test_get_count_uses_query_view(self):
+        voter = factories.NCVoter()
+        # query view is not synced, so will get zero records
         self.assertEqual(NCVoter.get_count({}), 0)
-        NCVoterQueryView.refresh()
+        NCVoterQueryView.rebuild()
         self.assertEqual(NCVoter.get_count({}), 1)
+        voter.delete()
+        self.assertFalse(NCVoterQueryView.objects.exists())
+
+    def test_project(self):
+        factories.NCVoter(ncid='AA1', data={'first_name': 'JANE', 'age': 40, 'ethnic_code': 'HL', 'race_code': 'W',
+                                            'sex_code': 'F', 'party_cd': 'DEM', 'res_street_address': '1 MAIN ST'})
+        query = NCVoter.objects.filter(ncid='AA1').project('first_name', 'age', *NCVoter.LABEL_DATA_KEYS)
+        self.assertNotIn('"voter_ncvoter"."data",', str(query.query))
+        voter = query.get()
+        self.assertEqual({'first_name': 'JANE', 'age': 40, 'ethnic_code': 'HL', 'race_code': 'W', 'sex_code': 'F',
+                          'party_cd': 'DEM'}, voter.data)
+        self.assertEqual(('Hispanic', 'Female', 'Democrat'),
+                         (voter.get_race_label(), voter.get_gender_label(), voter.get_party_label()))
+
+    def test_project_without_data(self):
+        "Voters whose data isn't set yet are projected from their changelog"
+        voter = factories.NCVoter(ncid='AA1')
+        ft = FileTracker.objects.create(filename='data.txt', created=timezone.now())
+        for op_code, data in (('A', {'first_name': 'JANE', 'party_cd': 'DEM'}), ('M', {'party_cd': 'REP'})):
+            ChangeTracker.objects.create(file_tracker=ft, file_lineno=0, snapshot_dt=timezone.now(), op_code=op_code,
+                                         voter=voter, data=data)
+        voter = NCVoter.objects.project('first_name', 'party_cd', 'age').get()
+        self.assertEqual({'first_name': 'JANE', 'party_cd': 'REP'}, voter.data)
+
+    def test_projected_voter_not_saved(self):
+        factories.NCVoter(ncid='AA1', data={'first_name': 'JANE', 'party_cd': 'DEM'})
+        voter = NCVoter.objects.project('first_name').get()
+        with self.assertRaises(ValueError):
+            voter.save()
+        self.assertEqual({'first_name': 'JANE', 'party_cd': 'DEM'}, NCVoter.objects.get().data)
+
+    def test_query_view_sync(self):
+        voter = factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM', 'ethnic_code': 'HL', 'race_code': 'W', 'age': '40'})
+        other = factories.NCVoter(ncid='AA2', data={'party_cd': 'REP'})
+        self.assertEqual(NCVoterQueryView.sync([voter.id]), 1)
+        row = NCVoterQueryView.objects.get()
+        self.assertEqual((row.pk, row.party_cd, row.race_ethnicity_code, row.age), (voter.id, 'DEM', 'H', 40))
+        voter.data['party_cd'] = 'UNA'
+        voter.save()
+        NCVoterQueryView.sync(NCVoter.objects.all())
+        self.assertEqual({voter.id: 'UNA', other.id: 'REP'},
+                         dict(NCVoterQueryView.objects.values_list('pk', 'party_cd')))
+
+    def test_refresh_applies_deltas(self):
+        dem = factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM', 'age': '40'})
+        rep = factories.NCVoter(ncid='AA2', data={'party_cd': 'REP', 'age': '30'})
+        NCVoterQueryView.sync([dem.id, rep.id])
+        NCVoterQueryView.refresh()
+        self.assertEqual(NCVoter.get_count({'party_cd': 'DEM'}), 1)
+        self.assertEqual(NCVoter.get_count({'age__gte': 35}), 1)
+        self.assertEqual(NCVoter.get_count({'party_cd': 'UNA'}), 0)
+
+        rep.data['party_cd'] = 'DEM'
+        rep.save()
+        NCVoterQueryView.sync([dem.id, rep.id])
+        # a count first asked for before the refresh leaves out the pending deltas
+        self.assertEqual(NCVoter.get_count({'party_cd__in': ['DEM', 'REP']}), 2)
+        with patch('voter.models.NCVoterQueryView.objects.filter') as mock_queryview:
+            NCVoterQueryView.refresh()
+        mock_queryview.assert_not_called()
+        self.assertEqual(NCVoter.get_count({'party_cd': 'DEM'}), 2)
+        self.assertEqual(NCVoter.get_count({'age__gte': 35}), 1)
+        self.assertEqual(NCVoter.get_count({'party_cd': 'UNA'}), 0)
+        self.assertEqual(NCVoter.get_count({'party_cd__in': ['DEM', 'REP']}), 2)
+        self.assertFalse(NCVoterQueryDelta.objects.exists())
+
+    def test_refresh_reads_deltas_in_one_pass(self):
+        voters = [factories.NCVoter(ncid='AA{}'.format(i), data={'zip_code': zip_code})
+                  for i, zip_code in enumerate(['27511', '27511', '27701'])]
+        NCVoterQueryView.rebuild()
+        for filters, count in (({'zip_code': '27511'}, 2), ({'zip_code': '27701'}, 1), ({'zip_code__in': []}, 0)):
+            factories.NCVoterQueryCache(qs_filters=filters, count=count)
+        voters[0].data['zip_code'] = '27701'
+        voters[0].save()
+        NCVoterQueryView.sync([voters[0].id])
+        self.assertEqual([-1, 1, 0], NCVoterQueryView.pending_deltas(
+            [{'zip_code': '27511'}, {'zip_code': '27701'}, {'zip_code__in': []}], chunk_size=2))
+        with CaptureQueriesContext(connection) as queries:
+            NCVoterQueryView.refresh()
+        self.assertEqual(1, len([q for q in queries if 'FILTER' in q['sql'] and 'voter_ncvoterquerydelta' in q['sql']]))
+        self.assertEqual({'{"zip_code": "27511"}': 1, '{"zip_code": "27701"}': 2, '{"zip_code__in": []}': 0},
+                         {json.dumps(c.qs_filters): c.count for c in NCVoterQueryCache.objects.all()})
+
+    def test_get_counts_in_one_pass(self):
+        factories.NCVoter(ncid='AA1', data={'zip_code': '27511', 'age': '40'})
+        factories.NCVoter(ncid='AA2', data={'zip_code': '27511', 'age': '30'})
+        NCVoterQueryView.rebuild()
+        voter = factories.NCVoter(ncid='AA3', data={'zip_code': '27511', 'age': '50'})
+        NCVoterQueryView.sync([voter.id])
+        filter_list = [
+            {}, {'zip_code': '27511'}, {'zip_code': '27511', 'age__gte': 35}, {'zip_code': '27511'},
+            {'zip_code__in': []},
+        ]
+        with patch('voter.models.NCVoterQueryView.counts_with_pending_delta',
+                   wraps=NCVoterQueryView.counts_with_pending_delta) as mock_counts:
+            # All as of the last refresh, leaving out the pending deltas
+            self.assertEqual([2, 2, 1, 2, 0], NCVoter.get_counts(filter_list))
+        mock_counts.assert_called_once()
+        self.assertEqual({'{"zip_code": "27511"}': 2, '{"age__gte": 35, "zip_code": "27511"}': 1},
+                         {json.dumps(c.qs_filters, sort_keys=True): c.count
+                          for c in NCVoterQueryCache.objects.exclude(qs_filters={'zip_code__in': []})})
+        NCVoterQueryView.refresh()
+        self.assertEqual([3, 2], NCVoter.get_counts([{'zip_code': '27511'}, {'zip_code': '27511', 'age__gte': 35}]))
+
+    def test_get_facet_counts(self):
+        factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM', 'county_id': '1', 'zip_code': '27511'})
+        factories.NCVoter(ncid='AA2', data={'party_cd': 'DEM', 'county_id': '2', 'zip_code': '27511'})
+        factories.NCVoter(ncid='AA3', data={'party_cd': 'REP', 'county_id': '1', 'zip_code': '27513'})
+        NCVoterQueryView.rebuild()
+        voter = factories.NCVoter(ncid='AA4', data={'party_cd': 'REP', 'county_id': '2', 'zip_code': '27511'})
+        NCVoterQueryView.sync([voter.id])
+        expected = {'party_cd': {'DEM': 2}, 'county_id': {1: 1, 2: 1}}
+        self.assertEqual(expected, NCVoter.get_facet_counts({'zip_code': '27511'}, ['party_cd', 'county_id']))
+        NCVoterQueryView.refresh()
+        expected = {'party_cd': {'DEM': 2, 'REP': 1}, 'county_id': {1: 1, 2: 2}}
+        self.assertEqual(expected, NCVoter.get_facet_counts({'zip_code': '27511'}, ['party_cd', 'county_id']))
+        self.assertEqual({}, NCVoter.get_facet_counts({}, []))
+
+    def test_facet_counts_from_cube(self):
+        factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM', 'county_id': '1', 'res_city_desc': 'DURHAM'})
+        factories.NCVoter(ncid='AA2', data={'party_cd': 'DEM', 'county_id': '2', 'res_city_desc': 'DURHAM'})
+        factories.NCVoter(ncid='AA3', data={'party_cd': 'REP', 'county_id': '1'})
+        factories.NCVoter(ncid='AA4', data={'party_cd': 'DEM'})
+        NCVoterQueryView.rebuild()
+        with CaptureQueriesContext(connection) as queries:
+            facet_counts = NCVoter.get_facet_counts({'party_cd__in': ['DEM', 'REP']}, ['party_cd', 'county_id'])
+        # Voters without a county aren't counted under None
+        self.assertEqual({'party_cd': {'DEM': 3, 'REP': 1}, 'county_id': {1: 2, 2: 1}}, facet_counts)
+        self.assertFalse([q for q in queries if 'voter_ncvoterqueryview' in q['sql']])
+        # Only the fields that aren't in the cube are counted from the query view
+        with CaptureQueriesContext(connection) as queries:
+            facet_counts = NCVoter.get_facet_counts({'party_cd': 'DEM'}, ['county_id', 'res_city_desc'])
+        self.assertEqual({'county_id': {1: 1, 2: 1}, 'res_city_desc': {'DURHAM': 2}}, facet_counts)
+        self.assertEqual(1, len([q for q in queries if 'GROUPING SETS' in q['sql']]))
+
+    @patch('voter.models.NCVoter.get_count', return_value=NCVoter.SAMPLE_SHUFFLE_MAX + 1)
+    def test_random_sample_probes(self, get_count):
+        voters = [factories.NCVoter(ncid='AA{}'.format(i), data={'party_cd': 'DEM' if i < 4 else 'REP'}) for i in range(5)]
+        NCVoterQueryView.rebuild()
+        for i, voter in enumerate(voters):
+            NCVoterQueryView.objects.filter(pk=voter.id).update(random_key=i / 5)
+        # Key 0.6, 0.6 again, nothing from 0.9 so 0.0, then 0.2
+        with patch('voter.models.random.random', side_effect=[0.5, 0.5, 0.9, 0.1]):
+            self.assertEqual({voters[3].id, voters[0].id, voters[1].id},
+                             set(NCVoter.get_random_sample({}, 3).values_list('pk', flat=True)))
+        with patch('voter.models.random.random', side_effect=[0.7, 0.5, 0.1]):
+            self.assertEqual({voters[0].id, voters[3].id, voters[1].id},
+                             set(NCVoter.get_random_sample({'party_cd': 'DEM'}, 3).values_list('pk', flat=True)))
+        # Fewer matches than asked for
+        with patch('voter.models.random.random', return_value=0.5):
+            self.assertEqual({voters[4].id}, set(NCVoter.get_random_sample({'party_cd': 'REP'}, 3).values_list('pk', flat=True)))
+        # Synced rows keep their key
+        NCVoterQueryView.sync([voters[2].id])
+        self.assertEqual(0.4, NCVoterQueryView.objects.get(pk=voters[2].id).random_key)
+
+    def test_random_samples_are_independent(self):
+        "Samples aren't runs of neighbours: all sorts of combinations of voters come up"
+        random.seed(23)
+        voters = [factories.NCVoter(ncid='AA{}'.format(i), data={'party_cd': 'DEM'}) for i in range(10)]
+        NCVoterQueryView.rebuild()
+        for voter in voters:
+            NCVoterQueryView.objects.filter(pk=voter.id).update(random_key=random.random())
+        for shuffle_max in (NCVoter.SAMPLE_SHUFFLE_MAX, -1):
+            with self.subTest(shuffle_max=shuffle_max), patch.object(NCVoter, 'SAMPLE_SHUFFLE_MAX', shuffle_max):
+                samples = [frozenset(NCVoter.get_random_sample({}, 3).values_list('pk', flat=True)) for i in range(300)]
+                self.assertTrue(all(len(sample) == 3 for sample in samples))
+                # At most 10 different runs of 3 neighbours, out of 120 combinations
+                self.assertGreater(len(set(samples)), 60)
+                picks = collections.Counter(pk for sample in samples for pk in sample)
+                self.assertEqual(10, len(picks))
+
+    def test_refresh_recounts_past_max_delta(self):
+        voter = factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM'})
+        factories.NCVoterQueryCache(qs_filters={'party_cd': 'DEM'}, count=23)
+        NCVoterQueryView.sync([voter.id])
+        NCVoterQueryView.refresh(max_delta=0)
+        self.assertEqual(NCVoter.get_count({'party_cd': 'DEM'}), 1)
+        self.assertFalse(NCVoterQueryDelta.objects.exists())
+
+    def test_recount_hottest_first_within_budget(self):
+        factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM'})
+        NCVoterQueryView.rebuild()
+        factories.NCVoterQueryCache(qs_filters={'party_cd': 'DEM'}, count=23, hit_count=5)
+        factories.NCVoterQueryCache(qs_filters={}, count=23, hit_count=10)
+        factories.NCVoterQueryCache(qs_filters={'party_cd': 'REP'}, count=23, hit_count=1)
+        # each call to the clock takes a second, so only two counts fit in the budget
+        with patch('voter.models.time.monotonic', side_effect=itertools.count()):
+            NCVoterQueryView.recount(NCVoterQueryCache.objects.all(), workers=1, budget=2.5)
+        self.assertEqual({'{}': 1, '{"party_cd": "DEM"}': 1},
+                         {json.dumps(c.qs_filters): c.count for c in NCVoterQueryCache.objects.all()})
+
+    def test_facet_cube_counts(self):
+        for i, (party, county, age) in enumerate([('DEM', '1', '20'), ('DEM', '2', '30'), ('REP', '1', '70'),
+                                                  ('UNA', '1', None)]):
+            data = {'party_cd': party, 'county_id': county, 'gender_code': 'F'}
+            if age:
+                data['age'] = age
+            factories.NCVoter(ncid='AA{}'.format(i), data=data)
+        NCVoterQueryView.rebuild()
+        rep = NCVoter.objects.get(ncid='AA2')
+        rep.data['party_cd'] = 'DEM'
+        rep.save()
+        NCVoterQueryView.sync([rep.id])
+        NCVoterQueryView.refresh()
+        for filters in ({}, {'party_cd': 'DEM'}, {'party_cd': 'REP'}, {'party_cd__in': ['DEM', 'UNA']},
+                        {'county_id': 1, 'party_cd': 'DEM'}, {'county_id__in': ['1', '2'], 'gender_code': 'F'},
+                        {'party_cd': 'DEM', 'party_cd__in': ['REP', 'UNA']}, {'age__gte': 18, 'age__lte': 40},
+                        {'age__gte': 26}, {'age__lte': 65, 'party_cd': 'DEM'}):
+            with self.subTest(filters=filters):
+                self.assertEqual(NCVoterQueryView.objects.filter(**filters).count(),
+                                 NCVoterFacetCube.get_count(filters))
+        self.assertIsNone(NCVoterFacetCube.get_count({'age__gte': 30}))
+        self.assertIsNone(NCVoterFacetCube.get_count({'zip_code': '27511'}))
+        self.assertIsNone(NCVoterFacetCube.get_count({'party_cd': ''}))
+        with patch('voter.models.NCVoterQueryView.objects.filter') as mock_queryview:
+            self.assertEqual(NCVoter.get_count({'party_cd': 'DEM'}), 3)
+        mock_queryview.assert_not_called()
+        self.assertFalse(NCVoterQueryCache.objects.exists())
+
+    def test_facet_cube_of_nothing(self):
+        NCVoterFacetCube.rebuild()
+        self.assertEqual(0, NCVoterFacetCube.get_count({}))
+
+    def test_cache_hits_are_sampled(self):
+        cached = factories.NCVoterQueryCache(qs_filters={}, count=23)
+        with override_settings(NCVOTER_QUERY_CACHE_HIT_SAMPLE_RATE=0.25):
+            with patch('voter.models.random.random', return_value=0.5):
+                self.assertEqual(NCVoter.get_count({}), 23)
+            cached.refresh_from_db()
+            self.assertEqual(0, cached.hit_count)
+            with patch('voter.models.random.random', return_value=0.1):
+                self.assertEqual(NCVoter.get_count({}), 23)
+            cached.refresh_from_db()
+            self.assertEqual(4, cached.hit_count)
+
+    def test_cache_eviction(self):
+        now = timezone.now()
+        entries = [
+            factories.NCVoterQueryCache(qs_filters={'party_cd': party}, count=1, hit_count=hits,
+                                        last_hit=now - timedelta(days=days))
+            for party, hits, days in [('DEM', 10, 2), ('REP', 5, 1), ('UNA', 1, 0), ('LIB', 50, 40)]
+        ]
+        self.assertEqual(2, NCVoterQueryCache.evict(max_size=2, max_idle=30, policy=NCVoterQueryCache.LFU))
+        self.assertEqual({entries[0].id, entries[1].id}, set(NCVoterQueryCache.objects.values_list('id', flat=True)))
+        self.assertEqual(1, NCVoterQueryCache.evict(max_size=1, max_idle=30, policy=NCVoterQueryCache.LRU))
+        self.assertEqual([entries[1].id], list(NCVoterQueryCache.objects.values_list('id', flat=True)))
+
+    def test_refresh_evicts(self):
+        factories.NCVoterQueryCache(qs_filters={'party_cd': 'DEM'}, count=1, last_hit=timezone.now() - timedelta(days=31))
+        with patch('voter.models.NCVoterQueryView.objects.filter') as mock_queryview, \
+                patch('voter.models.NCVoterFacetCube.rebuild'):
+            NCVoterQueryView.refresh(recount=True)
+        mock_queryview.assert_not_called()
+        self.assertFalse(NCVoterQueryCache.objects.exists())
 
     def test_get_count_is_cached_in_db(self):
         factories.NCVoterQueryCache(qs_filters={}, count=23)
         with patch('voter.models.NCVoterQueryView.objects.filter') as mock_queryview:
             self.assertEqual(NCVoter.get_count({}), 23)
         mock_queryview.assert_not_called()
+
+
+class NCVoterQueryRecountTest(TransactionTestCase):
+
+    def test_recount_with_workers(self):
+        for i, party in enumerate(['DEM', 'DEM', 'REP']):
+            factories.NCVoter(ncid='AA{}'.format(i), data={'party_cd': party})
+        NCVoterQueryView.rebuild()
+        for filters in ({}, {'party_cd': 'DEM'}, {'party_cd': 'REP'}, {'party_cd': 'UNA'}):
+            factories.NCVoterQueryCache(qs_filters=filters, count=23)
+        NCVoterQueryView.recount(NCVoterQueryCache.objects.all(), workers=3, budget=60)
+        counts = [NCVoter.get_count(f) for f in ({}, {'party_cd': 'DEM'}, {'party_cd': 'REP'}, {'party_cd': 'UNA'})]
+        self.assertEqual([3, 2, 1, 0], counts)
+
+    def test_recount_timeout_with_workers(self):
+        for i, party in enumerate(['DEM', 'DEM', 'REP']):
+            factories.NCVoter(ncid='AA{}'.format(i), data={'party_cd': party})
+        NCVoterQueryView.rebuild()
+        for filters in ({}, {'party_cd': 'DEM'}, {'party_cd': 'REP'}):
+            factories.NCVoterQueryCache(qs_filters=filters, count=23)
+        counts_with_pending_delta = NCVoterQueryView.counts_with_pending_delta
+
+        def slow_for_rep(filter_list, after_delta=0):
+            if filter_list == [{'party_cd': 'REP'}]:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_sleep(10)')
+            return counts_with_pending_delta(filter_list, after_delta)
+
+        with patch('voter.models.NCVoterQueryView.counts_with_pending_delta', side_effect=slow_for_rep):
+            NCVoterQueryView.recount(NCVoterQueryCache.objects.all(), workers=2, budget=1)
+        # The slow count was canceled when the budget ran out, and dropped
+        self.assertEqual({'{}': 3, '{"party_cd": "DEM"}': 2},
+                         {json.dumps(c.qs_filters): c.count for c in NCVoterQueryCache.objects.all()})
+
+        # Any other error isn't taken for running out of time
+        with patch('voter.models.NCVoterQueryView.counts_with_pending_delta', side_effect=OperationalError('gone')):
+            with self.assertRaisesMessage(OperationalError, 'gone'):
+                NCVoterQueryView.recount(NCVoterQueryCache.objects.all(), workers=2, budget=60)
+
+    def test_sync_during_refresh(self):
+        "sync() doesn't wait for a refresh to recount, and its deltas are left for the next refresh"
+        factories.NCVoter(ncid='AA0', data={'party_cd': 'DEM'})
+        NCVoterQueryView.rebuild()
+        factories.NCVoterQueryCache(qs_filters={'party_cd': 'DEM'}, count=1)
+        NCVoterQueryView.sync([factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM'}).id])
+        recount = NCVoterQueryView.recount
+        errors = []
+
+        def sync():
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET lock_timeout = '1s'")
+                NCVoterQueryView.sync([factories.NCVoter(ncid='AA2', data={'party_cd': 'DEM'}).id])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        def recount_while_syncing(*args, **kwargs):
+            thread = threading.Thread(target=sync)
+            thread.start()
+            thread.join()
+            return recount(*args, **kwargs)
+
+        with patch('voter.models.NCVoterQueryView.recount', side_effect=recount_while_syncing):
+            NCVoterQueryView.refresh(recount=True)
+        self.assertEqual([], errors)
+        self.assertEqual(2, NCVoter.get_count({'party_cd': 'DEM'}))
+        self.assertEqual(2, NCVoterFacetCube.get_count({'party_cd': 'DEM'}))
+        self.assertEqual(1, NCVoterQueryDelta.objects.count())
+        NCVoterQueryView.refresh()
+        self.assertEqual(3, NCVoter.get_count({'party_cd': 'DEM'}))
+        self.assertEqual(3, NCVoterFacetCube.get_count({'party_cd': 'DEM'}))
+
+    def test_facet_cube_readable_during_rebuild(self):
+        factories.NCVoter(ncid='AA0', data={'party_cd': 'DEM'})
+        NCVoterQueryView.rebuild()
+        NCVoterQueryView.sync([factories.NCVoter(ncid='AA1', data={'party_cd': 'DEM'}).id])
+        rebuilt = threading.Event()
+        done = threading.Event()
+
+        def rebuild():
+            # A refresh, still recounting after rebuilding the cube
+            try:
+                with transaction.atomic():
+                    NCVoterFacetCube.rebuild(after_delta=NCVoterQueryDelta.objects.latest('id').id)
+                    rebuilt.set()
+                    done.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=rebuild)
+        thread.start()
+        try:
+            rebuilt.wait(10)
+            with connection.cursor() as cursor:
+                cursor.execute("SET lock_timeout = '1s'")
+            # The cube as of before the rebuild, without waiting for it
+            self.assertEqual(1, NCVoterFacetCube.get_count({'party_cd': 'DEM'}))
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(2, NCVoterFacetCube.get_count({'party_cd': 'DEM'}))
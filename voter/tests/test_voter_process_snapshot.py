@@ -1,11 +1,23 @@
 import datetime
+import os
+import tempfile
+import threading
+import zipfile
 from unittest import mock
 
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 import django.utils.timezone
 
-from voter.models import FileTracker, ChangeTracker, NCVHis, NCVoter, BadLineRange
-from voter.management.commands.voter_process_snapshot import process_files, get_file_lines, skip_or_voter, record_change, reset, diff_dicts, flush
+from voter.hashing import CURRENT_VERSION, LEGACY_VERSION, row_hash
+from voter.models import FileTracker, ChangeTracker, NCVHis, NCVoter, BadLineRange, DeferredIndex, NCVoterQueryView, \
+    FieldChange
+from voter.management.commands.voter_backfill_field_changes import backfill_field_changes
+from voter.management.commands.voter_process_snapshot import process_files, get_file_lines, skip_or_voter, record_change, reset, diff_dicts, flush, \
+    staging_table_name, get_prepared_lines, prepare_change, prefetch_batch, update_records, get_file_encoding, \
+    clean_and_split_line, split_fields, RowSplitter, get_checkpoint, read_snapshot_blocks, claim_file, renew_lease, \
+    reset_file, finish_file, defer_indexes, rebuild_indexes
 
 file_trackers_data = [
     {
@@ -66,10 +78,29 @@ file_trackers_data = [
 ]
 
 
+def already_seen_tally():
+    from voter.management.commands import voter_process_snapshot
+    return voter_process_snapshot.already_seen_tally
+
+
+def modified_tally():
+    from voter.management.commands import voter_process_snapshot
+    return voter_process_snapshot.modified_tally
+
+
 def create_file_tracker(i):
     return FileTracker.objects.create(**file_trackers_data[i - 1])
 
 
+def downgrade_hashes(filename):
+    "Make the voters loaded from `filename` look like they were recorded before versioned hashing."
+    rows = {row['ncid']: row for index, line, row in get_file_lines(filename, False)}
+    for voter in NCVoter.objects.all():
+        legacy_hash = row_hash(rows[voter.ncid], LEGACY_VERSION)
+        voter.changelog.update(md5_hash=legacy_hash, hash_version=LEGACY_VERSION)
+        NCVoter.objects.filter(id=voter.id).update(latest_hash=legacy_hash, latest_hash_version=LEGACY_VERSION)
+
+
 def load_sorted_parsed_csv(filename, ModelClass):
     raw_rows = list(get_file_lines(filename))
     if ModelClass == NCVoter:
@@ -299,39 +330,63 @@ class VoterProcessChangeTrackerTest(TestCase):
 
         self.assertEqual(1, BadLineRange.objects.all().count())
 
-    def test_flush_repeat_voter(self):
-        """If the same voter appears twice within the span of the bulk-insert cutoff, we need
-        to insert the previously seen data before continuing.
-        """
+    def test_lease_renewed_without_changes(self):
+        "A file whose voters have all been seen before still keeps its lease alive."
+        create_file_tracker(1)
+        process_files(quiet=True)
+        data = dict(file_trackers_data[0], created=file_trackers_data[0]['created'] + datetime.timedelta(days=1))
+        del data['id']
+        FileTracker.objects.create(**data)
+        changes = ChangeTracker.objects.count()
 
-        add = ChangeTracker(
-            voter=NCVoter(ncid="A1"),
-            md5_hash="0000000000000000",
-            snapshot_dt="2000-01-01",
-            file_tracker=create_file_tracker(1),
-            file_lineno=1,
-            op_code="A",
-            data={"first_name": "Mary", "last_name": "Godwin"},
-        )
+        with mock.patch("voter.management.commands.voter_process_snapshot.renew_lease") as renew:
+            process_files(quiet=True)
+            self.assertGreater(renew.call_count, 0)
+        self.assertEqual(changes, ChangeTracker.objects.count())
+        self.assertFalse(FileTracker.objects.exclude(file_status=FileTracker.PROCESSED).exists())
 
-        modify = ChangeTracker(
-            voter=NCVoter(ncid="A1"),
-            md5_hash="0000000000000001",
-            snapshot_dt="2001-01-01",
-            file_tracker=add.file_tracker,
-            file_lineno=2,
-            op_code="M",
-            data={"first_name": "Mary", "last_name": "Shelley"},
+    def test_repeat_voter_is_coalesced(self):
+        """If the same voter appears twice within the span of the bulk-insert cutoff, both
+        changes are queued without flushing, and the voter is inserted once with its final data.
+        """
+        file_tracker = create_file_tracker(1)
+        first = {"ncid": "A1", "first_name": "MARY", "last_name": "GODWIN"}
+        second = {"ncid": "A1", "first_name": "MARY", "last_name": "SHELLEY"}
+
+        with mock.patch("voter.management.commands.voter_process_snapshot.flush") as mock_flush:
+            for line_no, row in enumerate([first, second], 1):
+                ncid, voter = skip_or_voter(row)
+                record_change(prepare_change(file_tracker, row, voter, line_no))
+            self.assertEqual(0, mock_flush.call_count)
+        flush()
+
+        voter = NCVoter.objects.get()
+        self.assertEqual("SHELLEY", voter.data["last_name"])
+        add, modify = voter.changelog.order_by('file_lineno')
+        self.assertEqual(("A", "M"), (add.op_code, modify.op_code))
+        self.assertEqual({"last_name": "SHELLEY"}, modify.data)
+        self.assertEqual(voter.latest_hash, modify.md5_hash)
+
+    def test_repeat_existing_voter_is_coalesced(self):
+        "A voter modified twice in one batch is written once, with its final data"
+        file_tracker = create_file_tracker(1)
+        NCVoter.objects.create(ncid="A1", data={"ncid": "A1", "last_name": "GODWIN"})
+        rows = [{"ncid": "A1", "last_name": "SHELLEY"}, {"ncid": "A1", "last_name": "WOLLSTONECRAFT"}]
+        prefetch_batch(rows)
+
+        for line_no, row in enumerate(rows, 1):
+            ncid, voter = skip_or_voter(row)
+            record_change(prepare_change(file_tracker, row, voter, line_no))
+        self.assertEqual(1, len(update_records))
+        flush()
+
+        voter = NCVoter.objects.get()
+        self.assertEqual("WOLLSTONECRAFT", voter.data["last_name"])
+        self.assertEqual(
+            ["SHELLEY", "WOLLSTONECRAFT"],
+            [c.data["last_name"] for c in voter.changelog.order_by('file_lineno')],
         )
-
-        with mock.patch("voter.management.commands.voter_process_snapshot.flush") as flush:
-            skip_or_voter({"ncid": add.voter.ncid})
-            record_change(add)
-            self.assertEqual(0, flush.call_count)
-
-            skip_or_voter({"ncid": modify.voter.ncid})
-            record_change(modify)
-            self.assertEqual(1, flush.call_count)
+        self.assertEqual(2, modified_tally())
 
     def test_flush_at_bulk_limit(self):
         create_file_tracker(1)
@@ -344,12 +399,110 @@ class VoterProcessChangeTrackerTest(TestCase):
 
                 self.assertEqual(2, flush.call_count)
 
-    def test_flush_doesnt_reset_processed_ncids(self):
-        "flush() should only reset change_records and voter_records, not processed_ncids"
-        processed_ncids = set(['foo', 'bar'])
-        with mock.patch('voter.management.commands.voter_process_snapshot.processed_ncids', processed_ncids):
+    def test_lookups_are_batched(self):
+        "Existing voters and hashes are looked up once per batch, not once per row"
+        self.load_two_snapshots()
+        create_file_tracker(8)
+
+        with mock.patch("voter.management.commands.voter_process_snapshot.BULK_CREATE_AMOUNT", 10):
+            with CaptureQueriesContext(connection) as queries:
+                process_files(quiet=True)
+
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(2, len([sql for sql in selects if 'FROM "voter_ncvoter"' in sql]))
+        # Every voter has a latest_hash, so no need to look at their changelog
+        self.assertEqual(0, len([sql for sql in selects if '"voter_changetracker"."md5_hash" IN' in sql]))
+        # The 6 voters changed by the second snapshot go back to their first version
+        self.assertEqual(13, already_seen_tally())
+
+    def test_flush_size_with_repeated_ncids(self):
+        "Repeated NCIDs don't cut batches short"
+        from voter.management.commands import voter_process_snapshot
+        flush_sizes = []
+
+        def counting_flush():
+            flush_sizes.append(len(voter_process_snapshot.change_records))
             flush()
-        self.assertEqual(processed_ncids, set(['foo', 'bar']))
+
+        with open(file_trackers_data[0]['filename'], encoding='latin1') as f:
+            lines = f.readlines()
+        with open(file_trackers_data[2]['filename'], encoding='latin1') as f:
+            lines += f.readlines()[1:]
+        with tempfile.NamedTemporaryFile('w', encoding='latin1', suffix='.txt') as f:
+            # Each voter's two versions follow each other
+            f.writelines([lines[0]] + [line for pair in zip(lines[1:20], lines[20:]) for line in pair])
+            f.flush()
+            FileTracker.objects.create(**dict(file_trackers_data[0], filename=f.name))
+            with mock.patch("voter.management.commands.voter_process_snapshot.BULK_CREATE_AMOUNT", 10):
+                with mock.patch("voter.management.commands.voter_process_snapshot.flush", counting_flush):
+                    process_files(quiet=True)
+
+        # One flush per batch of 10 rows (the unchanged rows are already seen)
+        self.assertEqual([8, 5, 7, 5], flush_sizes)
+        self.assertEqual(19, ChangeTracker.objects.filter(op_code='A').count())
+        self.assertEqual(6, ChangeTracker.objects.filter(op_code='M').count())
+
+    def test_modifications_are_batched(self):
+        "Modified voters are written with one UPDATE per flush, not one per row"
+        create_file_tracker(1)
+        process_files(quiet=True)
+        create_file_tracker(3)
+
+        with CaptureQueriesContext(connection) as queries:
+            process_files(quiet=True)
+
+        updates = [q['sql'] for q in queries if q['sql'].lstrip().startswith('UPDATE') and 'voter_ncvoter' in q['sql']]
+        self.assertEqual(1, len(updates))
+        self.assertEqual(6, ChangeTracker.objects.filter(op_code='M').count())
+        voter = NCVoter.objects.get(ncid="AS2035")
+        change = voter.changelog.last()
+        self.assertEqual(change.data, {k: voter.data.get(k, '') for k in change.data})
+        self.assertEqual(voter.latest_hash, change.md5_hash)
+
+    def test_already_seen_without_latest_hash(self):
+        """Voters that haven't been backfilled yet are checked against their latest change, looked
+        up once per batch, just like those that have been.
+        """
+        self.load_two_snapshots()
+        NCVoter.objects.update(latest_hash=None, latest_snapshot_dt=None)
+        create_file_tracker(8)
+
+        with mock.patch("voter.management.commands.voter_process_snapshot.BULK_CREATE_AMOUNT", 10):
+            with CaptureQueriesContext(connection) as queries:
+                process_files(quiet=True)
+
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(2, len([sql for sql in selects if 'DISTINCT ON ("voter_changetracker"."voter_id")' in sql]))
+        # The voters changed by the second snapshot go back to their first one's data
+        self.assertEqual(13, already_seen_tally())
+        self.assertEqual(6, ChangeTracker.objects.filter(file_tracker_id=8, op_code='M').count())
+
+    def test_already_seen_without_latest_hash_copy(self):
+        self.load_two_snapshots()
+        NCVoter.objects.update(latest_hash=None, latest_snapshot_dt=None)
+        create_file_tracker(8)
+        process_files(quiet=True, copy=True)
+        self.assertEqual(6, ChangeTracker.objects.filter(file_tracker_id=8, op_code='M').count())
+
+    def test_latest_hash(self):
+        self.load_two_snapshots()
+
+        voter = NCVoter.objects.get(ncid="AS2035")
+        change1, change2 = voter.changelog.all()
+        self.assertEqual(voter.latest_hash, change2.md5_hash)
+        self.assertEqual(voter.latest_snapshot_dt, change2.snapshot_dt)
+
+    def test_reverted_voter_is_modified(self):
+        "Going back to an older version of a voter's data is a change, not an already seen row"
+        self.load_two_snapshots()
+        create_file_tracker(8)
+        process_files(quiet=True)
+
+        voter = NCVoter.objects.get(ncid="AS2035")
+        change1, change2, change3 = voter.changelog.all()
+        self.assertEqual(change3.data["last_name"], 'LANGSTON')
+        self.assertEqual(voter.data["last_name"], 'LANGSTON')
+        self.assertEqual(voter.latest_hash, change1.md5_hash)
 
     def test_unhandled_exceptions_reset(self):
         create_file_tracker(1)
@@ -375,16 +528,12 @@ class VoterProcessChangeTrackerTest(TestCase):
         ft.save()
 
         with mock.patch("voter.management.commands.voter_process_snapshot.track_changes") as track_changes:
-            with mock.patch("voter.management.commands.voter_process_snapshot.FileTracker.objects.filter") as filter:
-                track_changes.side_effect = lambda *a: (0, 1, 2, 3)
-
-                def filter_func(*a, **kw):
-                    return FileTracker.objects.all()
-
-                filter.side_effect = filter_func
+            track_changes.side_effect = lambda *a: (0, 1, 2, 3)
+            process_files(quiet=True)
+            self.assertEqual(0, track_changes.call_count)
 
-                process_files(quiet=True)
-                self.assertEqual(0, track_changes.call_count)
+            process_files(quiet=True, resume=True)
+            self.assertEqual(1, track_changes.call_count)
 
     def test_line_numbers_across_files(self):
         ft0 = create_file_tracker(1)
@@ -395,3 +544,628 @@ class VoterProcessChangeTrackerTest(TestCase):
         self.assertEqual(1, ft0_first_tracker.file_lineno)
         ft1_first_tracker = ChangeTracker.objects.filter(file_tracker=ft1).order_by('file_lineno').first()
         self.assertEqual(1, ft1_first_tracker.file_lineno)
+
+
+class ProcessModesTestCase(TestCase):
+    """Base for tests that run the same files through several processing modes. Each entry of
+    `modes` is a set of options for process_files().
+    """
+    modes = ()
+
+    def setUp(self):
+        reset()
+
+    def snapshot_db(self):
+        voters = {
+            v.ncid: (v.data, v.latest_hash, v.latest_hash_version, v.latest_snapshot_dt)
+            for v in NCVoter.objects.all()
+        }
+        changes = [
+            (c.voter.ncid, c.op_code, c.file_lineno, c.md5_hash, c.hash_version, c.snapshot_dt, c.data)
+            for c in ChangeTracker.objects.select_related('voter').order_by('file_tracker_id', 'file_lineno')
+        ]
+        bad_lines = list(BadLineRange.objects.order_by('filename', 'first_line_no').values_list(
+            'filename', 'first_line_no', 'last_line_no', 'message', 'is_warning'))
+        return voters, changes, bad_lines
+
+    def assert_query_view_synced(self):
+        "NCVoterQueryView rows kept up by the ingest must match a full rebuild (but for their random keys)."
+        columns = [field.attname for field in NCVoterQueryView._meta.fields if field.name != 'random_key']
+        synced = list(NCVoterQueryView.objects.order_by('pk').values(*columns))
+        self.assertEqual(NCVoter.objects.count(), len(synced))
+        NCVoterQueryView.rebuild()
+        self.assertEqual(list(NCVoterQueryView.objects.order_by('pk').values(*columns)), synced)
+
+    def assert_field_changes_backfilled(self):
+        "FieldChange rows written by the ingest must match a backfill from the change history."
+        def snapshot():
+            return [
+                (f.voter.ncid, f.change.file_lineno, f.field, f.old_value, f.new_value, f.snapshot_dt)
+                for f in FieldChange.objects.select_related('voter', 'change').order_by('change_id', 'field')
+            ]
+        field_changes = snapshot()
+        FieldChange.objects.all().delete()
+        backfill_field_changes(chunk_size=5, output=False)
+        self.assertEqual(snapshot(), field_changes)
+        return field_changes
+
+    def clear_db(self):
+        ChangeTracker.objects.all().delete()
+        NCVoter.objects.all().delete()
+        BadLineRange.objects.all().delete()
+        FileTracker.objects.all().delete()
+
+    def assert_same_results(self, *file_tracker_numbers):
+        results = []
+        field_changes = []
+        for options in self.modes:
+            for i in file_tracker_numbers:
+                create_file_tracker(i)
+                process_files(quiet=True, **options)
+            self.assert_query_view_synced()
+            field_changes.append(self.assert_field_changes_backfilled())
+            results.append(self.snapshot_db())
+            self.clear_db()
+        for result in results[1:]:
+            self.assertEqual(results[0], result)
+        for result in field_changes[1:]:
+            self.assertEqual(field_changes[0], result)
+        return results[-1]
+
+
+class VoterProcessCopyTest(ProcessModesTestCase):
+    """The staging-table path must leave the database exactly as the row-by-row one does."""
+    modes = ({'copy': False}, {'copy': True})
+
+    def test_same_adds(self):
+        voters, changes, bad_lines = self.assert_same_results(1)
+        self.assertEqual(19, len(changes))
+
+    def test_same_modifications(self):
+        voters, changes, bad_lines = self.assert_same_results(1, 3)
+        self.assertEqual(6, len([c for c in changes if c[1] == 'M']))
+
+    def test_field_changes(self):
+        "Each field of a modify is indexed with its value from the voter's previous version."
+        create_file_tracker(1)
+        create_file_tracker(3)
+        process_files(quiet=True, copy=True)
+        modifies = ChangeTracker.objects.filter(op_code=ChangeTracker.OP_CODE_MODIFY)
+        self.assertEqual(6, modifies.count())
+        for change in modifies:
+            previous = {}
+            for earlier in change.voter.changelog.filter(id__lt=change.id).order_by('id'):
+                previous.update(earlier.data)
+            self.assertEqual(
+                {field: (previous.get(field), value) for field, value in change.data.items()},
+                {f.field: (f.old_value, f.new_value) for f in change.field_changes.all()},
+            )
+
+    def test_same_unchanged(self):
+        voters, changes, bad_lines = self.assert_same_results(1, 8)
+        self.assertEqual(19, len(changes))
+
+    def test_same_bad_lines(self):
+        voters, changes, bad_lines = self.assert_same_results(4, 5, 6, 7)
+        self.assertEqual(4, len(bad_lines))
+
+    def test_bad_lines_committed_with_changes(self):
+        "Rows that fail to parse are recorded as bad lines along with the changes, not after them"
+        parse_row = NCVoter.parse_row
+        bad_ncid = next(get_file_lines(file_trackers_data[0]['filename'], False))[2]['ncid']
+
+        def fail_for_bad_ncid(row):
+            if row['ncid'] == bad_ncid:
+                raise ValueError('Unparseable row')
+            return parse_row(row)
+
+        forced = []
+
+        def crash_after_apply(file_tracker, force=False):
+            forced.append(force)
+            if forced.count(True) == 2:
+                raise RuntimeError('Crashed after applying the changes')
+            return renew_lease(file_tracker, force)
+
+        create_file_tracker(1)
+        with mock.patch('voter.management.commands.voter_process_snapshot.NCVoter.parse_row', side_effect=fail_for_bad_ncid), \
+                mock.patch('voter.management.commands.voter_process_snapshot.renew_lease', side_effect=crash_after_apply):
+            with self.assertRaises(Exception):
+                process_files(quiet=True, copy=True)
+        self.assertEqual(18, ChangeTracker.objects.count())
+        self.assertEqual(['Unparseable row'], [line.message.strip().splitlines()[-1].split(': ', 1)[-1]
+                                               for line in BadLineRange.objects.all()])
+
+    def test_same_with_repeated_ncids(self):
+        "An NCID appearing twice in one file is compared against its own earlier row."
+        with open(file_trackers_data[0]['filename'], encoding='latin1') as f:
+            first = f.readlines()
+        with open(file_trackers_data[2]['filename'], encoding='latin1') as f:
+            second = f.readlines()[1:]
+        with tempfile.NamedTemporaryFile('w', encoding='latin1', suffix='.txt') as f:
+            f.writelines(first + second + first[1:])
+            f.flush()
+            file_trackers_data.append(dict(file_trackers_data[0], id=10, filename=f.name))
+            try:
+                voters, changes, bad_lines = self.assert_same_results(10)
+            finally:
+                file_trackers_data.pop()
+        self.assertEqual(19, len([c for c in changes if c[1] == 'A']))
+        # Rows repeated from the first snapshot undo the second snapshot's changes
+        self.assertEqual(12, len([c for c in changes if c[1] == 'M']))
+
+    def test_legacy_hashes(self):
+        "Hashes recorded before versioned hashing still recognize already seen rows"
+        for options in self.modes:
+            for backfilled in (True, False):
+                create_file_tracker(1)
+                process_files(quiet=True)
+                current_hashes = dict(NCVoter.objects.values_list('ncid', 'latest_hash'))
+                downgrade_hashes(file_trackers_data[0]['filename'])
+                if not backfilled:
+                    NCVoter.objects.update(latest_hash=None)
+                create_file_tracker(8)
+                process_files(quiet=True, **options)
+
+                self.assertEqual(0, ChangeTracker.objects.filter(file_tracker_id=8).count())
+                if backfilled:
+                    # Hashes seen again are upgraded to the current version
+                    self.assertEqual(current_hashes, dict(NCVoter.objects.values_list('ncid', 'latest_hash')))
+                    self.assertFalse(NCVoter.objects.exclude(latest_hash_version=CURRENT_VERSION).exists())
+                self.clear_db()
+                reset()
+
+    def test_resume(self):
+        ft = create_file_tracker(1)
+        ChangeTracker.objects.create(
+            file_tracker=ft,
+            file_lineno=10,
+            data={},
+            op_code='A',
+            snapshot_dt=django.utils.timezone.now(),
+            voter=NCVoter.objects.create(ncid="A1"),
+        )
+        process_files(quiet=True, copy=True)
+
+        self.assertEquals(ChangeTracker.objects.filter(op_code='A').count(), 9 + 1)
+
+    def test_staging_table_dropped(self):
+        ft = create_file_tracker(1)
+        process_files(quiet=True, copy=True)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [staging_table_name(ft)])
+            self.assertIsNone(cursor.fetchone()[0])
+
+
+# An odd block size, so blocks split lines (and UTF-16 characters) at awkward places
+@mock.patch('voter.management.commands.voter_process_snapshot.READ_BLOCK_SIZE', 777)
+class VoterProcessWorkersTest(ProcessModesTestCase):
+    """Parsing and hashing in worker processes must not change the results."""
+    modes = ({}, {'workers': 2}, {'copy': True, 'workers': 2})
+
+    def test_same_lines(self):
+        for data in file_trackers_data:
+            serial = list(get_prepared_lines(data['filename'], False))
+            # Both runs record the same bad lines
+            BadLineRange.objects.all().delete()
+            parallel = list(get_prepared_lines(data['filename'], False, workers=2))
+            self.assertEqual(
+                [(index, line, row) for index, line, row, prepared in serial],
+                [(index, line, row) for index, line, row, prepared in parallel],
+            )
+
+    def test_same_latin1(self):
+        voters, changes, bad_lines = self.assert_same_results(1, 3)
+        self.assertEqual(19, len([c for c in changes if c[1] == 'A']))
+
+    def test_same_utf16(self):
+        voters, changes, bad_lines = self.assert_same_results(2)
+        self.assertEqual(19, len(changes))
+
+    def test_same_bad_lines(self):
+        voters, changes, bad_lines = self.assert_same_results(4, 5, 6, 7)
+        self.assertEqual(4, len(bad_lines))
+
+    def test_same_with_placeholders(self):
+        "In a diff, blank lines keep the line numbers of the rows left out in their place"
+        with open(file_trackers_data[0]['filename'], encoding='latin1') as f:
+            lines = f.readlines()
+        lines[3:6] = ['\n'] * 3
+        with tempfile.NamedTemporaryFile('w', encoding='latin1', suffix='.txt') as f:
+            f.writelines(lines)
+            f.flush()
+            for diff in (True, False):
+                file_trackers_data.append(dict(file_trackers_data[0], id=10, filename=f.name, diff=diff))
+                try:
+                    voters, changes, bad_lines = self.assert_same_results(10)
+                finally:
+                    file_trackers_data.pop()
+                if diff:
+                    self.assertEqual([1, 2] + list(range(6, 20)), [c[2] for c in changes])
+                    self.assertEqual([], bad_lines)
+                else:
+                    # Anywhere else, they're bad lines, which don't count as rows
+                    self.assertEqual(list(range(1, 17)), [c[2] for c in changes])
+                    self.assertNotEqual([], bad_lines)
+
+
+@mock.patch('voter.management.commands.voter_process_snapshot.READ_BLOCK_SIZE', 777)
+class VoterProcessZipTest(ProcessModesTestCase):
+    "Reading a file straight from its zip archive must give the same results as reading it extracted."
+    modes = ({}, {'workers': 2}, {'copy': True})
+
+    def setUp(self):
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.zip_filename = os.path.join(tempdir.name, 'snapshots.zip')
+        with zipfile.ZipFile(self.zip_filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for data in file_trackers_data:
+                archive.write(data['filename'], arcname=data['filename'])
+
+    def process(self, file_tracker_numbers, options, zipped):
+        for i in file_tracker_numbers:
+            data = dict(file_trackers_data[i - 1])
+            if zipped:
+                data.update(filename=self.zip_filename, zip_member=data['filename'])
+            FileTracker.objects.create(**data)
+            process_files(quiet=True, **options)
+        voters, changes, bad_lines = self.snapshot_db()
+        self.clear_db()
+        reset()
+        # Bad lines are recorded against the file they're in, which differs of course
+        return voters, changes, [bad_line[1:] for bad_line in bad_lines]
+
+    def assert_same_results(self, *file_tracker_numbers):
+        for options in self.modes:
+            extracted = self.process(file_tracker_numbers, options, zipped=False)
+            self.assertEqual(extracted, self.process(file_tracker_numbers, options, zipped=True))
+        return extracted
+
+    def test_latin1(self):
+        voters, changes, bad_lines = self.assert_same_results(1, 3)
+        self.assertEqual(25, len(changes))
+
+    def test_utf16(self):
+        voters, changes, bad_lines = self.assert_same_results(2)
+        self.assertEqual(19, len(changes))
+
+    def test_bad_lines(self):
+        voters, changes, bad_lines = self.assert_same_results(4, 5, 6, 7)
+        self.assertEqual(4, len(bad_lines))
+
+    def test_encoding_from_stream(self):
+        self.assertEqual('latin1', get_file_encoding(self.zip_filename, file_trackers_data[0]['filename']))
+        self.assertEqual('utf16', get_file_encoding(self.zip_filename, file_trackers_data[1]['filename']))
+
+
+@mock.patch('voter.management.commands.voter_process_snapshot.READ_BLOCK_SIZE', 777)
+@mock.patch('voter.management.commands.voter_process_snapshot.BULK_CREATE_AMOUNT', 3)
+class VoterProcessCheckpointTest(ProcessModesTestCase):
+    "An import interrupted after a checkpoint was saved must pick up reading from it."
+    modes = ({}, {'workers': 2})
+
+    def process(self, data, options, interrupt_after=None):
+        file_tracker = FileTracker.objects.create(**data)
+        if interrupt_after:
+            changes = []
+
+            def interrupting_prepare_change(*args, **kwargs):
+                # Like pressing Ctrl+C in the middle of the import
+                if len(changes) == interrupt_after:
+                    raise KeyboardInterrupt()
+                changes.append(args)
+                return prepare_change(*args, **kwargs)
+
+            with mock.patch('voter.management.commands.voter_process_snapshot.prepare_change',
+                            side_effect=interrupting_prepare_change):
+                process_files(quiet=True, **options)
+            file_tracker.refresh_from_db()
+            self.assertEqual(FileTracker.UNPROCESSED, file_tracker.file_status)
+            self.assertNotEqual(0, file_tracker.checkpoint_offset)
+            reset()
+
+            with mock.patch('voter.management.commands.voter_process_snapshot.read_snapshot_blocks',
+                            wraps=read_snapshot_blocks) as reads:
+                process_files(quiet=True, resume=True, **options)
+            # The header is read from the top of the file, and the rest from the checkpoint
+            self.assertEqual(file_tracker.checkpoint_offset, reads.call_args[0][4])
+        else:
+            process_files(quiet=True, **options)
+        results = self.snapshot_db()
+        self.clear_db()
+        reset()
+        return results
+
+    def assert_same_after_resume(self, data):
+        for options in self.modes:
+            with self.subTest(options=options):
+                self.assertEqual(
+                    self.process(data, options),
+                    self.process(data, options, interrupt_after=10),
+                )
+
+    def test_latin1(self):
+        self.assert_same_after_resume(file_trackers_data[0])
+
+    def test_utf16(self):
+        self.assert_same_after_resume(file_trackers_data[1])
+
+    def test_bad_lines(self):
+        self.assert_same_after_resume(file_trackers_data[3])
+
+    def test_zip(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        zip_filename = os.path.join(tempdir.name, 'snapshots.zip')
+        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(file_trackers_data[1]['filename'], arcname='snapshot_utf16.txt')
+        self.assert_same_after_resume(dict(file_trackers_data[1], filename=zip_filename, zip_member='snapshot_utf16.txt'))
+
+    def test_checkpoint_for_other_encoding_is_ignored(self):
+        file_tracker = create_file_tracker(1)
+        file_tracker.checkpoint_offset = 1000
+        file_tracker.checkpoint_encoding = 'latin1'
+        self.assertEqual(1000, get_checkpoint(file_tracker).offset)
+        file_tracker.checkpoint_encoding = 'utf16'
+        self.assertIsNone(get_checkpoint(file_tracker))
+
+
+class ClaimFileTest(TestCase):
+
+    def create_file_tracker(self, i, county_num=None, days=0, **kwargs):
+        data = dict(file_trackers_data[i - 1], county_num=county_num, **kwargs)
+        del data['id']
+        data['created'] += datetime.timedelta(days=days)
+        return FileTracker.objects.create(**data)
+
+    def claim_all(self, worker='worker'):
+        claimed = []
+        while True:
+            file_tracker = claim_file(worker)
+            if not file_tracker:
+                return claimed
+            claimed.append(file_tracker)
+
+    def test_claim(self):
+        ft = self.create_file_tracker(1)
+        claimed = claim_file('worker', lease=datetime.timedelta(minutes=5))
+        self.assertEqual(ft, claimed)
+        ft.refresh_from_db()
+        self.assertEqual(FileTracker.PROCESSING, ft.file_status)
+        self.assertEqual('worker', ft.claimed_by)
+        self.assertEqual(datetime.timedelta(minutes=5), ft.lease_expires - ft.heartbeat)
+        self.assertIsNone(claim_file('other worker'))
+
+    def test_counties_in_parallel(self):
+        wake1 = self.create_file_tracker(1, county_num=92)
+        self.create_file_tracker(3, county_num=92, days=1)
+        durham = self.create_file_tracker(1, county_num=32, days=2)
+        # Only the first file of each county can be claimed
+        self.assertEqual([wake1, durham], self.claim_all())
+
+    def test_county_in_order(self):
+        wake1 = self.create_file_tracker(1, county_num=92)
+        wake2 = self.create_file_tracker(3, county_num=92, days=1)
+        self.assertEqual([wake1], self.claim_all())
+        wake1.file_status = FileTracker.PROCESSED
+        wake1.save()
+        self.assertEqual([wake2], self.claim_all())
+
+    def test_statewide_in_order(self):
+        first = self.create_file_tracker(1)
+        self.create_file_tracker(3, days=1)
+        self.assertEqual([first], self.claim_all())
+
+    def test_reclaim_expired_lease(self):
+        ft = self.create_file_tracker(
+            1, file_status=FileTracker.PROCESSING, claimed_by='crashed', lease_expires=django.utils.timezone.now()
+        )
+        self.assertEqual(ft, claim_file('worker'))
+
+    def test_keep_live_lease(self):
+        self.create_file_tracker(
+            1, file_status=FileTracker.PROCESSING, claimed_by='busy',
+            lease_expires=django.utils.timezone.now() + datetime.timedelta(minutes=1),
+        )
+        self.assertIsNone(claim_file('worker'))
+
+    def test_renew_lease(self):
+        self.create_file_tracker(1)
+        ft = claim_file('worker', lease=datetime.timedelta(minutes=5))
+        ft.heartbeat -= datetime.timedelta(minutes=1)
+        old_expiry = ft.lease_expires
+        renew_lease(ft)
+        ft.refresh_from_db()
+        self.assertGreater(ft.lease_expires, old_expiry)
+
+    def test_lost_lease(self):
+        self.create_file_tracker(1)
+        ft = claim_file('worker', lease=datetime.timedelta(minutes=5))
+        FileTracker.objects.filter(pk=ft.pk).update(claimed_by='other worker')
+        ft.heartbeat -= datetime.timedelta(minutes=1)
+        with self.assertRaises(Exception):
+            renew_lease(ft)
+        # Resetting must not take the file away from the other worker either
+        reset_file(ft)
+        ft.refresh_from_db()
+        self.assertEqual(FileTracker.PROCESSING, ft.file_status)
+        self.assertEqual('other worker', ft.claimed_by)
+
+    def test_finish_file(self):
+        self.create_file_tracker(1)
+        ft = claim_file('worker')
+        finish_file(ft)
+        ft.refresh_from_db()
+        self.assertEqual(FileTracker.PROCESSED, ft.file_status)
+
+    def test_finish_lost_file(self):
+        self.create_file_tracker(1)
+        ft = claim_file('worker')
+        FileTracker.objects.filter(pk=ft.pk).update(claimed_by='other worker')
+        with self.assertRaises(Exception):
+            finish_file(ft)
+        ft.refresh_from_db()
+        self.assertEqual(FileTracker.PROCESSING, ft.file_status)
+
+
+class ClaimFileConcurrencyTest(TransactionTestCase):
+
+    def test_skip_locked(self):
+        for county_num in (1, 2):
+            data = dict(file_trackers_data[0], county_num=county_num)
+            del data['id']
+            FileTracker.objects.create(**data)
+        locked = threading.Event()
+        done = threading.Event()
+
+        def hold_lock():
+            # Another worker, halfway through claiming the first file
+            with transaction.atomic():
+                FileTracker.objects.select_for_update().get(county_num=1)
+                locked.set()
+                done.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            locked.wait(10)
+            claimed = claim_file('worker')
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(2, claimed.county_num)
+
+
+class BulkLoadTest(TestCase):
+
+    def setUp(self):
+        reset()
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT indexname, indexdef FROM pg_indexes
+                 WHERE tablename IN ('voter_ncvoter', 'voter_changetracker', 'voter_ncvoterqueryview',
+                                     'voter_fieldchange')
+            """)
+            return dict(cursor.fetchall())
+
+    def test_defer_and_rebuild(self):
+        before = self.indexes()
+        defer_indexes(output=False)
+        deferred = set(DeferredIndex.objects.values_list('index_name', flat=True))
+        self.assertEqual(set(before) - set(self.indexes()), deferred)
+        self.assertIn('voter_ncvot_data_2e8e15_gin', deferred)
+        self.assertIn('voter_changetracker_file_lineno_5dab3cad', deferred)
+        # Primary keys, unique indexes and the indexes loading looks rows up by stay
+        for index_name in ('voter_ncvoter_pkey', 'voter_ncvoter_ncid_key', 'voter_changetracker_voter_id_a2e35707',
+                           'voter_changetracker_file_tracker_id_5a1529a3'):
+            self.assertNotIn(index_name, deferred)
+
+        create_file_tracker(1)
+        process_files(quiet=True)
+        self.assertEqual(19, ChangeTracker.objects.count())
+
+        # Committing would run the deferred foreign key checks, which an index can't be
+        # created with pending. Tests never commit, so run them now.
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        rebuild_indexes(workers=2, output=False)
+        self.assertEqual(before, self.indexes())
+        self.assertFalse(DeferredIndex.objects.exists())
+
+    def test_resume_rebuild(self):
+        before = self.indexes()
+        defer_indexes(output=False)
+        self.assertGreater(DeferredIndex.objects.count(), 1)
+        delete = DeferredIndex.delete
+        deleted = []
+
+        def interrupting_delete(index):
+            if deleted:
+                raise KeyboardInterrupt()
+            deleted.append(index.index_name)
+            return delete(index)
+
+        with mock.patch.object(DeferredIndex, 'delete', autospec=True, side_effect=interrupting_delete):
+            with self.assertRaises(KeyboardInterrupt):
+                rebuild_indexes(output=False)
+        # The first index was rebuilt, and the rest are still to do
+        self.assertIn(deleted[0], self.indexes())
+        remaining = set(DeferredIndex.objects.values_list('index_name', flat=True))
+        self.assertEqual(set(before) - set(self.indexes()), remaining)
+        self.assertNotIn(deleted[0], remaining)
+
+        rebuild_indexes(output=False)
+        self.assertEqual(before, self.indexes())
+        self.assertFalse(DeferredIndex.objects.exists())
+
+
+class SplitFieldsTest(SimpleTestCase):
+
+    lines = [
+        '',
+        'a\tb\tc',
+        ' a \t\t c\n',
+        '"a"\t"b"\t"c"',
+        '"a"\t"b"\t"c"\n',
+        '"a"\t""\t" c "\r\n',
+        '"a"\t"b"c"\t"d"',
+        '"a"\tb\t"c"',
+        'a\t"b"\t"c"',
+        '"a""\t"b"',
+        '"a\t"b"',
+        '"a"\t"b\x00"\t"c"',
+        'a\x00\tb',
+        '\x00\t\x00\t \x00\ta',
+        '"a"\t"b"\t"c" \n',
+        '"\t"',
+        '"',
+    ]
+
+    def test_same_as_clean_and_split_line(self):
+        for line in self.lines:
+            with self.subTest(line=line):
+                self.assertEqual(clean_and_split_line(line), split_fields(line))
+
+    def test_same_for_snapshot_files(self):
+        for filename, encoding in (('snapshot_latin1.txt', 'latin1'), ('snapshot_utf16.txt', 'utf16'), ('current.txt', 'latin1')):
+            path = os.path.join('voter/test_data/2010-10-31T00-00-00', filename)
+            with open(path, encoding=encoding) as f:
+                for line in f:
+                    self.assertEqual(clean_and_split_line(line), split_fields(line))
+
+
+class RowSplitterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.header = ['col{}'.format(i) for i in range(50)]
+        self.splitter = RowSplitter(self.header)
+
+    def test_skips_empty_fields(self):
+        fields = [''] * 50
+        fields[0] = 'a'
+        fields[49] = 'b'
+        self.assertEqual(({'col0': 'a', 'col49': 'b'}, None, None), self.splitter.split('\t'.join(fields)))
+
+    def test_extra_cells(self):
+        for extra in (1, 3):
+            fields = [str(i) for i in range(45)] + ['x'] * extra + [str(i) for i in range(45, 50)]
+            row, warning, error = self.splitter.split('\t'.join(fields))
+            self.assertEqual({'col{}'.format(i): str(i) for i in range(50)}, row)
+            self.assertIsNotNone(warning)
+            self.assertIsNone(error)
+
+    def test_placeholder(self):
+        row, warning, error = self.splitter.split('\n')
+        self.assertIsNone(row)
+        self.assertIsNotNone(error)
+        self.assertEqual((None, None, None), RowSplitter(self.header, placeholders=True).split('\n'))
+
+    def test_wrong_number_of_cells(self):
+        for count in (49, 52, 60):
+            row, warning, error = self.splitter.split('\t'.join(['x'] * count))
+            self.assertIsNone(row)
+            self.assertIsNotNone(error)
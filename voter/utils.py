@@ -2,6 +2,7 @@ from datetime import datetime, timezone
 from enum import Enum
 import os
 import subprocess
+import zipfile
 
 import requests
 
@@ -68,6 +69,17 @@ def extract_and_remove_file(filename):
         return True
 
 
+def list_zip_members(filename):
+    """Return the names of the .txt files inside the zip archive `filename`, or None if it
+    isn't a zip archive we can read.
+    """
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            return [name for name in archive.namelist() if name.endswith(".txt")]
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+
 def attempt_fetch_and_write_new_zip(url, base_path, output=False):
     etag, resp = get_etag_and_zip_stream(url)
     now = datetime.now(timezone.utc)
@@ -89,34 +101,52 @@ def attempt_fetch_and_write_new_zip(url, base_path, output=False):
     return (status_code, etag, now, target_filename)
 
 
-def process_new_zip(url, base_path, label, county_num=None, output=False):
+def process_new_zip(url, base_path, label, county_num=None, output=False, extract=True):
+    """Fetch the zip file at `url` if it's new, and add a FileTracker for each data file in it.
+
+    If `extract` is False, the zip file is kept as it is, and its data files are read
+    straight from it when processing, which saves writing them to disk. Only the NCVoter
+    files are read that way (by voter_process_snapshot), so other files are always extracted.
+    """
     out("Looking at {0}".format(url), output)
+    if label != 'ncvoter':
+        extract = True
 
     fetch_status_code, etag, created_time, target_filename = attempt_fetch_and_write_new_zip(url, base_path, output)
     if fetch_status_code == FETCH_STATUS_CODES.CODE_OK:
         out("Fetched {0} successfully to {1}".format(url, target_filename), output)
-        out("Extracting {0}".format(target_filename), output)
-        unzip_success = extract_and_remove_file(target_filename)
-        if unzip_success:
+        if extract:
+            out("Extracting {0}".format(target_filename), output)
+            unzip_success = extract_and_remove_file(target_filename)
+            if not unzip_success:
+                out("Unable to unzip {0}".format(target_filename), output)
+                return FETCH_STATUS_CODES.CODE_WRITE_FAILURE
             target_dir = os.path.dirname(target_filename)
-            for filename in os.listdir(target_dir):
-                # Need to implement a warning system if there are multiple files
-                if filename.endswith(".txt"):
-                    result_filename = os.path.join(target_dir, filename)
-                    out("Finished extracting to {0}".format(result_filename), output)
-                    out("Updating FileTracker table", output)
-                    if label == 'ncvoter':
-                        data_file_kind = FileTracker.DATA_FILE_KIND_NCVOTER
-                    else:
-                        data_file_kind = FileTracker.DATA_FILE_KIND_NCVHIS
-                    FileTracker.objects.create(
-                        etag=etag, filename=result_filename,
-                        county_num=county_num, created=created_time,
-                        data_file_kind=data_file_kind)
-                    out("Updated FileTracker table", output)
+            # Need to implement a warning system if there are multiple files
+            data_files = [(os.path.join(target_dir, filename), '') for filename in os.listdir(target_dir)
+                          if filename.endswith(".txt")]
         else:
-            out("Unable to unzip {0}".format(target_filename), output)
-            return FETCH_STATUS_CODES.CODE_WRITE_FAILURE
+            members = list_zip_members(target_filename)
+            if members is None:
+                out("Unable to read zip file {0}".format(target_filename), output)
+                return FETCH_STATUS_CODES.CODE_WRITE_FAILURE
+            data_files = [(target_filename, member) for member in members]
+
+        if label == 'ncvoter':
+            data_file_kind = FileTracker.DATA_FILE_KIND_NCVOTER
+        else:
+            data_file_kind = FileTracker.DATA_FILE_KIND_NCVHIS
+        for result_filename, zip_member in data_files:
+            if zip_member:
+                out("Found {0} in {1}".format(zip_member, result_filename), output)
+            else:
+                out("Finished extracting to {0}".format(result_filename), output)
+            out("Updating FileTracker table", output)
+            FileTracker.objects.create(
+                etag=etag, filename=result_filename, zip_member=zip_member,
+                county_num=county_num, created=created_time,
+                data_file_kind=data_file_kind)
+            out("Updated FileTracker table", output)
     else:
         if fetch_status_code == FETCH_STATUS_CODES.CODE_NOTHING_TO_DO:
             out("File already downloaded", output)
@@ -1,7 +1,12 @@
 import json
 from datetime import datetime
+from django.contrib.postgres.fields.jsonb import KeyTransform
+from django.db.models import BooleanField, Case, Value, When
 from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse
-from voter.models import ChangeTracker
+from voter.models import FieldChange, NCVoter
+
+# The keys of NCVoter.data that get_voter_basic() uses
+VOTER_BASIC_DATA_KEYS = ('first_name', 'midl_name', 'last_name', 'age')
 
 
 class Serializer(json.JSONEncoder):
@@ -16,15 +21,15 @@ class Serializer(json.JSONEncoder):
         raise TypeError("Cannot serialize type '%s': %r" % (obj.__class__.__name__, obj))
 
 
-def get_voter_basic(voter):
-    d = voter.build_current()
+def get_voter_basic(data):
+    """Summarize a voter from its current data, of which only VOTER_BASIC_DATA_KEYS are needed."""
     return {
         "full_name": ' '.join((
-            d.get('first_name', ''),
-            d.get('midl_name', ''),
-            d.get('last_name', ''),
+            data.get('first_name', ''),
+            data.get('midl_name', ''),
+            data.get('last_name', ''),
         )),
-        "age": d.get('age', ''),
+        "age": data.get('age', ''),
     }
 
 
@@ -45,38 +50,54 @@ def changes(request):
     new = request.GET.get('new')
     limit = int(request.GET.get('limit', '10')) or None
 
-    # Find change records that include the given field, only showing the most recent record
-    # for each voter, but prefetching the related voter and their entire change history.
-    mod_records = ChangeTracker.objects.filter(
-        op_code=ChangeTracker.OP_CODE_MODIFY,
-        data__has_key=changed,
-    )\
-        .prefetch_related('voter__changelog')\
-        .order_by('voter__pk', '-snapshot_dt')\
-        .distinct('voter__pk')
+    # Find the changes to the given field in the FieldChange index
+    field_changes = FieldChange.objects.filter(field=changed)
 
     # Don't include data that was just removed
-    mod_records = mod_records.exclude(**{'data__' + changed: ""})
+    field_changes = field_changes.exclude(new_value="")
 
     # If requested, only include results where the field was changed to a specific new value
     # For example, changed=county_desc and new=DURHAM to find people who moved to Durham
     if new:
-        mod_records = mod_records.filter(**{'data__' + changed: new})
+        field_changes = field_changes.filter(new_value=new)
+
+    # Only show the most recent change for each voter, along with the few fields of the
+    # voter's current data that we show, all in the one query.
+    voter_keys = {'voter_' + key: KeyTransform(key, 'voter__data') for key in VOTER_BASIC_DATA_KEYS}
+    voter_data_is_null = Case(
+        When(voter__data__isnull=True, then=Value(True)), default=Value(False), output_field=BooleanField(),
+    )
+    field_changes = field_changes\
+        .annotate(voter_data_is_null=voter_data_is_null, **voter_keys)\
+        .order_by('voter_id', '-snapshot_dt', '-change_id')\
+        .distinct('voter_id')\
+        .values('voter_id', 'voter__ncid', 'old_value', 'new_value', 'snapshot_dt', 'voter_data_is_null', *voter_keys)
 
     if request.GET.get('__debug'):
-        return HttpResponse(mod_records.query)
+        return HttpResponse(field_changes.query)
+
+    field_changes = list(field_changes[:limit])
+    # Voters whose data isn't set yet are summarized from their changelog instead
+    legacy_voters = NCVoter.objects\
+        .filter(id__in=[c['voter_id'] for c in field_changes if c['voter_data_is_null']])\
+        .prefetch_related('changelog')
+    legacy_data = {voter.id: voter.build_current() for voter in legacy_voters}
 
     result = {}
-    for c in mod_records[:limit]:
+    for c in field_changes:
         r = {}
-        prev = c.get_prev()
-
-        r["new"] = c.build_version()[changed]
-        r["old"] = prev.build_version().get(changed, '') if prev else ''
-        r["when"] = c.snapshot_dt
-        r["voter"] = get_voter_basic(c.voter)
 
-        result[c.voter.ncid] = r
+        r["new"] = c['new_value']
+        r["old"] = '' if c['old_value'] is None else c['old_value']
+        r["when"] = c['snapshot_dt']
+        if c['voter_id'] in legacy_data:
+            r["voter"] = get_voter_basic(legacy_data[c['voter_id']])
+        else:
+            r["voter"] = get_voter_basic({
+                key: c['voter_' + key] for key in VOTER_BASIC_DATA_KEYS if c['voter_' + key] is not None
+            })
+
+        result[c['voter__ncid']] = r
 
     result['_elapsed'] = (datetime.now() - start).total_seconds()
 